@@ -0,0 +1,107 @@
+"""
+Tiny benchmark harness shared by the scripts in this directory.
+
+CPython does not expose a per-call allocation counter, so memory is reported with two tracemalloc based numbers:
+- `peak B/op` - transient heap used by a single operation (peak of traced memory during one call);
+- `blocks/op` - memory blocks still alive after the run divided by the number of operations (leaks/retention).
+"""
+import asyncio
+import gc
+import json
+import os
+import time
+import tracemalloc
+from typing import Any, Awaitable, Callable, Coroutine
+
+from wb_to_ha import event_loop
+
+TESTDATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests', 'discovery', 'testdata')
+
+class BenchResult:
+    name: str
+    ops: int
+    ns_per_op: float
+    peak_bytes_per_op: float
+    blocks_per_op: float
+
+    def __init__(self, name: str, ops: int, ns_per_op: float, peak_bytes_per_op: float, blocks_per_op: float):
+        self.name = name
+        self.ops = ops
+        self.ns_per_op = ns_per_op
+        self.peak_bytes_per_op = peak_bytes_per_op
+        self.blocks_per_op = blocks_per_op
+
+    def __str__(self) -> str:
+        return f'{self.name:<68} {self.ops:>9} {self.ns_per_op:>14.1f} {self.peak_bytes_per_op:>12.1f} {self.blocks_per_op:>10.2f}'
+
+def header() -> str:
+    return f'{"benchmark":<68} {"ops":>9} {"ns/op":>14} {"peak B/op":>12} {"blocks/op":>10}'
+
+def load_messages(name: str = 'basic') -> list[tuple[str, bytes]]:
+    """Loads recorded WB traffic in the JSONL format used by LocalMQTTClient."""
+    result = []
+    with open(os.path.join(TESTDATA_DIR, name, 'wb.input.txt')) as f:
+        for line in f:
+            msg = json.loads(line)
+            result.append((msg['topic'], msg['payload'].encode('utf-8')))
+    return result
+
+async def bench(name: str, op: Callable[[int], Awaitable[None] | None], ops: int, mem_ops: int = 200) -> BenchResult:
+    """Measures `op(i)` for i in range(ops). Coroutine results are awaited, so async pipelines are measured end to end."""
+    async def run(n: int):
+        for i in range(n):
+            r = op(i)
+            if r is not None:
+                await r
+
+    await run(min(ops, 100))  # warmup
+
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.perf_counter_ns()
+        await run(ops)
+        elapsed = time.perf_counter_ns() - start
+    finally:
+        gc.enable()
+
+    peak_total = 0
+    tracemalloc.start()
+    try:
+        gc.collect()
+        traces_before = len(tracemalloc.take_snapshot().traces)
+        for i in range(mem_ops):
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            r = op(i)
+            if r is not None:
+                await r
+            _, peak = tracemalloc.get_traced_memory()
+            peak_total += peak - current
+        gc.collect()
+        traces_after = len(tracemalloc.take_snapshot().traces)
+    finally:
+        tracemalloc.stop()
+
+    return BenchResult(
+        name=name,
+        ops=ops,
+        ns_per_op=elapsed / ops,
+        peak_bytes_per_op=peak_total / mem_ops,
+        blocks_per_op=(traces_after - traces_before) / mem_ops,
+    )
+
+def run_benchmarks(benchmarks: Callable[[], Coroutine[Any, Any, list[BenchResult]]], loops: list[str] = [event_loop.LOOP_ASYNCIO]):
+    """Runs benchmarks on every event loop of `loops`, loops which are not installed are skipped."""
+    for name in loops:
+        event_loop.set_loop(name)
+        if event_loop.loop_name() != name:
+            print(f'event loop {name}: not installed, skipped')
+            continue
+        with asyncio.Runner(loop_factory=event_loop.new_event_loop) as runner:
+            results = runner.run(benchmarks())
+        if len(loops) > 1:
+            print(f'event loop {name}:')
+        print(header())
+        for r in results:
+            print(r)
@@ -0,0 +1,175 @@
+"""
+Micro-benchmarks for the hot paths of the bridge.
+
+Everything runs offline: both MQTT sides are InmemMQTTClient instances, WB traffic is taken from tests testdata.
+
+Usage:
+    python benchmarks/micro.py [-n OPS] [-k FILTER] [--json json|orjson]
+"""
+import asyncio
+import logging
+import optparse
+import os
+import sys
+import yaml
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.harness import BenchResult, bench, load_messages, run_benchmarks
+from wb_to_ha import json_backend
+from wb_to_ha.homeassistant import HomeAssistant, HomeAssistantDiscoveryCustomizer
+from wb_to_ha.manual_config import ManualConfigService, dict_to_yaml
+from wb_to_ha.mqtt.conn.inmem_mqtt import InmemMQTTClient
+from wb_to_ha.mqtt.mqtt_router import MQTTRouter
+from wb_to_ha.wirenboard import Wirenboard
+from wb_to_ha.wirenboard_registry import WirenBoardDeviceRegistry
+
+class PyYAMLReferenceDumper(yaml.Dumper):
+    """PyYAML configured to produce the same output as manual_config.dict_to_yaml."""
+    def increase_indent(self, flow=False, indentless=False):
+        return super().increase_indent(flow, False)
+
+    def represent_mapping(self, tag, mapping, flow_style=None):
+        node = super().represent_mapping(tag, mapping, flow_style)
+        for key, _ in node.value:
+            key.style = None
+        return node
+
+PyYAMLReferenceDumper.add_representer(str, lambda dumper, data: dumper.represent_scalar('tag:yaml.org,2002:str', data, style='"'))
+
+def dispatch(router, topic, payload):
+    router._on_message(None, topic, payload, 0, {})
+
+class Bridge:
+    """Wirenboard + HomeAssistant wired the same way as App does, but with in-memory clients on both sides."""
+    ha_client: InmemMQTTClient
+    wb_router: MQTTRouter
+    registry: WirenBoardDeviceRegistry
+    ha: HomeAssistant
+    wb: Wirenboard
+
+    def __init__(self, single_subscription):
+        self.ha_client = InmemMQTTClient()
+        self.wb_router = MQTTRouter(InmemMQTTClient(), 'wirenboard')
+        self.registry = WirenBoardDeviceRegistry()
+        self.ha = HomeAssistant(MQTTRouter(self.ha_client, 'homeassistant'), self.registry, HomeAssistantDiscoveryCustomizer(), config_first_publish_delay=0)
+        self.wb = Wirenboard(self.wb_router, self.registry, self.ha, metrics=self.ha.metrics, single_subscription=single_subscription)
+        self.ha.on_control_set_state = self.wb.on_control_set_state
+        self.wb.on_connect()
+        self.ha.on_connect()
+
+def new_bridge(single_subscription=False) -> Bridge:
+    return Bridge(single_subscription)
+
+async def replay(bridge: Bridge, messages: list[tuple[str, bytes]]):
+    for topic, payload in messages:
+        dispatch(bridge.wb_router, topic, payload)
+    await drain()
+
+def router_with_subscriptions(client_name, topics):
+    router = MQTTRouter(InmemMQTTClient(), client_name)
+    router.on_404 = _noop
+    for topic in topics:
+        router.subscribe(topic, _noop)
+    return router
+
+async def drain():
+    current = asyncio.current_task()
+    while any(t is not current and not t.done() for t in asyncio.all_tasks()):
+        await asyncio.sleep(0)
+
+def _noop(topic: str, payload: bytes):
+    pass
+
+async def benchmarks(ops: int, name_filter: str) -> list[BenchResult]:
+    messages = load_messages()
+    bridge = new_bridge()
+    await replay(bridge, messages)
+
+    results: list[BenchResult] = []
+
+    async def add(name: str, op, n: int):
+        if name_filter and name_filter not in name:
+            return
+        results.append(await bench(name, op, n))
+        await drain()
+
+    # Router: the same subscription set as Wirenboard.on_connect registers, with no-op callbacks to measure matching only.
+    wb_router = router_with_subscriptions('wirenboard', ['/devices/+/meta/+', '/devices/+/controls/+/meta/+', '/devices/+/controls/+'])
+    def router_wb(i: int):
+        topic, payload = messages[i % len(messages)]
+        dispatch(wb_router, topic, payload)
+    await add('MQTTRouter._on_message[wirenboard]', router_wb, ops)
+
+    # Router on HA side: InmemMQTTClient loops published states back, so most messages end up in on_404.
+    ha_router = router_with_subscriptions('homeassistant', ['hass/status', '/devices/+/controls/+/on'])
+    ha_topics = [(topic, payload.encode('utf-8')) for topic, payload in bridge.ha_client.last_messages.items()]
+    def router_ha(i: int):
+        topic, payload = ha_topics[i % len(ha_topics)]
+        dispatch(ha_router, topic, payload)
+    await add('MQTTRouter._on_message[homeassistant]', router_ha, ops)
+
+    # Full state pipeline: parse topic, update registry, schedule and run HA publish.
+    states = [(topic, payload) for topic, payload in messages if topic.count('/') == 4 and '/controls/' in topic]
+    def control_state(i: int):
+        topic, payload = states[i % len(states)]
+        bridge.wb._control_state_handler(topic, payload)
+        return asyncio.sleep(0)
+    await add('Wirenboard._control_state_handler', control_state, ops)
+
+    # Discovery payload: dict building, json.dumps and publish to in-memory sink.
+    controls = [(device, control) for device in bridge.registry.devices().values() for control in device.controls.values() if control.type is not None]
+    def control_config(i: int):
+        device, control = controls[i % len(controls)]
+        bridge.ha._publish_control_config(device, control)
+        return asyncio.sleep(0)
+    await add('HomeAssistant._publish_control_config', control_config, ops)
+
+    # Serialized config alone: payload dict built field by field against compiled template.
+    def build_config(i: int):
+        device, control = controls[i % len(controls)]
+        config = bridge.ha._build_control_config(device, control)
+        if config is not None:
+            json_backend.dumps(config[1])
+    await add('HomeAssistant._build_control_config+dumps', build_config, ops)
+    def render_config(i: int):
+        device, control = controls[i % len(controls)]
+        bridge.ha._render_control_config(device, control)
+    await add('HomeAssistant._render_control_config', render_config, ops)
+
+    # Serializer of discovery payloads alone, selected with --json.
+    configs = [payload for topic, payload in bridge.ha_client.last_messages.items() if topic.endswith('/config') and payload]
+    parsed_configs = [json_backend.loads(payload) for payload in configs]
+    def dumps(i: int):
+        json_backend.dumps(parsed_configs[i % len(parsed_configs)])
+    await add(f'json_backend.dumps[{json_backend.backend()}]', dumps, ops)
+    def loads(i: int):
+        json_backend.loads(configs[i % len(configs)])
+    await add('json_backend.loads', loads, ops)
+
+    # YAML add-on: whole document conversion from in-memory retained messages.
+    service = ManualConfigService()
+    last_messages = bridge.ha_client.last_messages
+    def convert(i: int):
+        service.convert_mqtt_topics_messages_to_manual_config(last_messages)
+    await add('ManualConfigService.convert_mqtt_topics_messages_to_manual_config', convert, max(ops // 1000, 10))
+
+    # YAML rendering of the whole document: own emitter against PyYAML with the same output format.
+    document = service.convert_mqtt_topics_messages_to_manual_config(last_messages)
+    def render_emitter(i: int):
+        dict_to_yaml(document)
+    await add('manual_config.dict_to_yaml', render_emitter, max(ops // 1000, 10))
+    def render_pyyaml(i: int):
+        yaml.dump(document, allow_unicode=True, Dumper=PyYAMLReferenceDumper)
+    await add('yaml.dump[reference]', render_pyyaml, max(ops // 1000, 10))
+
+    return results
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.ERROR)
+    parser = optparse.OptionParser()
+    parser.add_option("-n", "--ops", type=int, default=20000, dest="ops", help="Number of operations per benchmark")
+    parser.add_option("-k", "--filter", default="", dest="filter", help="Run only benchmarks which name contains this substring")
+    parser.add_option("--json", default=json_backend.BACKEND_JSON, dest="json_backend", help="Serializer of discovery payloads: json or orjson")
+    opts, args = parser.parse_args()
+    json_backend.set_backend(opts.json_backend)
+    run_benchmarks(lambda: benchmarks(opts.ops, opts.filter))
@@ -0,0 +1,113 @@
+"""
+Replay benchmark: recorded WB traffic goes through the whole bridge, broker side included.
+
+Compares two ways Wirenboard subscribes to the device tree:
+- `3 filters` - /devices/+/meta/+, /devices/+/controls/+/meta/+ and /devices/+/controls/+, MQTTRouter picks the handler
+  by regex and the handler parses topic with one more regex;
+- `/devices/#` - single filter, Wirenboard splits topic and dispatches by number of segments and their names.
+
+Broker CPU is modelled by the work broker does for every published message: it matches topic against each filter
+of the subscriber (segment by segment, like mosquitto and others do) and delivers the message if any filter matches.
+Messages which the broker would not deliver in a scheme are not replayed to the bridge in that scheme.
+With `--commands` every state topic gets a `/on` command too: `/devices/#` delivers them to the bridge, which skips them.
+`cold start` replays dataset to a new bridge, so every discovery payload is built and serialized (see `--json`).
+`bridge[...]` rounds are pipelined, ns/op is inverse of throughput. `state latency` delivers every state in its own loop
+callback, like a message read from socket, and waits for its publish to Home Assistant, ns/op is latency of one state.
+Benchmarks run on every event loop of `--loop`, comma separated, to compare stdlib asyncio loop with uvloop.
+
+Usage:
+    python benchmarks/replay.py [-r ROUNDS] [-d DATASET] [--commands] [--json json|orjson] [--loop asyncio,uvloop]
+"""
+import asyncio
+import logging
+import optparse
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.harness import BenchResult, bench, load_messages, run_benchmarks
+from benchmarks.micro import dispatch, drain, new_bridge, replay
+from wb_to_ha import event_loop, json_backend
+
+SCHEMES = {
+    '3 filters': (False, ['/devices/+/meta/+', '/devices/+/controls/+/meta/+', '/devices/+/controls/+']),
+    '/devices/#': (True, ['/devices/#']),
+}
+
+def topic_matches(topic_filter: list[str], topic: list[str]) -> bool:
+    """MQTT topic filter matching over split levels."""
+    for i, level in enumerate(topic_filter):
+        if level == '#':
+            return True
+        if i >= len(topic) or (level != '+' and level != topic[i]):
+            return False
+    return len(topic_filter) == len(topic)
+
+async def benchmarks(rounds: int, dataset: str, with_commands: bool) -> list[BenchResult]:
+    messages = load_messages(dataset)
+    if with_commands:
+        # Commands sent by Home Assistant are published to the same tree, broker matches them against filters too
+        messages += [(f'{topic}/on', payload) for topic, payload in messages if topic.count('/') == 4 and '/controls/' in topic]
+    split_topics = [topic.split('/') for topic, _ in messages]
+
+    results: list[BenchResult] = []
+    for name, (single_subscription, filters) in SCHEMES.items():
+        split_filters = [f.split('/') for f in filters]
+
+        def broker(i: int):
+            topic = split_topics[i % len(split_topics)]
+            for f in split_filters:
+                if topic_matches(f, topic):
+                    return
+        results.append(await bench(f'broker[{name}] filters={len(filters)}', broker, len(messages) * rounds))
+
+        delivered = [m for m, topic in zip(messages, split_topics) if any(topic_matches(f, topic) for f in split_filters)]
+        bridge = new_bridge(single_subscription)
+        # First replay fills registry and publishes configs, measured rounds are state updates of known controls
+        await replay(bridge, delivered)
+
+        def replay_round(i: int):
+            topic, payload = delivered[i % len(delivered)]
+            dispatch(bridge.wb_router, topic, payload)
+            if i % len(delivered) == len(delivered) - 1:
+                return drain()
+        results.append(await bench(f'bridge[{name}] delivered={len(delivered)}/{len(messages)}', replay_round, len(delivered) * rounds))
+        await drain()
+
+    # Every state arrives in its own loop callback and is awaited until the bridge publishes it to Home Assistant
+    states = [(topic, payload) for topic, payload in messages if topic.count('/') == 4 and '/controls/' in topic]
+    latency_bridge = new_bridge(single_subscription=True)
+    await replay(latency_bridge, messages)
+    loop = asyncio.get_running_loop()
+    published: list[asyncio.Future] = []
+
+    def on_publish(topic: str, payload: str):
+        if published and not published[0].done():
+            published[0].set_result(None)
+    latency_bridge.ha_client.add_publish_listener(on_publish)
+
+    async def latency(i: int):
+        topic, payload = states[i % len(states)]
+        published[:] = [loop.create_future()]
+        loop.call_soon(dispatch, latency_bridge.wb_router, topic, payload)
+        await published[0]
+    results.append(await bench(f'bridge state latency states={len(states)}', latency, len(states) * rounds))
+
+    async def cold_start(i: int):
+        await replay(new_bridge(), messages)
+    results.append(await bench(f'bridge cold start json={json_backend.backend()} messages={len(messages)}', cold_start, rounds))
+
+    return results
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.ERROR)
+    parser = optparse.OptionParser()
+    parser.add_option("-r", "--rounds", type=int, default=50, dest="rounds", help="Number of replays of dataset per benchmark")
+    parser.add_option("-d", "--dataset", default="complex", dest="dataset", help="Name of testdata directory with wb.input.txt")
+    parser.add_option("--commands", action="store_true", default=False, dest="commands", help="Add /on command for every state topic")
+    parser.add_option("--json", default=json_backend.BACKEND_JSON, dest="json_backend", help="Serializer of discovery payloads: json or orjson")
+    parser.add_option("--loop", default=f"{event_loop.LOOP_ASYNCIO},{event_loop.LOOP_UVLOOP}", dest="loops",
+                      help="Comma separated event loops to run benchmarks on: asyncio, uvloop")
+    opts, args = parser.parse_args()
+    json_backend.set_backend(opts.json_backend)
+    run_benchmarks(lambda: benchmarks(opts.rounds, opts.dataset, opts.commands), opts.loops.split(','))
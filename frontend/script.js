@@ -2,21 +2,112 @@ document.addEventListener('DOMContentLoaded', () => {
     const copyButton = document.getElementById('copyButton');
     const yamlContent = document.getElementById('yamlContent');
 
-    // Initial fetch of YAML content
-    fetch('/api/wb_to_ha.yaml')
-        .then(response => {
-            if (!response.ok) {
-                throw new Error(`HTTP error! status: ${response.status}`);
+    // Document view is split into text nodes: one per component header and one per entity block,
+    // so patches from the server replace only changed entities instead of re-rendering whole document.
+    const components = new Map(); // component -> {header: Text, entities: [{topic, unique_id, node: Text}]}
+    const topics = new Map(); // topic -> component
+    const rootNode = document.createTextNode('');
+
+    function resetView() {
+        components.clear();
+        topics.clear();
+        yamlContent.textContent = '';
+        yamlContent.appendChild(rootNode);
+    }
+
+    function updateRoot() {
+        // Same as yaml.dump output for empty mapping
+        rootNode.data = components.size === 0 ? 'mqtt: {}\n' : 'mqtt:\n';
+    }
+
+    function removeEntity(topic) {
+        const componentName = topics.get(topic);
+        if (componentName === undefined) {
+            return;
+        }
+        const component = components.get(componentName);
+        const i = component.entities.findIndex(e => e.topic === topic);
+        component.entities[i].node.remove();
+        component.entities.splice(i, 1);
+        topics.delete(topic);
+        if (component.entities.length === 0) {
+            component.header.remove();
+            components.delete(componentName);
+        }
+    }
+
+    function upsertEntity(change) {
+        removeEntity(change.topic);
+        let component = components.get(change.component);
+        if (component === undefined) {
+            // Components are sorted by name, same as on server
+            const header = document.createTextNode(`  ${change.component}:\n`);
+            const next = [...components.keys()].sort().find(name => name > change.component);
+            yamlContent.insertBefore(header, next === undefined ? null : components.get(next).header);
+            component = {header: header, entities: []};
+            components.set(change.component, component);
+        }
+        // Entities are sorted by unique_id, new entity goes after entities with equal unique_id
+        let i = component.entities.findIndex(e => e.unique_id > change.unique_id);
+        if (i === -1) {
+            i = component.entities.length;
+        }
+        let before = null;
+        if (i < component.entities.length) {
+            before = component.entities[i].node;
+        } else {
+            const next = [...components.keys()].sort().find(name => name > change.component);
+            before = next === undefined ? null : components.get(next).header;
+        }
+        const node = document.createTextNode(change.yaml);
+        yamlContent.insertBefore(node, before);
+        component.entities.splice(i, 0, {topic: change.topic, unique_id: change.unique_id, node: node});
+        topics.set(change.topic, change.component);
+    }
+
+    function applyChanges(entities) {
+        for (const change of entities) {
+            if (change.yaml === null) {
+                removeEntity(change.topic);
+            } else {
+                upsertEntity(change);
             }
-            return response.text();
-        })
-        .then(text => {
-            yamlContent.textContent = text;
-        })
-        .catch(error => {
-            console.error('Error fetching YAML:', error);
-            yamlContent.textContent = 'Error loading YAML content. Please try again later.';
+        }
+        updateRoot();
+    }
+
+    function fetchYaml() {
+        fetch('/api/wb_to_ha.yaml')
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error(`HTTP error! status: ${response.status}`);
+                }
+                return response.text();
+            })
+            .then(text => {
+                yamlContent.textContent = text;
+            })
+            .catch(error => {
+                console.error('Error fetching YAML:', error);
+                yamlContent.textContent = 'Error loading YAML content. Please try again later.';
+            });
+    }
+
+    if (window.EventSource) {
+        const events = new EventSource('/api/wb_to_ha/events');
+        events.addEventListener('snapshot', event => {
+            resetView();
+            applyChanges(JSON.parse(event.data).entities);
+        });
+        events.addEventListener('patch', event => {
+            applyChanges(JSON.parse(event.data).entities);
         });
+        events.onerror = error => {
+            console.error('Error in YAML events stream:', error);
+        };
+    } else {
+        fetchYaml();
+    }
 
     copyButton.addEventListener('click', async () => {
         try {
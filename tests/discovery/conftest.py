@@ -0,0 +1,92 @@
+import json
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import pytest
+
+from wb_to_ha.aggregation import AggregatingHomeAssistant
+from wb_to_ha.homeassistant import HomeAssistant, HomeAssistantDiscoveryCustomizer
+from wb_to_ha.mqtt.conn.inmem_mqtt import InmemMQTTClient
+from wb_to_ha.mqtt.mqtt_router import MQTTRouter
+from wb_to_ha.wirenboard import Wirenboard
+from wb_to_ha.wirenboard_registry import WirenBoardDeviceRegistry
+
+TESTDATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata')
+
+class Bridge:
+    """
+    Wirenboard + HomeAssistant wired the same way as App does, but with in-memory clients on both sides.
+
+    Keyword arguments are passed to HomeAssistant, `wb_options` to Wirenboard. Controls of `aggregated_controls`
+    go through AggregatingHomeAssistant. With `record`, messages published to both brokers are collected.
+    Must be created on running event loop.
+    """
+    ha_client: InmemMQTTClient
+    wb_client: InmemMQTTClient
+    ha_router: MQTTRouter
+    wb_router: MQTTRouter
+    registry: WirenBoardDeviceRegistry
+    ha: HomeAssistant
+    aggregation: AggregatingHomeAssistant | None
+    wb: Wirenboard
+    # Messages published to Home Assistant broker
+    published: list[tuple[str, str]]
+    # Messages published to Wiren Board broker, i.e. commands
+    commands: list[tuple[str, str]]
+
+    def __init__(self, customizer=None, aggregated_controls=[], wb_options={}, record=True, **ha_options):
+        self.published = []
+        self.commands = []
+        self.ha_client = InmemMQTTClient()
+        self.wb_client = InmemMQTTClient()
+        if record:
+            self.ha_client.add_publish_listener(lambda topic, payload: self.published.append((topic, payload)))
+            self.wb_client.add_publish_listener(lambda topic, payload: self.commands.append((topic, payload)))
+        self.ha_router = MQTTRouter(self.ha_client, 'homeassistant')
+        self.wb_router = MQTTRouter(self.wb_client, 'wirenboard')
+        self.registry = WirenBoardDeviceRegistry()
+        self.ha = HomeAssistant(
+            self.ha_router, self.registry, customizer or HomeAssistantDiscoveryCustomizer(),
+            **{'config_first_publish_delay': 0, **ha_options},
+        )
+        self.aggregation = AggregatingHomeAssistant(self.ha, aggregated_controls) if aggregated_controls else None
+        self.wb = Wirenboard(self.wb_router, self.registry, self.aggregation or self.ha, metrics=self.ha.metrics, **wb_options)
+        self.ha.on_control_set_state = self.wb.on_control_set_state
+        self.wb.on_connect()
+        self.ha.on_connect()
+
+    def send(self, topic, payload):
+        """Message from Wiren Board broker."""
+        self.wb_router._on_message(None, topic, payload.encode('utf-8'), 0, {})
+
+    def command(self, topic, payload):
+        """Message from Home Assistant broker."""
+        self.ha_router._on_message(None, topic, payload.encode('utf-8'), 0, {})
+
+    def send_testdata(self, name: str):
+        """Sends recorded Wiren Board traffic of testdata directory."""
+        with open(os.path.join(TESTDATA_DIR, name, 'wb.input.txt')) as f:
+            for line in f:
+                msg = json.loads(line)
+                self.send(msg['topic'], msg['payload'])
+
+    def states(self, topic: str) -> list[str]:
+        return [payload for t, payload in self.published if t == topic]
+
+    def availability(self) -> list[tuple[str, str]]:
+        return [(topic, payload) for topic, payload in self.published if topic.endswith('/availability')]
+
+    def config_topics(self) -> list[str]:
+        return [topic for topic, _ in self.published if topic.endswith('/config')]
+
+    def configs(self) -> dict[str, dict]:
+        return {topic: json.loads(payload) for topic, payload in self.published if topic.endswith('/config') and payload}
+
+    def retained(self, prefix: str) -> dict[str, str]:
+        # empty payload removes retained message
+        return {topic: payload for topic, payload in self.ha_client.last_messages.items() if topic.startswith(prefix) and payload}
+
+@pytest.fixture
+def make_bridge():
+    return Bridge
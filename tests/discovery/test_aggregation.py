@@ -0,0 +1,75 @@
+import asyncio
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+WINDOW = 0.05
+
+def states(bridge, prefix: str) -> list[tuple[str, str]]:
+    return [(topic, payload) for topic, payload in bridge.published if topic.startswith(prefix) and not topic.endswith('/availability')]
+
+def add_meter(bridge):
+    bridge.send('/devices/wb-map12h_1/meta/name', 'WB-MAP12H 1')
+    for control_id in ('Ch 1 Total P', 'Urms L1'):
+        bridge.send(f'/devices/wb-map12h_1/controls/{control_id}/meta/type', 'power')
+        bridge.send(f'/devices/wb-map12h_1/controls/{control_id}', '0')
+
+def test_aggregation(make_bridge):
+    async def run():
+        bridge = make_bridge(aggregated_controls=[{'entity_id': 'wb_map12h_1_ch_1_total_p', 'window': WINDOW, 'extra_sensors': True}])
+        add_meter(bridge)
+        await asyncio.sleep(WINDOW * 2)
+        # Extra sensors are configured with the first window
+        configs = bridge.configs()
+        assert len(configs) == 2 + 3
+        mean = configs['homeassistant/sensor/wb_map12h_1/ch_1_total_p_mean/config']
+        assert mean['unique_id'] == 'wb_map12h_1_ch_1_total_p_mean'
+        assert mean['state_topic'] == '/devices/wb-map12h_1/controls/Ch 1 Total P/mean'
+        derived_configs = bridge.ha._derived_configs['homeassistant/sensor/wb_map12h_1/ch_1_total_p/config']
+        bridge.published.clear()
+
+        for state in ('100', '250.5', '50', '120'):
+            bridge.send('/devices/wb-map12h_1/controls/Ch 1 Total P', state)
+            bridge.send('/devices/wb-map12h_1/controls/Urms L1', state)
+        await asyncio.sleep(0.01)
+        # Not aggregated control is published as usual
+        assert states(bridge, '/devices/wb-map12h_1/controls/Urms L1') == [('/devices/wb-map12h_1/controls/Urms L1', '120')]
+        assert states(bridge, '/devices/wb-map12h_1/controls/Ch 1 Total P') == []
+
+        await asyncio.sleep(WINDOW * 2)
+        assert sorted(states(bridge, '/devices/wb-map12h_1/controls/Ch 1 Total P')) == [
+            ('/devices/wb-map12h_1/controls/Ch 1 Total P', '120'),
+            ('/devices/wb-map12h_1/controls/Ch 1 Total P/max', '250.5'),
+            ('/devices/wb-map12h_1/controls/Ch 1 Total P/mean', '130.125'),
+            ('/devices/wb-map12h_1/controls/Ch 1 Total P/min', '50'),
+        ]
+        assert bridge.ha.metrics.get('aggregated_states') == 3
+        # Configs of extra sensors are not published again and not built again
+        assert bridge.config_topics() == []
+        assert bridge.ha._derived_configs['homeassistant/sensor/wb_map12h_1/ch_1_total_p/config'] is derived_configs
+    asyncio.run(run())
+
+def test_aggregated_state_bypasses_ratelimit(make_bridge):
+    async def run():
+        bridge = make_bridge(aggregated_controls=[{'entity_id': 'wb_map12h_1_ch_1_total_p', 'window': WINDOW}])
+        bridge.ha._ratelimit_intervals['Ch 1 Total P'] = 60
+        add_meter(bridge)
+        await asyncio.sleep(WINDOW * 2)
+        bridge.published.clear()
+        bridge.send('/devices/wb-map12h_1/controls/Ch 1 Total P', '100')
+        await asyncio.sleep(WINDOW * 2)
+        # Window already limits rate of states, the last state of window is not dropped
+        assert states(bridge, '/devices/wb-map12h_1/controls/Ch 1 Total P') == [('/devices/wb-map12h_1/controls/Ch 1 Total P', '100')]
+    asyncio.run(run())
+
+def test_stop_cancels_windows(make_bridge):
+    async def run():
+        bridge = make_bridge(aggregated_controls=[{'entity_id': 'wb_map12h_1_ch_1_total_p', 'window': WINDOW}])
+        add_meter(bridge)
+        # Configs are published with the first state, window is still open
+        await asyncio.sleep(WINDOW / 5)
+        bridge.published.clear()
+        bridge.aggregation.stop()
+        await asyncio.sleep(WINDOW * 2)
+        assert states(bridge, '/devices/wb-map12h_1/controls/Ch 1 Total P') == []
+    asyncio.run(run())
@@ -0,0 +1,84 @@
+import asyncio
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from wb_to_ha.homeassistant import AVAILABILITY_MODE_CONTROL, AVAILABILITY_MODE_DEVICE, HomeAssistantDiscoveryCustomizer
+
+DEBOUNCE = 0.05
+
+def add_module(bridge, device_id: str):
+    bridge.send(f'/devices/{device_id}/meta/name', device_id)
+    for control_id in ('K1', 'K2', 'K3'):
+        bridge.send(f'/devices/{device_id}/controls/{control_id}/meta/type', 'switch')
+        bridge.send(f'/devices/{device_id}/controls/{control_id}/meta/error', '')
+        bridge.send(f'/devices/{device_id}/controls/{control_id}', '0')
+
+def set_errors(bridge, device_id: str, error: str):
+    for control_id in ('K1', 'K2', 'K3'):
+        bridge.send(f'/devices/{device_id}/controls/{control_id}/meta/error', error)
+
+def test_device_availability(make_bridge):
+    async def run():
+        bridge = make_bridge(
+            customizer=HomeAssistantDiscoveryCustomizer(splitted_device_ids=['wb_mr6c_2']),
+            availability_mode=AVAILABILITY_MODE_DEVICE,
+            availability_debounce=DEBOUNCE,
+        )
+        add_module(bridge, 'wb-mr6c_1')
+        await asyncio.sleep(0.01)
+        assert {c['availability_topic'] for c in bridge.configs().values()} == {'wb_to_ha/wb_mr6c_1/availability'}
+        assert bridge.availability() == [('wb_to_ha/wb_mr6c_1/availability', '1')]
+
+        # Module drops off the bus: one message for the whole device after debounce interval
+        bridge.published.clear()
+        set_errors(bridge, 'wb-mr6c_1', 'r')
+        await asyncio.sleep(0.01)
+        assert bridge.availability() == []
+        await asyncio.sleep(DEBOUNCE * 2)
+        assert bridge.availability() == [('wb_to_ha/wb_mr6c_1/availability', '0')]
+
+        # Device is available while at least one control works
+        bridge.published.clear()
+        bridge.send('/devices/wb-mr6c_1/controls/K2/meta/error', '')
+        await asyncio.sleep(DEBOUNCE * 2)
+        assert bridge.availability() == [('wb_to_ha/wb_mr6c_1/availability', '1')]
+
+        # Flapping errors are not published
+        bridge.published.clear()
+        set_errors(bridge, 'wb-mr6c_1', 'r')
+        set_errors(bridge, 'wb-mr6c_1', '')
+        await asyncio.sleep(DEBOUNCE * 2)
+        assert bridge.availability() == []
+    asyncio.run(run())
+
+def test_splitted_device_availability(make_bridge):
+    async def run():
+        bridge = make_bridge(
+            customizer=HomeAssistantDiscoveryCustomizer(splitted_device_ids=['wb_mr6c_2']),
+            availability_mode=AVAILABILITY_MODE_DEVICE,
+            availability_debounce=DEBOUNCE,
+        )
+        add_module(bridge, 'wb-mr6c_2')
+        await asyncio.sleep(0.01)
+        assert sorted(bridge.availability()) == [
+            ('wb_to_ha/wb_mr6c_2_k1/availability', '1'),
+            ('wb_to_ha/wb_mr6c_2_k2/availability', '1'),
+            ('wb_to_ha/wb_mr6c_2_k3/availability', '1'),
+        ]
+    asyncio.run(run())
+
+def test_control_availability(make_bridge):
+    async def run():
+        bridge = make_bridge(
+            customizer=HomeAssistantDiscoveryCustomizer(splitted_device_ids=['wb_mr6c_2']),
+            availability_mode=AVAILABILITY_MODE_CONTROL,
+            availability_debounce=DEBOUNCE,
+        )
+        add_module(bridge, 'wb-mr6c_1')
+        await asyncio.sleep(0.01)
+        bridge.published.clear()
+        set_errors(bridge, 'wb-mr6c_1', 'r')
+        await asyncio.sleep(0.01)
+        assert bridge.availability() == [(f'/devices/wb-mr6c_1/controls/{c}/availability', '0') for c in ('K1', 'K2', 'K3')]
+    asyncio.run(run())
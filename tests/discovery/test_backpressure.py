@@ -0,0 +1,90 @@
+import asyncio
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from wb_to_ha.metrics import Metrics
+from wb_to_ha.mqtt.conn.inmem_mqtt import InmemMQTTClient
+from wb_to_ha.mqtt.inflight import InflightStorage
+from wb_to_ha.mqtt.mqtt_router import MQTTRouter
+
+def test_inflight_window():
+    published = []
+    client = InmemMQTTClient()
+    client.add_publish_listener(lambda topic, payload: published.append((topic, payload)))
+    inflight = InflightStorage()
+    metrics = Metrics()
+    router = MQTTRouter(client, 'homeassistant', inflight, inflight_window=2, queue_size=3, metrics=metrics)
+
+    router.publish('homeassistant/switch/wb_mr6c_1/k1/config', '{}', qos=1)
+    router.publish('/devices/wb-mr6c_1/controls/K1', '0', qos=1)
+    # QoS 0 is not acknowledged, so it is not limited
+    router.publish('/devices/wb-mr6c_1/controls/K2', '0', qos=0)
+    assert len(published) == 3
+
+    router.publish('/devices/wb-mr6c_1/controls/K1', '1', qos=1)
+    router.publish('/devices/wb-mr6c_1/controls/K3', '1', qos=1)
+    router.publish('/devices/wb-mr6c_1/controls/K1', '0', qos=1)
+    router.publish('wb_to_ha/wb_mr6c_1/availability', 'online', qos=1)
+    # Queue is full, states are dropped, configs are queued anyway
+    router.publish('/devices/wb-mr6c_1/controls/K4', '1', qos=1)
+    router.publish('homeassistant/switch/wb_mr6c_1/k4/config', '{}', qos=1)
+    assert len(published) == 3
+    assert metrics.gauge('homeassistant_publish_queue_depth') == 4
+    assert metrics.get('homeassistant_publish_coalesced') == 1
+    assert metrics.get('homeassistant_publish_dropped') == 1
+
+    async def ack(mid):
+        await inflight.push_message(mid, b'')
+        await inflight.remove_message_by_mid(mid)
+        # not stored message does not release slot
+        await inflight.remove_message_by_mid(mid)
+    asyncio.run(ack(1))
+    assert published[3:] == [('/devices/wb-mr6c_1/controls/K1', '0')]
+    asyncio.run(ack(2))
+    asyncio.run(ack(3))
+    assert published[4:] == [
+        ('/devices/wb-mr6c_1/controls/K3', '1'),
+        ('wb_to_ha/wb_mr6c_1/availability', 'online'),
+    ]
+    assert metrics.gauge('homeassistant_publish_queue_depth') == 1
+    assert metrics.gauge('homeassistant_inflight') == 2
+
+def test_no_inflight_window():
+    published = []
+    client = InmemMQTTClient()
+    client.add_publish_listener(lambda topic, payload: published.append((topic, payload)))
+    router = MQTTRouter(client, 'homeassistant', None, inflight_window=1)
+    for state in ('0', '1', '0'):
+        router.publish('/devices/wb-mr6c_1/controls/K1', state, qos=1)
+    assert len(published) == 3
+
+def test_qos0_supersedes_queued_message():
+    published = []
+    client = InmemMQTTClient()
+    client.add_publish_listener(lambda topic, payload: published.append((topic, payload)))
+    inflight = InflightStorage()
+    router = MQTTRouter(client, 'homeassistant', inflight, inflight_window=1)
+    router.publish('/devices/wb-mr6c_1/controls/K1', '0', qos=1)
+    router.publish('/devices/wb-mr6c_1/controls/K1', '1', qos=1)
+    assert router.queue_depth == 1
+    # e.g. QoS of states is downgraded, older queued state must not overwrite newer one
+    router.publish('/devices/wb-mr6c_1/controls/K1', '0', qos=0)
+    assert router.queue_depth == 0
+    assert published == [('/devices/wb-mr6c_1/controls/K1', '0'), ('/devices/wb-mr6c_1/controls/K1', '0')]
+
+def test_inflight_recount_on_connect():
+    published = []
+    client = InmemMQTTClient()
+    client.add_publish_listener(lambda topic, payload: published.append((topic, payload)))
+    inflight = InflightStorage()
+    router = MQTTRouter(client, 'homeassistant', inflight, inflight_window=2)
+    for control_id in ('K1', 'K2', 'K3', 'K4'):
+        router.publish(f'/devices/wb-mr6c_1/controls/{control_id}', '1', qos=1)
+    assert router.queue_depth == 2
+
+    # Acknowledgements are lost with connection, one message is still kept by the storage for resend
+    asyncio.run(inflight.push_message(1, b''))
+    router.recount_inflight()
+    assert published[2:] == [('/devices/wb-mr6c_1/controls/K3', '1')]
+    assert router.queue_depth == 1
@@ -0,0 +1,130 @@
+import asyncio
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+WINDOW = 0.05
+
+def add_dimmer(bridge):
+    bridge.send('/devices/wb-mdm3_1/meta/name', 'WB-MDM3 1')
+    bridge.send('/devices/wb-mdm3_1/controls/K1/meta/type', 'switch')
+    bridge.send('/devices/wb-mdm3_1/controls/Channel 1/meta/type', 'range')
+    bridge.send('/devices/wb-mdm3_1/controls/Channel 1/meta/max', '100')
+
+def test_range_commands_coalesced(make_bridge):
+    async def run():
+        bridge = make_bridge(wb_options={'command_coalesce_window': WINDOW})
+        add_dimmer(bridge)
+        for value in ('10', '20', '30', '40'):
+            bridge.command('/devices/wb-mdm3_1/controls/Channel 1/on', value)
+        # Switch commands are never coalesced
+        for value in ('1', '0', '1'):
+            bridge.command('/devices/wb-mdm3_1/controls/K1/on', value)
+        assert bridge.commands == [
+            ('/devices/wb-mdm3_1/controls/Channel 1/on', '10'),
+            ('/devices/wb-mdm3_1/controls/K1/on', '1'),
+            ('/devices/wb-mdm3_1/controls/K1/on', '0'),
+            ('/devices/wb-mdm3_1/controls/K1/on', '1'),
+        ]
+        bridge.commands.clear()
+
+        await asyncio.sleep(WINDOW * 1.5)
+        assert bridge.commands == [('/devices/wb-mdm3_1/controls/Channel 1/on', '40')]
+        await asyncio.sleep(WINDOW * 1.5)
+        # Window is closed, next command goes immediately
+        bridge.command('/devices/wb-mdm3_1/controls/Channel 1/on', '50')
+        assert bridge.commands[-1] == ('/devices/wb-mdm3_1/controls/Channel 1/on', '50')
+
+        metrics = bridge.ha.metrics
+        assert metrics.get('commands_sent') == 6
+        assert metrics.get('commands_coalesced') == 2
+        delay = metrics.summary('command_coalesce_delay')
+        assert delay.count == 6
+        assert delay.max >= WINDOW
+    asyncio.run(run())
+
+def test_stop_closes_command_windows(make_bridge):
+    async def run():
+        bridge = make_bridge(wb_options={'command_coalesce_window': WINDOW})
+        add_dimmer(bridge)
+        for value in ('10', '20'):
+            bridge.command('/devices/wb-mdm3_1/controls/Channel 1/on', value)
+        bridge.wb.stop()
+        await asyncio.sleep(WINDOW * 1.5)
+        # Pending command is dropped
+        assert bridge.commands == [('/devices/wb-mdm3_1/controls/Channel 1/on', '10')]
+        assert bridge.wb._command_windows == {}
+    asyncio.run(run())
+
+def test_no_coalescing(make_bridge):
+    async def run():
+        bridge = make_bridge()
+        add_dimmer(bridge)
+        for value in ('10', '20', '30'):
+            bridge.command('/devices/wb-mdm3_1/controls/Channel 1/on', value)
+        # Not registered controls are forwarded too
+        bridge.command('/devices/wb-mr6c_1/controls/K2/on', '1')
+        # Not a command topic
+        bridge.command('/devices/wb-mr6c_1/controls/K2/meta/on', '1')
+        assert bridge.commands == [
+            ('/devices/wb-mdm3_1/controls/Channel 1/on', '10'),
+            ('/devices/wb-mdm3_1/controls/Channel 1/on', '20'),
+            ('/devices/wb-mdm3_1/controls/Channel 1/on', '30'),
+            ('/devices/wb-mr6c_1/controls/K2/on', '1'),
+        ]
+        assert bridge.ha.metrics.get('commands_coalesced') == 0
+        # Topics of controls not in registry are not cached
+        assert list(bridge.wb._command_topics) == [('wb-mdm3_1', 'Channel 1')]
+    asyncio.run(run())
+
+def test_optimistic_switch_state(make_bridge):
+    async def run():
+        bridge = make_bridge(optimistic_switch_timeout=WINDOW)
+        add_dimmer(bridge)
+        bridge.send('/devices/wb-mdm3_1/controls/K1', '0')
+        bridge.send('/devices/wb-mdm3_1/controls/Channel 1', '0')
+        await asyncio.sleep(0.01)
+        bridge.published.clear()
+
+        # Echoed immediately and confirmed by Wiren Board
+        bridge.command('/devices/wb-mdm3_1/controls/K1/on', '1')
+        assert bridge.states('/devices/wb-mdm3_1/controls/K1') == ['1']
+        bridge.send('/devices/wb-mdm3_1/controls/K1', '1')
+        await asyncio.sleep(WINDOW * 1.5)
+        assert bridge.states('/devices/wb-mdm3_1/controls/K1') == ['1', '1']
+        bridge.published.clear()
+
+        # Not confirmed within timeout, last reported state is published back
+        bridge.command('/devices/wb-mdm3_1/controls/K1/on', '0')
+        await asyncio.sleep(WINDOW * 1.5)
+        assert bridge.states('/devices/wb-mdm3_1/controls/K1') == ['0', '1']
+
+        # Range controls are not echoed
+        bridge.command('/devices/wb-mdm3_1/controls/Channel 1/on', '50')
+        assert bridge.states('/devices/wb-mdm3_1/controls/Channel 1') == []
+
+        metrics = bridge.ha.metrics
+        assert metrics.get('optimistic_states') == 2
+        assert metrics.get('optimistic_confirmed') == 1
+        assert metrics.get('optimistic_rolled_back') == 1
+    asyncio.run(run())
+
+def test_optimistic_switch_state_mismatch_within_ratelimit(make_bridge):
+    async def run():
+        bridge = make_bridge(optimistic_switch_timeout=WINDOW)
+        add_dimmer(bridge)
+        bridge.ha._ratelimit_intervals['K1'] = 60
+        # Not reported yet, echoed state could not be rolled back
+        bridge.command('/devices/wb-mdm3_1/controls/K1/on', '1')
+        assert bridge.states('/devices/wb-mdm3_1/controls/K1') == []
+        bridge.send('/devices/wb-mdm3_1/controls/K1', '0')
+        await asyncio.sleep(0.01)
+        bridge.published.clear()
+
+        # Reported state differs from echoed one, it is published regardless of ratelimit
+        bridge.command('/devices/wb-mdm3_1/controls/K1/on', '1')
+        bridge.send('/devices/wb-mdm3_1/controls/K1', '0')
+        await asyncio.sleep(0.01)
+        assert bridge.states('/devices/wb-mdm3_1/controls/K1') == ['1', '0']
+        assert bridge.ha.metrics.get('optimistic_rolled_back') == 1
+    asyncio.run(run())
@@ -0,0 +1,68 @@
+import json
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import pytest
+
+from voluptuous import MultipleInvalid
+
+from wb_to_ha.config import config_schema_builder, load_config
+from wb_to_ha.homeassistant import build_customizer
+
+OPTIONS = {
+    "homeassistant": {'broker_host': 'localhost'},
+    "wirenboard": {'broker_host': 'localhost', 'device_id_prefix': 'wb1_'},
+    "homeassistant.splitted_device_ids": ['wb_gpio'],
+}
+
+def test_load_config(tmp_path):
+    json_file = tmp_path / 'options.json'
+    json_file.write_text(json.dumps(OPTIONS))
+    yaml_file = tmp_path / 'options.yaml'
+    yaml_file.write_text("homeassistant:\n  broker_host: localhost\nwirenboard:\n  broker_host: localhost\n  device_id_prefix: wb1_\n")
+    cfg = load_config(str(json_file), {})
+    assert cfg is not None
+    assert load_config(str(yaml_file), {})["wirenboard"] == cfg["wirenboard"]
+
+    # YAML addon keeps only configs by default
+    assert cfg["general.yaml_retention"] == {'config': None, 'availability': 0, 'state': 0}
+    assert config_schema_builder({})({**OPTIONS, "general.yaml_retention": {'state': 100}})["general.yaml_retention"] == \
+        {'config': None, 'availability': 0, 'state': 100}
+
+    customizer = build_customizer(cfg)
+    assert customizer.is_splitted_device('wb_gpio')
+    # Default combined device of Wiren Board is built for the prefix of broker
+    assert customizer.get_combined_device_id('wb1_power_status').new_device_id == 'wb1_wirenboard'
+
+@pytest.mark.parametrize('name, content', [
+    ('options.json', '{"homeassistant": '),
+    ('options.yaml', 'homeassistant: [broker_host'),
+    ('options.json', '{}'),
+    ('options.json', '{"wirenboard": {}}'),
+    ('options.toml', '[homeassistant]'),
+])
+def test_load_invalid_config(tmp_path, name, content):
+    config_file = tmp_path / name
+    config_file.write_text(content)
+    assert load_config(str(config_file), {}) is None
+    assert load_config(str(tmp_path / 'missing.json'), {}) is None
+
+@pytest.mark.parametrize('failover', [
+    {'heartbeat_interval': 1},
+    {'lease_ttl': 2, 'heartbeat_interval': 2},
+    {'lease_ttl': 0, 'heartbeat_interval': -1},
+])
+def test_invalid_failover_config(failover):
+    with pytest.raises(MultipleInvalid):
+        config_schema_builder({})({**OPTIONS, 'failover': failover})
+
+@pytest.mark.parametrize('options', [
+    {'failover': {'enabled': True}},
+    {'general.diagnostics_port': 8080},
+    {'homeassistant': {'broker_host': 'localhost', 'inflight_window': 10}},
+])
+def test_invalid_workers_config(options):
+    config_schema_builder({})({**OPTIONS, **options})
+    with pytest.raises(MultipleInvalid):
+        config_schema_builder({})({**OPTIONS, **options, 'general.workers': 2})
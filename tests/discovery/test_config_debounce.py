@@ -0,0 +1,63 @@
+import asyncio
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+DEBOUNCE = 0.05
+
+def add_module(bridge):
+    bridge.send('/devices/wb-map3e_1/meta/name', 'WB-MAP3E 1')
+    for control_id in ('Urms L1', 'Urms L2', 'Urms L3'):
+        bridge.send(f'/devices/wb-map3e_1/controls/{control_id}/meta/type', 'voltage')
+        bridge.send(f'/devices/wb-map3e_1/controls/{control_id}', '230')
+
+def restart_serial(bridge):
+    # wb-mqtt-serial republishes serial number and meta of every control
+    for _ in range(3):
+        bridge.send('/devices/wb-map3e_1/controls/Serial', '4271234')
+    bridge.send('/devices/wb-map3e_1/controls/Urms L1/meta/units', 'mV')
+    bridge.send('/devices/wb-map3e_1/controls/Urms L1/meta/readonly', '1')
+
+def test_config_debounce(make_bridge):
+    async def run():
+        bridge = make_bridge(config_debounce=DEBOUNCE)
+        add_module(bridge)
+        await asyncio.sleep(0.01)
+        assert len(bridge.config_topics()) == 3
+
+        bridge.published.clear()
+        restart_serial(bridge)
+        await asyncio.sleep(0.01)
+        assert bridge.config_topics() == []
+        await asyncio.sleep(DEBOUNCE * 2)
+        # Serial number is part of config of every control, so each config is published exactly once
+        assert sorted(bridge.config_topics()) == [
+            'homeassistant/sensor/wb_map3e_1/urms_l1/config',
+            'homeassistant/sensor/wb_map3e_1/urms_l2/config',
+            'homeassistant/sensor/wb_map3e_1/urms_l3/config',
+        ]
+        metrics = bridge.ha.metrics
+        assert metrics.get('config_requests') == 3 * 3 + 2
+        assert metrics.get('config_coalesced') == 3 * 3 + 2 - 3
+        assert metrics.get('config_published') == 3
+
+        # Same meta again: nothing has changed, nothing is published
+        bridge.published.clear()
+        restart_serial(bridge)
+        await asyncio.sleep(DEBOUNCE * 2)
+        assert bridge.config_topics() == []
+        assert metrics.get('config_unchanged') == 3
+    asyncio.run(run())
+
+def test_no_debounce(make_bridge):
+    async def run():
+        bridge = make_bridge(config_debounce=0)
+        add_module(bridge)
+        await asyncio.sleep(0.01)
+        bridge.published.clear()
+        restart_serial(bridge)
+        await asyncio.sleep(0.01)
+        # Config of Urms L1 is published for meta change and once more for serial number
+        assert len(bridge.config_topics()) == 3 + 1
+        assert bridge.ha.metrics.snapshot() == {}
+    asyncio.run(run())
@@ -0,0 +1,65 @@
+import asyncio
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import pytest
+
+from wb_to_ha.homeassistant import AVAILABILITY_MODE_CONTROL, AVAILABILITY_MODE_DEVICE, HomeAssistantDiscoveryCustomizer
+
+NEW_CUSTOMIZER = dict(
+    ignored_device_ids=['wb_mr3_16'],
+    splitted_device_ids=['wb_gpio'],
+    combined_devices=[{'device_id': 'knx', 'new_device_id': 'wirenboard', 'new_name': 'Wiren Board'}],
+)
+
+@pytest.mark.parametrize('availability_mode', [AVAILABILITY_MODE_CONTROL, AVAILABILITY_MODE_DEVICE])
+def test_reload_publishes_only_affected_configs(availability_mode, make_bridge):
+    async def run():
+        bridge = make_bridge(availability_mode=availability_mode)
+        bridge.send_testdata('complex')
+        await asyncio.sleep(0.01)
+        old_configs = bridge.retained('homeassistant/')
+
+        bridge.published.clear()
+        bridge.ha.set_customizer(HomeAssistantDiscoveryCustomizer(**NEW_CUSTOMIZER))
+        await asyncio.sleep(0.01)
+
+        # The same retained configs and availability as after start with new customization
+        expected = make_bridge(customizer=HomeAssistantDiscoveryCustomizer(**NEW_CUSTOMIZER), availability_mode=availability_mode)
+        expected.send_testdata('complex')
+        await asyncio.sleep(0.01)
+        new_configs = bridge.retained('homeassistant/')
+        assert new_configs == expected.retained('homeassistant/')
+        assert bridge.retained('wb_to_ha/') == expected.retained('wb_to_ha/')
+
+        published_configs = {topic: payload for topic, payload in bridge.published if topic.startswith('homeassistant/')}
+        changed = {topic: payload for topic, payload in new_configs.items() if old_configs.get(topic) != payload}
+        removed = {topic: '' for topic in old_configs.keys() - new_configs.keys()}
+        assert published_configs == changed | removed
+        assert changed and removed and len(changed) < len(old_configs)
+        metrics = bridge.ha.metrics
+        assert metrics.get('customizer_reloads') == 1
+        assert metrics.get('customizer_configs_published') == len(changed)
+        assert metrics.get('customizer_configs_removed') == len(removed)
+        # Entities of ignored device, and of devices moved out of and into combined device
+        assert {topic.split('/')[2] for topic in removed} == {'wb_mr3_16', 'wirenboard', 'knx'}
+    asyncio.run(run())
+
+def test_reload_skips_controls_waiting_for_first_publish(make_bridge):
+    async def run():
+        bridge = make_bridge(config_first_publish_delay=0.05)
+        for device_id in ('wb-mr6c_1', 'wb-mr6c_2'):
+            bridge.send(f'/devices/{device_id}/meta/name', device_id)
+            bridge.send(f'/devices/{device_id}/controls/K1/meta/type', 'switch')
+            bridge.send(f'/devices/{device_id}/controls/K1', '0')
+            await asyncio.sleep(0.1 if device_id == 'wb-mr6c_1' else 0)
+        assert bridge.config_topics() == ['homeassistant/switch/wb_mr6c_1/k1/config']
+
+        # Control with the same id of another device is not published yet, there is nothing to remove
+        bridge.published.clear()
+        bridge.ha.set_customizer(HomeAssistantDiscoveryCustomizer(ignored_device_ids=['wb_mr6c_2']))
+        await asyncio.sleep(0.1)
+        assert bridge.config_topics() == []
+        assert bridge.ha.metrics.get('customizer_configs_removed') == 0
+    asyncio.run(run())
@@ -0,0 +1,58 @@
+import asyncio
+import json
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+import pytest
+
+from wb_to_ha.diagnostics import DiagnosticsService
+from wb_to_ha.mappers import WirenControlType
+from wb_to_ha.metrics import Metrics
+from wb_to_ha.wirenboard_registry import ControlHistory, WirenBoardDeviceRegistry
+
+def test_control_history_ring():
+    history = ControlHistory(3)
+    assert history.items() == []
+    history.append(1.0, 10.0)
+    history.append(2.0, None)
+    assert history.items() == [(1.0, 10.0), (2.0, None)]
+    for i in range(3, 6):
+        history.append(float(i), float(i * 10))
+    assert history.items() == [(3.0, 30.0), (4.0, 40.0), (5.0, 50.0)]
+    assert len(history) == 3 and history.count == 5
+    # 3 kept messages during 60 seconds
+    assert history.rate(63.0) == 3.0
+
+def test_diagnostics_handlers():
+    registry = WirenBoardDeviceRegistry(history_size=4)
+    for device_id in ('wb-msw-v3_21', 'wb-mr6c_1'):
+        registry.get_device(device_id).name = device_id
+    noisy = registry.get_device('wb-msw-v3_21').get_control('Temperature')
+    noisy.apply_type(WirenControlType.temperature)
+    for state in ('23.5', '23.6', '23.5', '23.5', '23.7'):
+        noisy.apply_state(state)
+    quiet = registry.get_device('wb-mr6c_1').get_control('K1')
+    quiet.apply_state('1')
+    metrics = Metrics()
+    metrics.inc('config_published', 2)
+    service = DiagnosticsService(registry, metrics)
+
+    def get(path: str, handler, match_info: dict = {}) -> object:
+        resp = asyncio.run(handler(make_mocked_request('GET', path, match_info=match_info)))
+        return json.loads(resp.text)
+
+    controls = get('/api/diagnostics/controls', service.controls)
+    assert [(c['device_id'], c['control_id'], c['messages']) for c in controls] == [('wb-msw-v3_21', 'Temperature', 5), ('wb-mr6c_1', 'K1', 1)]
+    assert len(get('/api/diagnostics/controls?limit=1', service.controls)) == 1
+
+    match_info = {'device_id': 'wb-msw-v3_21', 'control_id': 'Temperature'}
+    history = get('/api/diagnostics/controls/wb-msw-v3_21/Temperature', service.control_history, match_info)
+    assert [h['value'] for h in history['history']] == [23.6, 23.5, 23.5, 23.7]
+    assert history['value'] == 23.7
+
+    with pytest.raises(web.HTTPNotFound):
+        asyncio.run(service.control_history(make_mocked_request('GET', '/', match_info={'device_id': 'unknown', 'control_id': 'K1'})))
+    assert get('/api/diagnostics/metrics', service.metrics) == {'config_published': 2}
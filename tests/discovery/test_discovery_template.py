@@ -0,0 +1,65 @@
+import asyncio
+import json
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import pytest
+
+from wb_to_ha import json_backend
+from wb_to_ha.discovery_template import DiscoveryTemplate, sentinel
+from wb_to_ha.homeassistant import HomeAssistant, HomeAssistantDiscoveryCustomizer
+from wb_to_ha.mappers import WirenControlType
+from wb_to_ha.mqtt.conn.inmem_mqtt import InmemMQTTClient
+from wb_to_ha.mqtt.mqtt_router import MQTTRouter
+from wb_to_ha.wirenboard import Wirenboard
+from wb_to_ha.wirenboard_registry import WirenBoardDeviceRegistry
+
+TESTDATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata')
+
+def load_registry(dataset):
+    registry = WirenBoardDeviceRegistry()
+    ha = HomeAssistant(MQTTRouter(InmemMQTTClient(), 'homeassistant'), registry, HomeAssistantDiscoveryCustomizer(splitted_device_ids=['wb_gpio']))
+    wb_router = MQTTRouter(InmemMQTTClient(), 'wirenboard')
+    Wirenboard(wb_router, registry, ha).on_connect()
+    with open(os.path.join(TESTDATA_DIR, dataset, 'wb.input.txt')) as f:
+        for line in f:
+            msg = json.loads(line)
+            wb_router._on_message(None, msg['topic'], msg['payload'].encode('utf-8'), 0, {})
+    # Names with characters which are escaped in JSON
+    device = registry.get_device('wb-mr6c_"test"')
+    device.name = 'Реле "кухня" \\ 1'
+    device.get_control('K1 "свет"').apply_type(WirenControlType.switch)
+    return ha
+
+@pytest.mark.parametrize('backend', [json_backend.BACKEND_JSON, json_backend.BACKEND_ORJSON])
+@pytest.mark.parametrize('dataset', ['basic', 'complex'])
+def test_template_is_byte_identical(dataset, backend):
+    async def run():
+        ha = load_registry(dataset)
+        json_backend.set_backend(backend)
+        try:
+            rendered = 0
+            for device in ha._registry.devices().values():
+                for control in device.controls.values():
+                    expected = ha._build_control_config(device, control)
+                    actual = ha._render_control_config(device, control)
+                    if expected is None:
+                        assert actual is None
+                        continue
+                    assert actual == (expected[0], json_backend.dumps(expected[1]))
+                    rendered += 1
+            assert rendered > 10
+        finally:
+            json_backend.set_backend(json_backend.BACKEND_JSON)
+    asyncio.run(run())
+
+def test_template_fields():
+    template = DiscoveryTemplate(
+        {'device': sentinel('device'), 'name': sentinel('name'), 'command_topic': sentinel('topic') + '/on', 'retain': True},
+        ['name', 'topic'],
+        ['device'],
+    )
+    values = {'device': '{"name": "WB"}', 'name': 'Реле "1"', 'topic': '/devices/wb-mr6c_1/controls/K1'}
+    payload = {'device': {'name': 'WB'}, 'name': 'Реле "1"', 'command_topic': '/devices/wb-mr6c_1/controls/K1/on', 'retain': True}
+    assert template.render(values) == json.dumps(payload)
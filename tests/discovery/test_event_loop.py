@@ -0,0 +1,70 @@
+import asyncio
+import importlib.util
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import pytest
+
+from wb_to_ha import event_loop
+from wb_to_ha.config import config_schema_builder
+from wb_to_ha.mqtt.conn.inmem_mqtt import InmemMQTTClient
+from wb_to_ha.mqtt.mqtt_router import MQTTRouter
+
+async def route_message():
+    received = []
+    router = MQTTRouter(InmemMQTTClient(), 'wirenboard')
+    router.subscribe('/devices/+/controls/+', lambda topic, payload: received.append((topic, payload)))
+    asyncio.get_running_loop().call_soon(router._on_message, None, '/devices/wb-mr6c_1/controls/K1', b'1', 0, {})
+    await asyncio.sleep(0)
+    return received
+
+def test_uvloop_falls_back_to_asyncio():
+    assert event_loop.loop_name() == event_loop.LOOP_ASYNCIO
+    event_loop.set_loop(event_loop.LOOP_UVLOOP)
+    try:
+        installed = importlib.util.find_spec('uvloop') is not None
+        assert event_loop.loop_name() == (event_loop.LOOP_UVLOOP if installed else event_loop.LOOP_ASYNCIO)
+        with asyncio.Runner(loop_factory=event_loop.new_event_loop) as runner:
+            assert runner.run(route_message()) == [('/devices/wb-mr6c_1/controls/K1', b'1')]
+            assert type(runner.get_loop()).__module__.startswith('uvloop' if installed else 'asyncio')
+    finally:
+        event_loop.set_loop(event_loop.LOOP_ASYNCIO)
+
+def test_without_uvloop(monkeypatch):
+    # uvloop is an optional requirement
+    monkeypatch.setitem(sys.modules, 'uvloop', None)
+    event_loop.set_loop(event_loop.LOOP_UVLOOP)
+    try:
+        assert event_loop.loop_name() == event_loop.LOOP_ASYNCIO
+        with asyncio.Runner(loop_factory=event_loop.new_event_loop) as runner:
+            assert runner.run(route_message()) == [('/devices/wb-mr6c_1/controls/K1', b'1')]
+    finally:
+        event_loop.set_loop(event_loop.LOOP_ASYNCIO)
+
+def load_entrypoint(name):
+    root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_').removesuffix('.py'), os.path.join(root_dir, name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+@pytest.mark.parametrize('name', ['wb-to-ha-discovery.py', 'wb-to-ha-yaml.py'])
+def test_mqtt_clients_resend_on_app_loop(name):
+    # gmqtt resends unacknowledged QoS 1/2 messages in a task created with the client
+    entrypoint = load_entrypoint(name)
+    cfg = config_schema_builder({})({
+        "homeassistant": {'broker_host': 'localhost', 'broker_port': 1883},
+        "wirenboard": {'broker_host': 'localhost', 'broker_port': 1883},
+    })
+    args = [cfg] if name == 'wb-to-ha-discovery.py' else [cfg, InmemMQTTClient()]
+    loop = event_loop.new_event_loop()
+    try:
+        app, _ = loop.run_until_complete(entrypoint.create_app(*args))
+        clients = [c for c in (app._ha_mqtt_client, app._wb_mqtt_client) if hasattr(c, '_resend_task')]
+        assert clients and all(client._resend_task.get_loop() is loop for client in clients)
+        for client in clients:
+            client._resend_task.cancel()
+        loop.run_until_complete(asyncio.sleep(0))
+    finally:
+        loop.close()
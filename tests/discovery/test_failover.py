@@ -0,0 +1,183 @@
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from wb_to_ha.app import App
+from wb_to_ha.homeassistant import HomeAssistantDiscoveryCustomizer
+from wb_to_ha.leader import LeaderLease
+from wb_to_ha.mqtt.conn.local_broker import LocalBroker, LocalBrokerClient
+from wb_to_ha.mqtt.mqtt_router import MQTTRouter
+
+LEASE_TTL = 0.3
+
+class Instance:
+    """App running in its own thread and event loop, like on separate host."""
+    app: App | None
+    ha_client: LocalBrokerClient
+    wb_client: LocalBrokerClient
+    lease: LeaderLease
+
+    def __init__(self, instance_id: str, ha_broker: LocalBroker, wb_broker: LocalBroker):
+        self.app = None
+        self.ha_client = ha_broker.client(f'ha-{instance_id}')
+        self.wb_client = wb_broker.client(f'wb-{instance_id}')
+        self.lease = LeaderLease(instance_id, ttl=LEASE_TTL, heartbeat_interval=0.05)
+        self._thread = threading.Thread(target=self._run)
+
+    def _run(self):
+        async def run():
+            self._loop = asyncio.get_running_loop()
+            self.app = App(
+                {'broker_host': 'ha', 'broker_port': 1883, 'config_first_publish_delay': 0},
+                {'broker_host': 'wb', 'broker_port': 1883},
+                self.ha_client, self.wb_client,
+                HomeAssistantDiscoveryCustomizer(),
+                leader_lease=self.lease,
+            )
+            await self.app.run()
+        asyncio.run(run())
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.app.stop(), self._loop)
+        self._thread.join(5)
+        assert not self._thread.is_alive()
+
+def wait_for(condition, timeout: float = 3) -> float:
+    started = time.monotonic()
+    while not condition():
+        assert time.monotonic() - started < timeout
+        time.sleep(0.01)
+    return time.monotonic() - started
+
+def config_topics(client: LocalBrokerClient) -> list[str]:
+    return [topic for topic, _ in client.published if topic.startswith('homeassistant/')]
+
+def test_failover():
+    ha_broker = LocalBroker()
+    wb_broker = LocalBroker()
+    wb_broker.publish('/devices/wb-mr6c_1/meta/name', 'WB-MR6C 1', retain=True)
+    wb_broker.publish('/devices/wb-mr6c_1/controls/K1/meta/type', 'switch', retain=True)
+    wb_broker.publish('/devices/wb-mr6c_1/controls/K1', '0', retain=True)
+
+    def leader() -> str | None:
+        lease = ha_broker.retained.get('wb_to_ha/leader')
+        return json.loads(lease)['instance'] if lease else None
+
+    a = Instance('a', ha_broker, wb_broker)
+    b = Instance('b', ha_broker, wb_broker)
+    a.start()
+    try:
+        wait_for(lambda: leader() == 'a' and ha_broker.retained.get('/devices/wb-mr6c_1/controls/K1') == '0')
+        # Second instance sees lease of leader and stays standby
+        b.start()
+        time.sleep(LEASE_TTL * 2)
+        assert leader() == 'a'
+        assert a.lease.is_leader and not b.lease.is_leader
+        assert 'homeassistant/switch/wb_mr6c_1/k1/config' in config_topics(a.ha_client)
+        assert config_topics(b.ha_client) == []
+
+        # Command from Home Assistant is forwarded to Wiren Board by leader only
+        ha_broker.publish('/devices/wb-mr6c_1/controls/K1/on', '1')
+        wait_for(lambda: ('/devices/wb-mr6c_1/controls/K1/on', '1') in a.wb_client.published)
+        time.sleep(0.1)
+        assert b.wb_client.published == []
+
+        # Host of leader dies, standby takes over and publishes state which leader missed
+        a.ha_client.crash()
+        a.wb_client.crash()
+        wb_broker.publish('/devices/wb-mr6c_1/controls/K1', '1', retain=True)
+        elapsed = wait_for(lambda: leader() == 'b' and ha_broker.retained.get('/devices/wb-mr6c_1/controls/K1') == '1')
+        assert elapsed < 1
+        # Configs were published by previous leader
+        assert config_topics(b.ha_client) == []
+    finally:
+        a.stop()
+        if b.app is not None:
+            b.stop()
+    # Lease renewal stops with app
+    assert a.app._lease_task.done() and b.app._lease_task.done()
+    # Stopped leader releases lease
+    assert json.loads(ha_broker.retained['wb_to_ha/leader']) == {'instance': 'b', 'ttl': 0}
+
+def test_lease_conflict():
+    async def run():
+        lease = LeaderLease('b')
+        lease._promote()
+        assert lease.is_leader
+        # Lease of instance with higher id is ignored, that instance steps down itself
+        lease._lease_topic_handler('wb_to_ha/leader', json.dumps({'instance': 'c', 'ttl': 1}).encode())
+        assert lease.is_leader
+        lease._lease_topic_handler('wb_to_ha/leader', json.dumps({'instance': 'a', 'ttl': 1}).encode())
+        assert not lease.is_leader
+    asyncio.run(run())
+
+class NotAcknowledged:
+    """Inflight storage of broker which never acknowledges messages."""
+    def __init__(self):
+        self.on_release = None
+
+    @property
+    def count(self) -> int:
+        return 0
+
+def test_lease_bypasses_publish_queue():
+    async def run():
+        broker = LocalBroker()
+        leader_client, standby_client = broker.client('ha-a'), broker.client('ha-b')
+        await leader_client.connect()
+        await standby_client.connect()
+        # Window of leader is taken by state, next states are queued or dropped
+        leader_router = MQTTRouter(leader_client, 'homeassistant', NotAcknowledged(), inflight_window=1, queue_size=1)
+        for i in range(3):
+            leader_router.publish(f'/devices/wb-mr6c_1/controls/K{i}', '1', qos=1)
+        leader = LeaderLease('a', ttl=LEASE_TTL, heartbeat_interval=0.05)
+        standby = LeaderLease('b', ttl=LEASE_TTL, heartbeat_interval=0.05)
+        leader.on_connect(leader_router)
+        standby.on_connect(MQTTRouter(standby_client, 'homeassistant'))
+        leader._promote()
+        tasks = [asyncio.create_task(leader.run()), asyncio.create_task(standby.run())]
+        await asyncio.sleep(LEASE_TTL * 3)
+        assert leader.is_leader and not standby.is_leader
+        assert leader_router.queue_depth == 1
+        leader.stop()
+        standby.stop()
+        await asyncio.gather(*tasks)
+    asyncio.run(run())
+
+def test_standby_takes_over_at_lease_expiration():
+    async def run():
+        broker = LocalBroker()
+        client = broker.client('ha-b')
+        await client.connect()
+        # Expiration is not rounded up to heartbeat interval
+        standby = LeaderLease('b', ttl=1, heartbeat_interval=0.4)
+        standby.on_connect(MQTTRouter(client, 'homeassistant'))
+        task = asyncio.create_task(standby.run())
+        broker.publish('wb_to_ha/leader', json.dumps({'instance': 'a', 'ttl': 1}), retain=True)
+        seen_at = time.monotonic()
+        while not standby.is_leader:
+            await asyncio.sleep(0.01)
+        assert time.monotonic() - seen_at < 1.1
+
+        # Lease released by stopped leader is taken without waiting for expiration
+        other = LeaderLease('c', ttl=1, heartbeat_interval=0.4)
+        other_client = broker.client('ha-c')
+        await other_client.connect()
+        other.on_connect(MQTTRouter(other_client, 'homeassistant'))
+        other_task = asyncio.create_task(other.run())
+        await asyncio.sleep(0.05)
+        standby.stop()
+        released_at = time.monotonic()
+        while not other.is_leader:
+            await asyncio.sleep(0.01)
+        assert time.monotonic() - released_at < 0.2
+        other.stop()
+        await asyncio.gather(task, other_task)
+    asyncio.run(run())
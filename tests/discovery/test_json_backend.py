@@ -0,0 +1,47 @@
+import importlib
+import json
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from wb_to_ha import json_backend
+
+PAYLOAD = {
+    'name': 'Температура',
+    'unique_id': 'wb_msw_v3_21_temperature',
+    'state_topic': '/devices/wb-msw-v3_21/controls/Temperature',
+    'device': {'identifiers': ['wb_msw_v3_21'], 'name': 'Wiren Board WB-MSW v.3 (21)'},
+    'unit_of_measurement': '°C',
+    'suggested_display_precision': 1,
+    'enabled_by_default': True,
+}
+
+def test_default_backend_is_byte_identical():
+    assert json_backend.backend() == json_backend.BACKEND_JSON
+    assert json_backend.dumps(PAYLOAD) == json.dumps(PAYLOAD)
+    assert json_backend.loads(json.dumps(PAYLOAD)) == PAYLOAD
+    assert json_backend.loads(json.dumps(PAYLOAD).encode('utf-8')) == PAYLOAD
+
+def test_orjson_backend():
+    json_backend.set_backend(json_backend.BACKEND_ORJSON)
+    try:
+        data = json_backend.dumps(PAYLOAD)
+        assert json.loads(data) == PAYLOAD
+        if json_backend.backend() == json_backend.BACKEND_ORJSON:
+            assert data == json.dumps(PAYLOAD, separators=(',', ':'), ensure_ascii=False)
+    finally:
+        json_backend.set_backend(json_backend.BACKEND_JSON)
+    assert json_backend.dumps(PAYLOAD) == json.dumps(PAYLOAD)
+
+def test_without_orjson(monkeypatch):
+    # orjson is an optional requirement
+    monkeypatch.setitem(sys.modules, 'orjson', None)
+    importlib.reload(json_backend)
+    try:
+        assert json_backend.loads is json.loads
+        json_backend.set_backend(json_backend.BACKEND_ORJSON)
+        assert json_backend.backend() == json_backend.BACKEND_JSON
+        assert json_backend.dumps(PAYLOAD) == json.dumps(PAYLOAD)
+    finally:
+        monkeypatch.undo()
+        importlib.reload(json_backend)
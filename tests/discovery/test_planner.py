@@ -0,0 +1,45 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from wb_to_ha import planner
+from wb_to_ha.homeassistant import AVAILABILITY_MODE_CONTROL, AVAILABILITY_MODE_DEVICE, HomeAssistantDiscoveryCustomizer
+
+CAPTURE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata', 'complex', 'wb.input.txt')
+
+def test_plan_customization_change():
+    registry = planner.load_registry(CAPTURE_FILE)
+    same = planner.plan(registry, HomeAssistantDiscoveryCustomizer(), HomeAssistantDiscoveryCustomizer())
+    assert not same
+    assert same.unchanged > 50
+
+    diff = planner.plan(registry, HomeAssistantDiscoveryCustomizer(), HomeAssistantDiscoveryCustomizer(
+        ignored_device_ids=['wb_mr3_16'],
+        splitted_device_ids=['wb_gpio'],
+    ))
+    assert diff.added == {}
+    assert {topic.split('/')[2] for topic in diff.removed} == {'wb_mr3_16'}
+    # wb_gpio leaves default combined device, every control becomes a device
+    assert diff.moved['homeassistant/binary_sensor/wirenboard/a1_in/config'] == 'homeassistant/binary_sensor/wb_gpio_a1_in/a1_in/config'
+    assert all(topic.split('/')[2] == 'wirenboard' for topic in diff.moved)
+    assert diff.unchanged == same.unchanged - len(diff.removed) - len(diff.moved)
+    lines = diff.format()
+    assert lines[0] == '- homeassistant/binary_sensor/wb_mr3_16/input_0/config'
+    assert lines[-1] == f'0 added, {len(diff.removed)} removed, {len(diff.moved)} moved, 0 changed, {diff.unchanged} unchanged'
+
+def test_plan_changed_fields():
+    registry = planner.load_registry(CAPTURE_FILE)
+    customizer = HomeAssistantDiscoveryCustomizer()
+    diff = planner.plan(registry, customizer, customizer, AVAILABILITY_MODE_CONTROL, AVAILABILITY_MODE_DEVICE)
+    assert diff.unchanged == 0 and not diff.added and not diff.removed and not diff.moved
+    assert {tuple(fields) for fields in diff.changed.values()} == {('availability_topic',)}
+    assert diff.format()[0].endswith('/config: availability_topic')
+
+def test_plan_aggregated_controls():
+    registry = planner.load_registry(CAPTURE_FILE)
+    customizer = HomeAssistantDiscoveryCustomizer()
+    aggregated = {'entity_id': 'wb_mr3_16_input_0_counter', 'window': 1}
+    diff = planner.plan(registry, customizer, customizer, old_aggregated_controls=[aggregated],
+                        new_aggregated_controls=[{**aggregated, 'extra_sensors': True}])
+    assert not diff.removed and not diff.changed and not diff.moved
+    assert sorted(topic.split('/')[3] for topic in diff.added) == ['input_0_counter_max', 'input_0_counter_mean', 'input_0_counter_min']
@@ -0,0 +1,62 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import pytest
+from voluptuous import MultipleInvalid
+
+from wb_to_ha.config import config_schema_builder
+from wb_to_ha.mappers import WirenControlType
+from wb_to_ha.metrics import Metrics
+from wb_to_ha.qos import QosPolicy
+from wb_to_ha.wirenboard_registry import WirenDevice
+
+def make_control(device: WirenDevice, control_id: str, control_type: WirenControlType):
+    control = device.get_control(control_id)
+    control.apply_type(control_type)
+    return control
+
+def test_qos_rules():
+    policy = QosPolicy(1, [
+        {'device': 'wb-map*', 'control_type': 'power', 'qos': 0},
+        {'device': 'wb-mr6c_*', 'qos': 2},
+        {'control_type': 'voltage', 'qos': 0},
+    ])
+    meter = WirenDevice('wb-map12h_1')
+    meter.name = 'WB-MAP12H 1'
+    relay = WirenDevice('wb-mr6c_1')
+    relay.name = 'WB-MR6C 1'
+    assert policy.state_qos(meter, make_control(meter, 'Ch 1 P', WirenControlType.power)) == 0
+    assert policy.state_qos(meter, make_control(meter, 'Urms L1', WirenControlType.voltage)) == 0
+    assert policy.state_qos(meter, make_control(meter, 'Ch 1 Total Energy', WirenControlType.power_consumption)) == 1
+    assert policy.state_qos(relay, make_control(relay, 'K1', WirenControlType.switch)) == 2
+    # Rules are matched again when type of control is changed
+    control = make_control(meter, 'Ch 2 P', WirenControlType.value)
+    assert policy.state_qos(meter, control) == 1
+    control.apply_type(WirenControlType.power)
+    assert policy.state_qos(meter, control) == 0
+
+def test_qos_downgrade():
+    depth = 0
+    metrics = Metrics()
+    policy = QosPolicy(1, [], downgrade_threshold=100, restore_threshold=20, load=lambda: depth, metrics=metrics)
+    device = WirenDevice('wb-map12h_1')
+    device.name = 'WB-MAP12H 1'
+    control = make_control(device, 'Ch 1 P', WirenControlType.power)
+
+    for depth, qos in [(50, 1), (100, 0), (50, 0), (20, 1), (50, 1), (150, 0)]:
+        assert policy.state_qos(device, control) == qos, depth
+    assert metrics.get('qos_downgrades') == 2
+    assert metrics.get('qos_restores') == 1
+    assert metrics.get('qos_downgraded_states') == 3
+    assert metrics.gauge('qos_downgraded') == 1
+
+@pytest.mark.parametrize('options', [
+    # Depth of publish queue is known only with inflight window
+    {'homeassistant': {'broker_host': 'localhost', 'qos_downgrade_threshold': 100}},
+    {'homeassistant': {'broker_host': 'localhost', 'qos_downgrade_threshold': 100, 'inflight_window': 10}, 'general.workers': 2},
+    {'homeassistant': {'broker_host': 'localhost'}, 'homeassistant.qos_rules': [{'control_type': 'powr', 'qos': 0}]},
+])
+def test_invalid_qos_config(options):
+    with pytest.raises(MultipleInvalid):
+        config_schema_builder({})({'wirenboard': {'broker_host': 'localhost'}, **options})
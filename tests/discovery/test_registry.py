@@ -0,0 +1,30 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from wb_to_ha.mappers import WirenControlType
+from wb_to_ha.wirenboard_registry import WirenControl
+
+def test_control_value():
+    control = WirenControl('wb-msw-v3_21', 'Temperature')
+    # State before type is kept raw until type is known
+    assert control.apply_state('23.5')
+    assert control.value is None
+    control.apply_type(WirenControlType.temperature)
+    assert control.value == 23.5
+
+    assert not control.apply_state('23.5')
+    assert control.apply_state('-1')
+    assert control.value == -1.0
+    assert control.apply_state('')
+    assert control.state == '' and control.value is None
+
+    text = WirenControl('system', 'Release name')
+    text.apply_type(WirenControlType.text)
+    text.apply_state('12')
+    assert text.state == '12' and text.value is None
+
+    switch = WirenControl('wb-mr6c_1', 'K1')
+    switch.apply_type(WirenControlType.switch)
+    switch.apply_state('1')
+    assert switch.value == 1.0
@@ -0,0 +1,82 @@
+import json
+import os
+import subprocess
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Modules of optional config formats and modes, not needed to start with JSON config in single process
+LAZY_MODULES = [
+    'yaml',
+    'aiohttp',
+    'multiprocessing',
+    'uvloop',
+    'wb_to_ha.diagnostics',
+    'wb_to_ha.sharding',
+    'wb_to_ha.mqtt.inflight',
+    'wb_to_ha.mqtt.conn.tester_mqtt',
+]
+
+# Import time of entrypoint's own modules (wb_to_ha, gmqtt, voluptuous) relative to import of stdlib modules it uses,
+# both measured by -X importtime in one process. It is about 0.4 on developer machine,
+# with eager imports of aiohttp, yaml and multiprocessing it was about 3.4
+STARTUP_BUDGET = 1.0
+
+# Stdlib modules imported by entrypoint, imported before it as the baseline
+BASELINE_MODULES = ['asyncio', 'logging', 'optparse', 'signal', 'uuid']
+ENTRYPOINT_MARKER = 'import time: entrypoint'
+
+# Loads entrypoint module without running `main` and reports loaded modules
+LOAD_ENTRYPOINT = f"""
+import importlib, importlib.util, json, sys
+sys.path.insert(0, sys.argv[1])
+for name in {BASELINE_MODULES!r}:
+    importlib.import_module(name)
+print({ENTRYPOINT_MARKER!r}, file=sys.stderr, flush=True)
+spec = importlib.util.spec_from_file_location('entrypoint', sys.argv[2])
+spec.loader.exec_module(importlib.util.module_from_spec(spec))
+print(json.dumps({{'modules': sorted(sys.modules)}}))
+"""
+
+def load_entrypoint(name):
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', LOAD_ENTRYPOINT, ROOT_DIR, os.path.join(ROOT_DIR, name)],
+        capture_output=True, text=True, check=True,
+    )
+    # -X importtime: "import time: self [us] | cumulative | imported package", nested imports are indented
+    baseline, entrypoint = 0, 0
+    profile = []
+    for line in result.stderr.splitlines():
+        if line == ENTRYPOINT_MARKER:
+            baseline, entrypoint = entrypoint, 0
+            profile = []
+            continue
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        if not module.startswith('  '):
+            entrypoint += int(cumulative)
+        profile.append((int(cumulative), module.strip()))
+    report = json.loads(result.stdout)
+    report['relative_import_time'] = entrypoint / baseline
+    return report, sorted(profile, reverse=True)
+
+def test_discovery_entrypoint_imports():
+    report, profile = load_entrypoint('wb-to-ha-discovery.py')
+    loaded = [m for m in LAZY_MODULES if m in report['modules']]
+    assert loaded == [], f"slowest imports: {profile[:10]}"
+
+def test_discovery_entrypoint_startup_budget():
+    # the best of several runs, the first one can be slowed down by cold disk cache
+    runs = [load_entrypoint('wb-to-ha-discovery.py') for _ in range(3)]
+    report, profile = min(runs, key=lambda run: run[0]['relative_import_time'])
+    assert report['relative_import_time'] < STARTUP_BUDGET, f"slowest imports: {profile[:10]}"
+
+def test_config_imports():
+    # config loading and validation do not need the bridge and MQTT client modules
+    result = subprocess.run(
+        [sys.executable, '-c', 'import json, sys; import wb_to_ha.config; print(json.dumps(sorted(sys.modules)))'],
+        cwd=ROOT_DIR, capture_output=True, text=True, check=True,
+    )
+    modules = json.loads(result.stdout)
+    assert [m for m in ['gmqtt', 'wb_to_ha.homeassistant'] if m in modules] == []
@@ -7,10 +7,12 @@ import pytest
 import logging
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 
+from wb_to_ha.mqtt.conn.inmem_mqtt import InmemMQTTClient
 from wb_to_ha.mqtt.conn.tester_mqtt import LocalMQTTClient
 from wb_to_ha.homeassistant import HomeAssistantDiscoveryCustomizer
 from wb_to_ha.app import App
 from wb_to_ha.config import config_schema_builder
+from wb_to_ha.sharding import ShardedApp
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -18,6 +20,29 @@ def get_test_dirs():
     test_dir = os.path.join(os.path.dirname(__file__), 'testdata')
     return [os.path.join(test_dir, d) for d in os.listdir(test_dir)]
 
+def compare_output_with_golden(output_file, golden_file):
+    with open(output_file) as out_f, open(golden_file) as gold_f:
+        output_content = out_f.readlines()
+        golden_content = gold_f.readlines()
+
+        printed_lines = 0
+        diff_lines = 0
+        if len(output_content) != len(golden_content):
+            print(f"Output len {output_file}: {len(output_content)}")
+            print(f"Golden len {golden_file}: {len(golden_content)}")
+        for i, (out_line, gold_line) in enumerate(zip_longest(output_content, golden_content, fillvalue='')):
+            if out_line != gold_line:
+                if printed_lines < 10:
+                    print(f"Line {i+1}:")
+                    print(f"Output: {out_line.rstrip()}")
+                    print(f"Golden: {gold_line.rstrip()}")
+                    printed_lines += 1
+                diff_lines += 1
+        if diff_lines > printed_lines:
+            print(f"and {diff_lines - printed_lines} more lines")
+        if diff_lines > 0:
+            pytest.fail(f"{output_file} does not match {golden_file} file, diff lines: {diff_lines}")
+
 @pytest.mark.parametrize('wb_input_dir', get_test_dirs())
 def test_wb_ha_discovery_matrix_files(wb_input_dir):
     wb_input_file = os.path.join(wb_input_dir, 'wb.input.txt')
@@ -75,29 +100,6 @@ def test_wb_ha_discovery_matrix_files(wb_input_dir):
     # Run the main test with this client
     asyncio.run(wb_ha_discovery_matrix_test(app))
 
-    def compare_output_with_golden(output_file, golden_file):
-        with open(output_file) as out_f, open(golden_file) as gold_f:
-            output_content = out_f.readlines()
-            golden_content = gold_f.readlines()
-
-            printed_lines = 0
-            diff_lines = 0
-            if len(output_content) != len(golden_content):
-                print(f"Output len {output_file}: {len(output_content)}")
-                print(f"Golden len {golden_file}: {len(golden_content)}")
-            for i, (out_line, gold_line) in enumerate(zip_longest(output_content, golden_content, fillvalue='')):
-                if out_line != gold_line:
-                    if printed_lines < 10:
-                        print(f"Line {i+1}:")
-                        print(f"Output: {out_line.rstrip()}")
-                        print(f"Golden: {gold_line.rstrip()}")
-                        printed_lines += 1
-                    diff_lines += 1
-            if diff_lines > printed_lines:
-                print(f"and {diff_lines - printed_lines} more lines")
-            if diff_lines > 0:
-                pytest.fail(f"{output_file} does not match {golden_file} file, diff lines: {diff_lines}")
-
     compare_output_with_golden(wb_output_file, wb_golden_file)
     if os.path.exists(wb_output_file):
         os.remove(wb_output_file)
@@ -108,3 +110,219 @@ def test_wb_ha_discovery_matrix_files(wb_input_dir):
 
 async def wb_ha_discovery_matrix_test(app: App):
     await app.run()
+
+def test_multiple_wirenboard_brokers(tmp_path):
+    wb_input_file = os.path.join(os.path.dirname(__file__), 'testdata', 'basic', 'wb.input.txt')
+    ha_input_file = str(tmp_path / 'ha.input.txt')
+    with open(ha_input_file, 'w') as f:
+        f.write(json.dumps({'topic': '/devices/wb-mr3_16/controls/K1/on', 'payload': '1'}) + '\n')
+        f.write(json.dumps({'topic': '/devices/second_wb-mr3_16/controls/K2/on', 'payload': '1'}) + '\n')
+        f.write(json.dumps({'topic': '/devices/unknown/controls/K1/on', 'payload': '1'}) + '\n')
+
+    cfg = config_schema_builder({})({
+        "homeassistant": {'broker_host': 'localhost', 'broker_port': 1883, 'config_first_publish_delay': 0},
+        "wirenboard": {'broker_host': 'localhost', 'broker_port': 1883},
+        "wirenboard.extra_brokers": [{'broker_host': 'second', 'broker_port': 1883, 'device_id_prefix': 'second_'}],
+    })
+    wb_mqtt_client = LocalMQTTClient(wb_input_file, str(tmp_path / 'wb.output.txt'))
+    second_wb_mqtt_client = LocalMQTTClient(wb_input_file, str(tmp_path / 'second_wb.output.txt'))
+    ha_mqtt_client = LocalMQTTClient(ha_input_file, str(tmp_path / 'ha.output.txt'))
+    app = App(
+        cfg["homeassistant"],
+        cfg["wirenboard"],
+        ha_mqtt_client, wb_mqtt_client,
+        HomeAssistantDiscoveryCustomizer(device_id_prefixes=['', 'second_']),
+        [(e, second_wb_mqtt_client) for e in cfg["wirenboard.extra_brokers"]],
+    )
+
+    completed = 0
+    async def on_disconnect(a, b):
+        nonlocal completed
+        completed += 1
+        if completed == 3:
+            await app.stop()
+
+    wb_mqtt_client.on_disconnect = on_disconnect
+    second_wb_mqtt_client.on_disconnect = on_disconnect
+    ha_mqtt_client.on_disconnect = on_disconnect
+    asyncio.run(wb_ha_discovery_matrix_test(app))
+
+    def read_output(name: str) -> list[dict]:
+        with open(tmp_path / name) as f:
+            return [json.loads(line) for line in f]
+
+    # Commands are routed to controller by device id prefix, prefix is removed from topic
+    assert [m['topic'] for m in read_output('wb.output.txt')] == ['/devices/wb-mr3_16/controls/K1/on', '/devices/unknown/controls/K1/on']
+    assert [m['topic'] for m in read_output('second_wb.output.txt')] == ['/devices/wb-mr3_16/controls/K2/on']
+    # Controller of device not in registry is not cached
+    assert 'unknown' not in app._wb_by_device_id
+
+    ha_topics = {m['topic']: m['payload'] for m in read_output('ha.output.txt')}
+    assert '/devices/wb-mr3_16/controls/K1' in ha_topics
+    assert '/devices/second_wb-mr3_16/controls/K1' in ha_topics
+    # Default combined devices are created for every controller
+    configs = [json.loads(payload) for topic, payload in ha_topics.items() if topic.endswith('/config') and payload]
+    assert {'wirenboard', 'second_wirenboard'} <= {c['device']['identifiers'] for c in configs}
+
+@pytest.mark.parametrize('wb_input_dir', get_test_dirs())
+def test_sharded_app_matrix_files(wb_input_dir, tmp_path):
+    # Workers publish independently, so order and number of repeated messages differ from golden files,
+    # but brokers must end up with the same retained messages
+    wb_input_file = os.path.join(wb_input_dir, 'wb.input.txt')
+    options_file = os.path.join(wb_input_dir, 'options.json')
+    options = {
+        "homeassistant": {'broker_host': 'localhost', 'broker_port': 1883, 'config_first_publish_delay': 0},
+        "wirenboard": {'broker_host': 'localhost', 'broker_port': 1883},
+    }
+    if os.path.exists(options_file):
+        with open(options_file, 'r') as f:
+            options = json.load(f)
+    cfg = config_schema_builder({})(options)
+
+    wb_mqtt_client = LocalMQTTClient(wb_input_file, str(tmp_path / 'wb.output.txt'))
+    ha_mqtt_client = LocalMQTTClient(os.path.join(wb_input_dir, 'ha.input.txt'), str(tmp_path / 'ha.output.txt'))
+    app = ShardedApp(
+        2,
+        cfg["homeassistant"],
+        cfg["wirenboard"],
+        ha_mqtt_client, wb_mqtt_client,
+        HomeAssistantDiscoveryCustomizer(
+            ignored_device_ids=cfg.get("homeassistant.ignored_device_ids", []),
+            ignored_device_control_ids=cfg.get("homeassistant.ignored_device_control_ids", []),
+            splitted_device_ids=cfg.get("homeassistant.splitted_device_ids", []),
+            combined_devices=cfg.get("homeassistant.combined_devices", []),
+            enable_default_combined_devices=cfg.get("homeassistant.enable_default_combined_devices", True),
+        ),
+    )
+
+    completed = 0
+    async def on_disconnect(a, b):
+        nonlocal completed
+        completed += 1
+        if completed == 2:
+            await app.stop()
+
+    wb_mqtt_client.on_disconnect = on_disconnect
+    ha_mqtt_client.on_disconnect = on_disconnect
+    asyncio.run(app.run())
+
+    def last_messages(file_name: str) -> dict[str, str]:
+        with open(file_name) as f:
+            return {m['topic']: m['payload'] for m in map(json.loads, f)}
+
+    for name in ('wb', 'ha'):
+        assert last_messages(str(tmp_path / f'{name}.output.txt')) == last_messages(os.path.join(wb_input_dir, f'{name}.golden.txt'))
+
+@pytest.mark.parametrize('wb_input_dir', get_test_dirs())
+def test_single_subscription_matrix_files(wb_input_dir, tmp_path):
+    # One /devices/# subscription with local demultiplexing produces exactly the same output
+    options_file = os.path.join(wb_input_dir, 'options.json')
+    options = {
+        "homeassistant": {'broker_host': 'localhost', 'broker_port': 1883, 'config_first_publish_delay': 0},
+        "wirenboard": {'broker_host': 'localhost', 'broker_port': 1883},
+    }
+    if os.path.exists(options_file):
+        with open(options_file, 'r') as f:
+            options = json.load(f)
+    options["wirenboard"]["single_subscription"] = True
+    cfg = config_schema_builder({})(options)
+
+    wb_output_file = str(tmp_path / 'wb.output.txt')
+    ha_output_file = str(tmp_path / 'ha.output.txt')
+    wb_mqtt_client = LocalMQTTClient(os.path.join(wb_input_dir, 'wb.input.txt'), wb_output_file)
+    ha_mqtt_client = LocalMQTTClient(os.path.join(wb_input_dir, 'ha.input.txt'), ha_output_file)
+    app = App(
+        cfg["homeassistant"],
+        cfg["wirenboard"],
+        ha_mqtt_client, wb_mqtt_client,
+        HomeAssistantDiscoveryCustomizer(
+            ignored_device_ids=cfg.get("homeassistant.ignored_device_ids", []),
+            ignored_device_control_ids=cfg.get("homeassistant.ignored_device_control_ids", []),
+            splitted_device_ids=cfg.get("homeassistant.splitted_device_ids", []),
+            combined_devices=cfg.get("homeassistant.combined_devices", []),
+            enable_default_combined_devices=cfg.get("homeassistant.enable_default_combined_devices", True),
+        ),
+    )
+
+    completed = 0
+    async def on_disconnect(a, b):
+        nonlocal completed
+        completed += 1
+        if completed == 2:
+            await app.stop()
+
+    wb_mqtt_client.on_disconnect = on_disconnect
+    ha_mqtt_client.on_disconnect = on_disconnect
+    asyncio.run(app.run())
+
+    assert wb_mqtt_client._subscriptions and all(s.pattern == '^/devices/.+$' for s in wb_mqtt_client._subscriptions)
+    # Same messages as golden files. Order is not compared: with config_first_publish_delay tasks woken
+    # by timers interleave with publish tasks depending on load of the machine.
+    for name, output_file in (('wb', wb_output_file), ('ha', ha_output_file)):
+        with open(output_file) as out_f, open(os.path.join(wb_input_dir, f'{name}.golden.txt')) as gold_f:
+            assert sorted(out_f.readlines()) == sorted(gold_f.readlines())
+
+def test_sharded_app_keeps_combined_devices_on_reload():
+    customizer = HomeAssistantDiscoveryCustomizer()
+    app = ShardedApp(2, {'broker_host': 'localhost', 'broker_port': 1883}, {'broker_host': 'localhost', 'broker_port': 1883},
+                     InmemMQTTClient(), InmemMQTTClient(), customizer)
+    # Devices are owned by workers according to combined devices
+    app.reload_customizer(HomeAssistantDiscoveryCustomizer(combined_devices=[{'device_id': 'knx', 'new_device_id': 'wirenboard', 'new_name': 'Wiren Board'}]))
+    assert app._ha_customizer is customizer
+    app.reload_customizer(HomeAssistantDiscoveryCustomizer(splitted_device_ids=['wb_gpio']))
+    assert app._ha_customizer is customizer
+    new_customizer = HomeAssistantDiscoveryCustomizer(ignored_device_ids=['knx'])
+    app.reload_customizer(new_customizer)
+    assert app._ha_customizer is new_customizer
+
+class RecordingChannel:
+    def __init__(self):
+        self.messages = []
+
+    def send(self, msg):
+        self.messages.append(msg)
+
+def test_sharded_app_routes_by_ha_device():
+    wb_client = InmemMQTTClient()
+    # Controls of splitted device are separate Home Assistant devices, one of them is combined with relay
+    app = ShardedApp(8, {'broker_host': 'localhost', 'broker_port': 1883}, {'broker_host': 'localhost', 'broker_port': 1883},
+                     InmemMQTTClient(), wb_client, HomeAssistantDiscoveryCustomizer(
+                         splitted_device_ids=['wb_gpio'],
+                         combined_devices=[
+                             {'device_id': 'wb_gpio_a1_in', 'new_device_id': 'hall', 'new_name': 'Hall'},
+                             {'device_id': 'wb_mr6c_1', 'new_device_id': 'hall', 'new_name': 'Hall'},
+                         ]))
+    app._channels = [RecordingChannel() for _ in range(8)]
+
+    def owners(topics) -> set[int]:
+        for topic in topics:
+            wb_client.on_message(None, topic, b'1', 0, {})
+        owners = {i for i, channel in enumerate(app._channels) if channel.messages}
+        for channel in app._channels:
+            channel.messages.clear()
+        return owners
+
+    hall = [
+        '/devices/wb-gpio/controls/A1_IN', '/devices/wb-gpio/controls/A1_IN/meta/type',
+        '/devices/wb-mr6c_1/controls/K1', '/devices/wb-mr6c_1/controls/K2/meta/type',
+    ]
+    assert len(owners(hall)) == 1
+    # Other controls of splitted device are spread over workers
+    assert len(owners([f'/devices/wb-gpio/controls/A{i}_IN' for i in range(2, 12)])) > 1
+    # Device meta and device info go to every worker
+    assert len(owners(['/devices/wb-mr6c_1/meta/name'])) == 8
+    assert len(owners(['/devices/wb-mr6c_1/controls/Serial'])) == 8
+    assert len(owners(['/devices/system/controls/HW Revision'])) == 8
+
+def test_sharded_app_fails_when_worker_dies():
+    async def run():
+        app = ShardedApp(2, {'broker_host': 'localhost', 'broker_port': 1883}, {'broker_host': 'localhost', 'broker_port': 1883},
+                         InmemMQTTClient(), InmemMQTTClient(), HomeAssistantDiscoveryCustomizer())
+        task = asyncio.create_task(app.run())
+        await asyncio.wait_for(app._workers_ready.wait(), 30)
+        app._processes[0].kill()
+        # Shard of devices is not lost silently, app stops and fails
+        with pytest.raises(RuntimeError, match='worker 0 exited'):
+            await asyncio.wait_for(task, 30)
+        assert not any(process.is_alive() for process in app._processes)
+    asyncio.run(run())
@@ -0,0 +1,190 @@
+import asyncio
+import json
+import os
+import sys
+import threading
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer, make_mocked_request
+
+from wb_to_ha import manual_config
+from wb_to_ha.handlers import HTTPService
+from wb_to_ha.manual_config import ManualConfigService
+from wb_to_ha.mqtt.conn.inmem_mqtt import InmemMQTTClient
+from wb_to_ha.mqtt.topics import TOPIC_CLASS_AVAILABILITY, TOPIC_CLASS_STATE
+
+def config_payload(unique_id: str) -> str:
+    return json.dumps({
+        'device': {'name': 'Wiren Board', 'identifiers': 'wirenboard'},
+        'name': unique_id,
+        'unique_id': unique_id,
+        'availability_topic': f'/devices/wb/controls/{unique_id}/availability',
+        'payload_available': '1',
+        'payload_not_available': '0',
+        'state_topic': f'/devices/wb/controls/{unique_id}',
+    })
+
+def unique_ids(service: ManualConfigService, device_type: str) -> list[str]:
+    return [e['unique_id'] for e in service.to_dict()['mqtt'].get(device_type, [])]
+
+def test_incremental_document_is_sorted_and_versioned():
+    service = ManualConfigService()
+    assert service.on_mqtt_message('homeassistant/sensor/wb/b/config', config_payload('b'))
+    assert service.on_mqtt_message('homeassistant/sensor/wb/c/config', config_payload('c'))
+    assert service.on_mqtt_message('homeassistant/sensor/wb/a/config', config_payload('a'))
+    assert not service.on_mqtt_message('/devices/wb/controls/a', '1')
+    assert unique_ids(service, 'sensor') == ['a', 'b', 'c']
+    assert service.version == 3
+
+    # Same payload does not change document
+    assert not service.on_mqtt_message('homeassistant/sensor/wb/a/config', config_payload('a'))
+    assert service.version == 3
+
+    rendered = service.to_yaml()
+    assert service.to_yaml() is rendered
+
+    # Empty payload removes entity
+    assert service.on_mqtt_message('homeassistant/sensor/wb/b/config', '')
+    assert unique_ids(service, 'sensor') == ['a', 'c']
+    assert service.to_yaml() != rendered
+
+def test_yaml_handler_etag():
+    client = InmemMQTTClient()
+    service = ManualConfigService()
+    client.add_publish_listener(service.on_mqtt_message)
+    http = HTTPService(service, client)
+    client.publish('homeassistant/sensor/wb/a/config', config_payload('a'))
+
+    resp = asyncio.run(http.wb_to_ha_yaml(make_mocked_request('GET', '/api/wb_to_ha.yaml')))
+    assert resp.status == 200
+    etag = resp.headers['ETag']
+
+    resp = asyncio.run(http.wb_to_ha_yaml(make_mocked_request('GET', '/api/wb_to_ha.yaml', headers={'If-None-Match': etag})))
+    assert resp.status == 304
+
+    client.publish('homeassistant/sensor/wb/b/config', config_payload('b'))
+    resp = asyncio.run(http.wb_to_ha_yaml(make_mocked_request('GET', '/api/wb_to_ha.yaml', headers={'If-None-Match': etag})))
+    assert resp.status == 200
+    assert resp.headers['ETag'] != etag
+
+def test_changes_since():
+    service = ManualConfigService()
+    service.on_mqtt_message('homeassistant/sensor/wb/a/config', config_payload('a'))
+    version = service.version
+    service.on_mqtt_message('homeassistant/sensor/wb/b/config', config_payload('b'))
+    service.on_mqtt_message('homeassistant/binary_sensor/wb/c/config', config_payload('c'))
+    service.on_mqtt_message('homeassistant/sensor/wb/b/config', '')
+
+    changes = service.changes_since(version)
+    assert changes is not None
+    assert [(c['topic'], c['yaml'] is None) for c in changes] == [
+        ('homeassistant/binary_sensor/wb/c/config', False),
+        ('homeassistant/sensor/wb/b/config', True),
+    ]
+    assert service.changes_since(service.version) == []
+    assert ''.join(['mqtt:\n'] + [f"  {c['component']}:\n{c['yaml']}" for c in service.snapshot()]) == service.to_yaml()
+
+def test_yaml_events_stream():
+    client = InmemMQTTClient()
+    service = ManualConfigService()
+    client.add_publish_listener(service.on_mqtt_message)
+    http = HTTPService(service, client, events_settle_delay=0)
+    client.publish('homeassistant/sensor/wb/a/config', config_payload('a'))
+
+    async def read_event(resp) -> tuple[str, dict]:
+        fields: dict[str, str] = {}
+        while True:
+            line = (await resp.content.readline()).decode('utf-8').rstrip('\n')
+            if not line:
+                return fields['event'], json.loads(fields['data'])
+            name, _, value = line.partition(': ')
+            fields[name] = value
+
+    async def run():
+        app = web.Application()
+        app.add_routes([web.get('/api/wb_to_ha/events', http.wb_to_ha_events)])
+        async with TestClient(TestServer(app)) as cl:
+            resp = await cl.get('/api/wb_to_ha/events')
+            event, data = await read_event(resp)
+            assert event == 'snapshot'
+            assert [e['unique_id'] for e in data['entities']] == ['a']
+
+            client.publish('homeassistant/sensor/wb/b/config', config_payload('b'))
+            event, data = await read_event(resp)
+            assert event == 'patch'
+            assert [e['unique_id'] for e in data['entities']] == ['b']
+            resp.close()
+
+    asyncio.run(run())
+
+def test_filter():
+    service = ManualConfigService()
+    service.on_mqtt_message('homeassistant/sensor/wb_msw/temperature/config', config_payload('wb_msw_temperature'))
+    service.on_mqtt_message('homeassistant/sensor/wb_msw/humidity/config', config_payload('wb_msw_humidity'))
+    service.on_mqtt_message('homeassistant/switch/wb_mr6c/k1/config', config_payload('wb_mr6c_k1'))
+    service.on_mqtt_message('homeassistant/sensor/wb_mr6c/power/config', config_payload('wb_mr6c_power'))
+
+    def ids(filtered) -> dict[str, list[str]]:
+        return {t: [e.unique_id for e in entities] for t, entities in filtered.items()}
+
+    assert service.devices() == {'wb_mr6c': 2, 'wb_msw': 2}
+    assert ids(service.filter(device_ids=['wb_msw'])) == {'sensor': ['wb_msw_humidity', 'wb_msw_temperature']}
+    assert ids(service.filter(device_types=['switch'])) == {'switch': ['wb_mr6c_k1']}
+    assert ids(service.filter(unique_id_prefix='wb_mr6c_')) == {'sensor': ['wb_mr6c_power'], 'switch': ['wb_mr6c_k1']}
+    assert ids(service.filter(device_ids=['wb_mr6c'], device_types=['sensor'])) == {'sensor': ['wb_mr6c_power']}
+    assert service.filtered_yaml(device_ids=['unknown']) == 'mqtt: {}\n'
+
+    service.on_mqtt_message('homeassistant/switch/wb_mr6c/k1/config', '')
+    assert service.devices() == {'wb_mr6c': 1, 'wb_msw': 2}
+
+    http = HTTPService(service, InmemMQTTClient())
+    request = make_mocked_request('GET', '/api/devices/wb_msw/wb_to_ha.yaml?component=sensor', match_info={'device_id': 'wb_msw'})
+    resp = asyncio.run(http.wb_to_ha_yaml(request))
+    assert resp.text == service.filtered_yaml(device_ids=['wb_msw'])
+
+def test_yaml_handler_renders_in_executor(monkeypatch):
+    def make_service() -> ManualConfigService:
+        service = ManualConfigService()
+        for unique_id in ('a', 'b', 'c'):
+            service.on_mqtt_message(f'homeassistant/sensor/wb/{unique_id}/config', config_payload(unique_id))
+        return service
+    expected = make_service().to_yaml()
+
+    threads = []
+    render = manual_config._render
+    def record_thread(entities):
+        threads.append(threading.current_thread())
+        return render(entities)
+    monkeypatch.setattr(manual_config, '_render', record_thread)
+
+    service = make_service()
+    http = HTTPService(service, InmemMQTTClient(), render_executor_threshold=2)
+    async def run():
+        resp = await http.wb_to_ha_yaml(make_mocked_request('GET', '/api/wb_to_ha.yaml'))
+        assert resp.text == expected
+        assert threads[-1] is not threading.current_thread()
+        # Blocks are rendered already, filtered document is joined on event loop
+        resp = await http.wb_to_ha_yaml(make_mocked_request('GET', '/api/wb_to_ha.yaml?unique_id_prefix=b'))
+        assert resp.text == service.filtered_yaml(unique_id_prefix='b')
+        assert threads[-2] is threading.current_thread()
+    asyncio.run(run())
+    # Full document is cached as with `to_yaml`
+    assert service.to_yaml() == expected and len(threads) == 3
+
+def test_inmem_retention():
+    client = InmemMQTTClient(retention={TOPIC_CLASS_STATE: 2, TOPIC_CLASS_AVAILABILITY: 0})
+    published = []
+    client.add_publish_listener(lambda topic, payload: published.append(topic))
+    client.publish('homeassistant/sensor/wb/a/config', config_payload('a'))
+    client.publish('/devices/wb/controls/a/availability', '1')
+    for i in range(3):
+        client.publish(f'/devices/wb/controls/s{i}', '10')
+    client.publish('/devices/wb/controls/s1', '20 °C')
+
+    assert len(published) == 6
+    assert list(client.last_messages) == ['homeassistant/sensor/wb/a/config', '/devices/wb/controls/s2', '/devices/wb/controls/s1']
+    footprint = client.footprint()
+    assert footprint[TOPIC_CLASS_AVAILABILITY] == {'topics': 0, 'bytes': 0}
+    # '°' takes 2 bytes in UTF-8
+    assert footprint[TOPIC_CLASS_STATE] == {'topics': 2, 'bytes': len('/devices/wb/controls/s2') + 2 + len('/devices/wb/controls/s1') + 6}
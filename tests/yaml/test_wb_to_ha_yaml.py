@@ -63,6 +63,8 @@ def test_wb_ha_yaml_matrix_files(wb_input_dir):
         ),
     )
     static_config_service = ManualConfigService()
+    incremental_config_service = ManualConfigService()
+    ha_mqtt_client.add_publish_listener(incremental_config_service.on_mqtt_message)
 
     async def on_disconnect(a, b):
         await app.stop()
@@ -75,6 +77,7 @@ def test_wb_ha_yaml_matrix_files(wb_input_dir):
 
     ha_config = static_config_service.convert_mqtt_topics_messages_to_manual_config(ha_mqtt_client.last_messages)
     ha_config_yaml = dict_to_yaml(ha_config)
+    assert incremental_config_service.to_yaml() == ha_config_yaml
     with open(ha_output_file, 'w') as f:
         f.write(ha_config_yaml)
 
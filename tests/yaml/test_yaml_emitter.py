@@ -0,0 +1,51 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import pytest
+import yaml
+
+from wb_to_ha.yaml_emitter import dump
+
+class ReferenceDumper(yaml.Dumper):
+    """PyYAML dumper configured to produce manual config format: keys plain, values double-quoted, indented lists."""
+    def increase_indent(self, flow=False, indentless=False):
+        return super().increase_indent(flow, False)
+
+    def represent_mapping(self, tag, mapping, flow_style=None):
+        node = super().represent_mapping(tag, mapping, flow_style)
+        for key, _ in node.value:
+            key.style = None
+        return node
+
+ReferenceDumper.add_representer(str, lambda dumper, data: dumper.represent_scalar('tag:yaml.org,2002:str', data, style='"'))
+
+@pytest.mark.parametrize('value', [
+    '',
+    'Wiren Board',
+    '/devices/wb-mr3_16/controls/K1/on',
+    'quote " and backslash \\ and tab \t and newline \n',
+    'unicode \u00b0C m\u00b3/hour \xa0 \u2028 \u2029 \ufeff \U0001F600 \x7f \x85',
+    ' '.join(['long value with spaces that should be folded by line width'] * 4),
+    'x' * 100 + ' ' + 'y' * 100,
+    '  leading and trailing spaces  ',
+    ('escaped\n ' * 20),
+])
+def test_dump_matches_pyyaml(value):
+    data = {
+        'mqtt': {
+            'sensor': [
+                {
+                    'device': {'identifiers': 'wirenboard', 'name': value},
+                    'name': value,
+                    'retain': True,
+                    'unique_id': 'wb_value',
+                },
+                {'name': value, 'empty': {}, 'list': [], 'none': None, 'number': 1},
+            ],
+        },
+    }
+    assert dump(data) == yaml.dump(data, allow_unicode=True, Dumper=ReferenceDumper)
+
+def test_dump_empty():
+    assert dump({'mqtt': {}}) == yaml.dump({'mqtt': {}}, allow_unicode=True, Dumper=ReferenceDumper)
@@ -1,54 +1,99 @@
 import asyncio
-import json
 import optparse
 import logging
 import signal
-import yaml
-from voluptuous import MultipleInvalid
+import uuid
 
-from wb_to_ha.config import config_schema_builder, LOGLEVEL_MAPPER
-from wb_to_ha.homeassistant import HomeAssistantDiscoveryCustomizer
+from wb_to_ha import event_loop, json_backend
+from wb_to_ha.config import load_config, LOGLEVEL_MAPPER
+from wb_to_ha.homeassistant import build_customizer
 from gmqtt.client import Client as MQTTClient
 from wb_to_ha.app import App
+from wb_to_ha.leader import LeaderLease
+
+# Modules used only by some config formats and modes are imported where they are used:
+# yaml, sharding (multiprocessing), diagnostics (aiohttp) and inflight storage are not loaded on start otherwise
 
 logging.getLogger().setLevel(logging.INFO)  # root
 
 logger = logging.getLogger(__name__)
 
-def main(cfg):
-    logging.basicConfig(
-        level=LOGLEVEL_MAPPER[cfg["general.loglevel"]],
-        format="%(asctime)s %(levelname)s [%(name)s] %(message)s",
-        datefmt="%H:%M:%S",
-    )
-    logging.getLogger("gmqtt").setLevel(LOGLEVEL_MAPPER[cfg["mqtt.loglevel"]])
-
+async def create_app(cfg):
+    """App with MQTT clients of the config, must run on the loop of the bridge."""
     wb_cfg = cfg["wirenboard"]
     ha_cfg = cfg["homeassistant"] if "homeassistant" in cfg else {}
 
-    logger.info("Starting")
     wb_mqtt_client = MQTTClient(client_id=wb_cfg["mqtt_client_id"])
     if wb_cfg.get('username') and wb_cfg.get('password'):
         wb_mqtt_client.set_auth_credentials(
             wb_cfg["username"],
             wb_cfg["password"]
         )
-    ha_mqtt_client = MQTTClient(client_id=ha_cfg["mqtt_client_id"])
+    ha_inflight = None
+    if ha_cfg.get("inflight_window"):
+        from wb_to_ha.mqtt.inflight import InflightStorage
+        ha_inflight = InflightStorage()
+    if ha_inflight is not None:
+        ha_mqtt_client = MQTTClient(client_id=ha_cfg["mqtt_client_id"], persistent_storage=ha_inflight)
+    else:
+        ha_mqtt_client = MQTTClient(client_id=ha_cfg["mqtt_client_id"])
     if ha_cfg.get("username") and ha_cfg.get("password"):
         ha_mqtt_client.set_auth_credentials(
             ha_cfg["username"],
             ha_cfg["password"]
         )
-    ha_customizer = HomeAssistantDiscoveryCustomizer(
-        splitted_device_ids=cfg["homeassistant.splitted_device_ids"],
-        combined_devices=cfg["homeassistant.combined_devices"],
-        ignored_device_ids=cfg["homeassistant.ignored_device_ids"],
-        ignored_device_control_ids=cfg["homeassistant.ignored_device_control_ids"],
-        enable_default_combined_devices=cfg["homeassistant.enable_default_combined_devices"],
+    extra_wb_brokers = []
+    for extra_wb_cfg in cfg["wirenboard.extra_brokers"]:
+        extra_wb_mqtt_client = MQTTClient(client_id=extra_wb_cfg["mqtt_client_id"])
+        if extra_wb_cfg.get('username') and extra_wb_cfg.get('password'):
+            extra_wb_mqtt_client.set_auth_credentials(
+                extra_wb_cfg["username"],
+                extra_wb_cfg["password"]
+            )
+        extra_wb_brokers.append((extra_wb_cfg, extra_wb_mqtt_client))
+    ha_customizer = build_customizer(cfg)
+    leader_lease = None
+    if cfg["failover"]["enabled"]:
+        leader_lease = LeaderLease(
+            cfg["failover"].get("instance_id") or uuid.uuid4().hex[:8],
+            cfg["failover"]["lease_topic"],
+            cfg["failover"]["lease_ttl"],
+            cfg["failover"]["heartbeat_interval"],
+        )
+    diagnostics = None
+    if cfg["general.workers"] > 0:
+        from wb_to_ha.sharding import ShardedApp
+        app = ShardedApp(cfg["general.workers"], ha_cfg, wb_cfg, ha_mqtt_client, wb_mqtt_client, ha_customizer, extra_wb_brokers,
+                         aggregated_controls=cfg["homeassistant.aggregated_controls"], qos_rules=cfg["homeassistant.qos_rules"])
+    else:
+        app = App(ha_cfg, wb_cfg, ha_mqtt_client, wb_mqtt_client, ha_customizer, extra_wb_brokers, leader_lease, cfg["general.history_size"],
+                  aggregated_controls=cfg["homeassistant.aggregated_controls"], ha_inflight=ha_inflight,
+                  qos_rules=cfg["homeassistant.qos_rules"])
+        if cfg["general.diagnostics_port"]:
+            from wb_to_ha.diagnostics import DiagnosticsService
+            diagnostics = DiagnosticsService(app.registry, app.metrics)
+
+    return app, diagnostics
+
+def main(cfg, reload_config):
+    logging.basicConfig(
+        level=LOGLEVEL_MAPPER[cfg["general.loglevel"]],
+        format="%(asctime)s %(levelname)s [%(name)s] %(message)s",
+        datefmt="%H:%M:%S",
     )
-    app = App(ha_cfg, wb_cfg, ha_mqtt_client, wb_mqtt_client, ha_customizer)
+    logging.getLogger("gmqtt").setLevel(LOGLEVEL_MAPPER[cfg["mqtt.loglevel"]])
+    json_backend.set_backend(cfg["general.json_backend"])
+    event_loop.set_loop(cfg["general.event_loop"])
+
+    logger.info("Starting")
+    # gmqtt client schedules resend of QoS 1/2 messages on the current loop when it is created,
+    # so clients are created in `create_app` running on the loop of the bridge
+    loop = event_loop.new_event_loop()
+    asyncio.set_event_loop(loop)
+    app, diagnostics = loop.run_until_complete(create_app(cfg))
 
-    loop = asyncio.get_event_loop()
+    if diagnostics is not None:
+        loop.run_until_complete(diagnostics.start('0.0.0.0', cfg["general.diagnostics_port"]))
 
     def stop_app():
         loop.create_task(app.stop())
@@ -56,8 +101,37 @@ def main(cfg):
     loop.add_signal_handler(signal.SIGINT, stop_app)
     loop.add_signal_handler(signal.SIGTERM, stop_app)
 
+    def reload_customizer():
+        # Only customization is applied, other options need restart
+        new_cfg = reload_config()
+        if new_cfg is None:
+            logger.error("Customization is not reloaded")
+            return
+        logger.info("Reloading customization")
+        app.reload_customizer(build_customizer(new_cfg))
+
+    loop.add_signal_handler(signal.SIGHUP, reload_customizer)
+
     loop.run_until_complete(app.run())
 
+def plan(cfg, new_cfg, capture_file):
+    """Prints changes of discovery configs after switching from `cfg` to `new_cfg`, nothing is connected."""
+    from wb_to_ha import planner
+
+    json_backend.set_backend(cfg["general.json_backend"])
+    registry = planner.load_registry(capture_file, cfg["wirenboard"]["device_id_prefix"])
+    diff = planner.plan(
+        registry,
+        build_customizer(cfg),
+        build_customizer(new_cfg),
+        cfg["homeassistant"]["availability_mode"],
+        new_cfg["homeassistant"]["availability_mode"],
+        cfg["homeassistant.aggregated_controls"],
+        new_cfg["homeassistant.aggregated_controls"],
+    )
+    for line in diff.format():
+        print(line)
+
 if __name__ == "__main__":
     parser = optparse.OptionParser()
     parser.add_option("-c", "--config", default="/data/options.json", dest="config_file", help="Path to config file. In YAML or JSON format")
@@ -65,6 +139,10 @@ if __name__ == "__main__":
     parser.add_option("--ha_mqtt_port", type=int, default=1883, dest="ha_mqtt_port", help="HA MQTT port")
     parser.add_option("--ha_mqtt_username", default="", dest="ha_mqtt_username", help="HA MQTT username")
     parser.add_option("--ha_mqtt_password", default="", dest="ha_mqtt_password", help="HA MQTT password")
+    parser.add_option("--plan", default="", dest="plan_capture_file",
+                      help="Dry run: print discovery configs changed by --plan-config, for recorded Wiren Board traffic in JSONL format. "
+                           "Traffic is read as traffic of wirenboard broker, devices of wirenboard.extra_brokers are not compared")
+    parser.add_option("--plan-config", default="", dest="plan_config_file", help="New config file to compare with --config in dry run")
     opts, args = parser.parse_args()
 
     config_file = opts.config_file
@@ -73,29 +151,18 @@ if __name__ == "__main__":
         parser.print_help()
         exit(1)
 
-    try:
-        with open(config_file) as f:
-            config_file_content = f.read()
-    except OSError as e:
-        logger.error(f'Could not open config file "{config_file}: {e}"')
-        exit(1)
-
-    config = None
-    if config_file.endswith(".json"):
-        config = json.loads(config_file_content)
-    elif config_file.endswith(".yaml") or config_file.endswith(".yml"):
-        config = yaml.load(config_file_content, Loader=yaml.FullLoader)
-    else:
-        logger.error(f'Unsupported config file extension: "{config_file}"')
-        exit(1)
-    if not config:
-        logger.error(f'Empty config "{config_file}"')
-        exit(1)
-
-    try:
-        config = config_schema_builder(vars(opts))(config)
-    except MultipleInvalid as e:
-        logger.error(f"Config validation error: {e}")
+    config = load_config(config_file, vars(opts))
+    if config is None:
         exit(1)
 
-    main(config)
\ No newline at end of file
+    if opts.plan_capture_file:
+        if not opts.plan_config_file:
+            logger.error("--plan-config is required for dry run")
+            exit(1)
+        new_config = load_config(opts.plan_config_file, vars(opts))
+        if new_config is None:
+            exit(1)
+        plan(config, new_config, opts.plan_capture_file)
+        exit(0)
+
+    main(config, lambda: load_config(config_file, vars(opts)))
\ No newline at end of file
@@ -1,15 +1,11 @@
 import asyncio
-import json
 import optparse
 import logging
 import signal
-import yaml
-from voluptuous import MultipleInvalid
-from aiohttp import web
 
-from wb_to_ha import handlers
-from wb_to_ha.config import config_schema_builder, LOGLEVEL_MAPPER
-from wb_to_ha.homeassistant import HomeAssistantDiscoveryCustomizer
+from wb_to_ha import event_loop, json_backend
+from wb_to_ha.config import load_config, LOGLEVEL_MAPPER
+from wb_to_ha.homeassistant import build_customizer
 from gmqtt.client import Client as MQTTClient
 from wb_to_ha.app import App
 from wb_to_ha.manual_config import ManualConfigService
@@ -19,38 +15,69 @@ logging.getLogger().setLevel(logging.INFO)  # root
 
 logger = logging.getLogger(__name__)
 
-def main(cfg):
-    logging.basicConfig(
-        level=LOGLEVEL_MAPPER[cfg["general.loglevel"]],
-        format="%(asctime)s %(levelname)s [%(name)s] %(message)s",
-        datefmt="%H:%M:%S",
-    )
-    logging.getLogger("gmqtt").setLevel(LOGLEVEL_MAPPER[cfg["mqtt.loglevel"]])
+# aiohttp is imported in `main`, after config is validated, yaml and sharding (multiprocessing) only when they are used
 
+async def create_app(cfg, ha_mqtt_client):
+    """App with MQTT clients of the config, must run on the loop of the bridge."""
     wb_cfg = cfg["wirenboard"]
     ha_cfg = cfg["homeassistant"] if "homeassistant" in cfg else {}
 
-    logger.info("Starting")
     wb_mqtt_client = MQTTClient(client_id=wb_cfg["mqtt_client_id"])
     if wb_cfg.get('username') and wb_cfg.get('password'):
         wb_mqtt_client.set_auth_credentials(
             wb_cfg["username"],
             wb_cfg["password"]
         )
-    ha_mqtt_client = InmemMQTTClient()
-    ha_customizer = HomeAssistantDiscoveryCustomizer(
-        splitted_device_ids=cfg["homeassistant.splitted_device_ids"],
-        combined_devices=cfg["homeassistant.combined_devices"],
-        ignored_device_ids=cfg["homeassistant.ignored_device_ids"],
-        ignored_device_control_ids=cfg["homeassistant.ignored_device_control_ids"],
-        enable_default_combined_devices=cfg["homeassistant.enable_default_combined_devices"],
+    extra_wb_brokers = []
+    for extra_wb_cfg in cfg["wirenboard.extra_brokers"]:
+        extra_wb_mqtt_client = MQTTClient(client_id=extra_wb_cfg["mqtt_client_id"])
+        if extra_wb_cfg.get('username') and extra_wb_cfg.get('password'):
+            extra_wb_mqtt_client.set_auth_credentials(
+                extra_wb_cfg["username"],
+                extra_wb_cfg["password"]
+            )
+        extra_wb_brokers.append((extra_wb_cfg, extra_wb_mqtt_client))
+    ha_customizer = build_customizer(cfg)
+
+    diagnostics = None
+    if cfg["general.workers"] > 0:
+        from wb_to_ha.sharding import ShardedApp
+        app = ShardedApp(cfg["general.workers"], ha_cfg, wb_cfg, ha_mqtt_client, wb_mqtt_client, ha_customizer, extra_wb_brokers,
+                         aggregated_controls=cfg["homeassistant.aggregated_controls"])
+    else:
+        app = App(ha_cfg, wb_cfg, ha_mqtt_client, wb_mqtt_client, ha_customizer, extra_wb_brokers, history_size=cfg["general.history_size"],
+                  aggregated_controls=cfg["homeassistant.aggregated_controls"])
+        if cfg["general.history_size"]:
+            from wb_to_ha.diagnostics import DiagnosticsService
+            diagnostics = DiagnosticsService(app.registry, app.metrics)
+
+    return app, diagnostics
+
+def main(cfg, reload_config):
+    from aiohttp import web
+    from wb_to_ha import handlers
+
+    logging.basicConfig(
+        level=LOGLEVEL_MAPPER[cfg["general.loglevel"]],
+        format="%(asctime)s %(levelname)s [%(name)s] %(message)s",
+        datefmt="%H:%M:%S",
     )
+    logging.getLogger("gmqtt").setLevel(LOGLEVEL_MAPPER[cfg["mqtt.loglevel"]])
+    json_backend.set_backend(cfg["general.json_backend"])
+    event_loop.set_loop(cfg["general.event_loop"])
 
+    logger.info("Starting")
+    # Only discovery configs are used to build YAML, by default states and availability are not kept.
+    ha_mqtt_client = InmemMQTTClient(retention=cfg["general.yaml_retention"])
     manual_config_service = ManualConfigService()
+    ha_mqtt_client.add_publish_listener(manual_config_service.on_mqtt_message)
     handlers_service = handlers.HTTPService(manual_config_service, ha_mqtt_client)
-    app = App(ha_cfg, wb_cfg, ha_mqtt_client, wb_mqtt_client, ha_customizer)
 
-    loop = asyncio.get_event_loop()
+    # gmqtt client schedules resend of QoS 1/2 messages on the current loop when it is created,
+    # so clients are created in `create_app` running on the loop of the bridge
+    loop = event_loop.new_event_loop()
+    asyncio.set_event_loop(loop)
+    app, diagnostics = loop.run_until_complete(create_app(cfg, ha_mqtt_client))
 
     async def stop_app(*arg):
         asyncio.create_task(app.stop())
@@ -63,9 +90,26 @@ def main(cfg):
     wapp.on_shutdown.append(stop_app)
     wapp.add_routes([
         web.get('/api/wb_to_ha.yaml', handlers_service.wb_to_ha_yaml),
+        web.get('/api/wb_to_ha/events', handlers_service.wb_to_ha_events),
+        web.get('/api/devices', handlers_service.devices),
+        web.get('/api/stats', handlers_service.stats),
+        web.get('/api/devices/{device_id}/wb_to_ha.yaml', handlers_service.wb_to_ha_yaml),
         web.get('/', handlers_service.index),
         web.static('/', 'frontend')
     ])
+    if diagnostics is not None:
+        wapp.add_routes(diagnostics.routes())
+
+    def reload_customizer():
+        # Only customization is applied, other options need restart
+        new_cfg = reload_config()
+        if new_cfg is None:
+            logger.error("Customization is not reloaded")
+            return
+        logger.info("Reloading customization")
+        app.reload_customizer(build_customizer(new_cfg))
+
+    loop.add_signal_handler(signal.SIGHUP, reload_customizer)
     web.run_app(wapp, host='0.0.0.0', port=8099, loop=loop)
 
 if __name__ == "__main__":
@@ -79,29 +123,8 @@ if __name__ == "__main__":
         parser.print_help()
         exit(1)
 
-    try:
-        with open(config_file) as f:
-            config_file_content = f.read()
-    except OSError as e:
-        logger.error(f'Could not open config file "{config_file}: {e}"')
-        exit(1)
-
-    config = None
-    if config_file.endswith(".json"):
-        config = json.loads(config_file_content)
-    elif config_file.endswith(".yaml") or config_file.endswith(".yml"):
-        config = yaml.load(config_file_content, Loader=yaml.FullLoader)
-    else:
-        logger.error(f'Unsupported config file extension: "{config_file}"')
-        exit(1)
-    if not config:
-        logger.error(f'Empty config "{config_file}"')
-        exit(1)
-
-    try:
-        config = config_schema_builder(vars(opts))(config)
-    except MultipleInvalid as e:
-        logger.error(f"Config validation error: {e}")
+    config = load_config(config_file, vars(opts))
+    if config is None:
         exit(1)
 
-    main(config)
\ No newline at end of file
+    main(config, lambda: load_config(config_file, vars(opts)))
\ No newline at end of file
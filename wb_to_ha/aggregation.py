@@ -0,0 +1,112 @@
+"""
+Time-window aggregation of high-frequency sensors.
+
+`AggregatingHomeAssistant` sits between Wirenboard and HomeAssistant: states of configured controls are collected
+during window and only the last one is published at the end of window. Optionally min/max/mean of the window
+are published as extra sensors with their own discovery configs.
+"""
+import asyncio
+import logging
+
+from wb_to_ha.homeassistant import HomeAssistant, format_entity_id
+from wb_to_ha.wirenboard_registry import WirenControl, WirenDevice
+
+logger = logging.getLogger(__name__)
+
+# Suffixes of extra sensors, they are attributes of WindowStats
+EXTRA_SENSOR_SUFFIXES = ['min', 'max', 'mean']
+
+class AggregatedControl:
+    entity_id: str
+    window: float
+    extra_sensors: bool
+
+    def __init__(self, entity_id: str, window: float, extra_sensors: bool = False):
+        self.entity_id = entity_id
+        self.window = window
+        self.extra_sensors = extra_sensors
+
+class WindowStats:
+    __slots__ = ('min', 'max', 'sum', 'count')
+
+    min: float
+    max: float
+    sum: float
+    count: int
+
+    def __init__(self, value: float):
+        self.min = value
+        self.max = value
+        self.sum = value
+        self.count = 1
+
+    def add(self, value: float):
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        self.sum += value
+        self.count += 1
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count
+
+def format_value(value: float) -> str:
+    return format(round(value, 3), '.15g')
+
+class AggregatingHomeAssistant:
+    """IHomeAssistant decorator, states of other controls and all configs go to HomeAssistant as is."""
+    _hass: HomeAssistant
+    # entity id -> aggregation parameters
+    _controls: dict[str, AggregatedControl]
+    # entity id -> stats of current window
+    _windows: dict[str, WindowStats]
+    # entity id -> timer of the end of current window
+    _flush_timers: dict[str, asyncio.TimerHandle]
+
+    def __init__(self, hass: HomeAssistant, aggregated_controls: list[dict]):
+        self._hass = hass
+        self._controls = {e['entity_id']: AggregatedControl(**e) for e in aggregated_controls}
+        self._windows = {}
+        self._flush_timers = {}
+
+    def publish_device_config(self, device: WirenDevice):
+        self._hass.publish_device_config(device)
+
+    def publish_control_config(self, device: WirenDevice, control: WirenControl):
+        self._hass.publish_control_config(device, control)
+
+    def publish_availability(self, device: WirenDevice, control: WirenControl):
+        self._hass.publish_availability(device, control)
+
+    def publish_control_state(self, device: WirenDevice, control: WirenControl):
+        entity_id = format_entity_id(device.device_id, control.id)
+        aggregated = self._controls.get(entity_id)
+        if aggregated is None or control.value is None:
+            self._hass.publish_control_state(device, control)
+            return
+        stats = self._windows.get(entity_id)
+        if stats is not None:
+            stats.add(control.value)
+            self._hass.metrics.inc('aggregated_states')
+            return
+        self._windows[entity_id] = WindowStats(control.value)
+        self._flush_timers[entity_id] = asyncio.get_running_loop().call_later(aggregated.window, self._flush, entity_id, device, control)
+
+    def stop(self):
+        """Cancels windows in progress, their states are not published."""
+        for timer in self._flush_timers.values():
+            timer.cancel()
+        self._flush_timers.clear()
+        self._windows.clear()
+
+    def _flush(self, entity_id: str, device: WirenDevice, control: WirenControl):
+        del self._flush_timers[entity_id]
+        stats = self._windows.pop(entity_id)
+        # control keeps last state of window, window already limits its rate
+        self._hass.publish_control_state_now(device, control)
+        if self._controls[entity_id].extra_sensors:
+            self._hass.publish_derived_states(device, control, {
+                suffix: format_value(getattr(stats, suffix)) for suffix in EXTRA_SENSOR_SUFFIXES
+            })
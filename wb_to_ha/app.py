@@ -1,11 +1,14 @@
 import asyncio
 import logging
-from typing import Callable, Protocol, Union
-from gmqtt import Client as MQTTClient
-from wb_to_ha.homeassistant import HomeAssistant, HomeAssistantDiscoveryCustomizer
-from wb_to_ha.mqtt.conn.tester_mqtt import LocalMQTTClient
-from wb_to_ha.mqtt.mqtt_router import MQTTRouter
-from wb_to_ha.wirenboard import Wirenboard
+from typing import Callable, Protocol
+from wb_to_ha.aggregation import AggregatingHomeAssistant
+from wb_to_ha.homeassistant import AVAILABILITY_MODE_CONTROL, HomeAssistant, HomeAssistantDiscoveryCustomizer
+from wb_to_ha.leader import LeaderLease
+from wb_to_ha.metrics import Metrics
+from wb_to_ha.mqtt.topics import TOPIC_CLASS_STATE
+from wb_to_ha.mqtt.mqtt_router import IInflightNotifier, MQTTRouter
+from wb_to_ha.qos import QosPolicy
+from wb_to_ha.wirenboard import IHomeAssistant, Wirenboard
 from wb_to_ha.wirenboard_registry import WirenBoardDeviceRegistry
 
 logger = logging.getLogger(__name__)
@@ -21,6 +24,27 @@ class IMQTTClient(Protocol):
     def publish(self, topic: str, payload: str, qos: int = 0, retain: bool = False):
         ...
 
+class IConnectableMQTTClient(Protocol):
+    async def connect(self, host: str, port: int):
+        ...
+
+async def connect_mqtt(name: str, client: IConnectableMQTTClient, host: str, port: int):
+    # infinite loop of reconnections
+    trynum = 0
+    while True:
+        try:
+            await client.connect(host, port)
+            logger.info(f"[{name}] connected to MQTT")
+            break
+        except ConnectionRefusedError as e:
+            # backoff
+            trynum = min(trynum + 6, 30)
+            logger.error(f"[{name}] error connecting to MQTT: {e}; next try in {trynum} seconds")
+            await asyncio.sleep(trynum)
+        except Exception as e:
+            logger.error(f"[{name}] MQTT: error connecting: {e}")
+            raise
+
 class App:
     _ha_mqtt_router: MQTTRouter
     _wb_mqtt_router: MQTTRouter
@@ -28,8 +52,17 @@ class App:
     _wb_mqtt_client: IMQTTClient
     _wb: Wirenboard
     _ha: HomeAssistant
+    _registry: WirenBoardDeviceRegistry
     _ha_config: dict
     _wb_config: dict
+    # Additional Wiren Board controllers: config, client and bridge of every broker
+    _extra_wbs: list[tuple[dict, IMQTTClient, Wirenboard]]
+    _wbs_by_prefix: list[Wirenboard]
+    # device id -> controller, resolved by prefix on the first command to device
+    _wb_by_device_id: dict[str, Wirenboard]
+    _aggregation: AggregatingHomeAssistant | None
+    _lease: LeaderLease | None
+    _lease_task: asyncio.Task | None
     _stoper: asyncio.Event
     _is_stopping: bool
 
@@ -39,6 +72,12 @@ class App:
                 ha_mqtt_client: IMQTTClient,
                 wb_mqtt_client: IMQTTClient,
                 ha_customizer: HomeAssistantDiscoveryCustomizer,
+                extra_wb_brokers: list[tuple[dict, IMQTTClient]] = [],
+                leader_lease: LeaderLease | None = None,
+                history_size: int = 0,
+                aggregated_controls: list[dict] = [],
+                ha_inflight: IInflightNotifier | None = None,
+                qos_rules: list[dict] = [],
                 ):
         self._stoper = asyncio.Event()
         assert 'broker_host' in ha_config
@@ -47,11 +86,39 @@ class App:
         assert 'broker_port' in wb_config
         self._ha_config = ha_config
         self._wb_config = wb_config
+        self._lease = leader_lease
+        self._lease_task = None
+        if leader_lease is not None:
+            # Standby does not publish anything, Home Assistant messages dropped by standby can be published on promotion
+            ha_mqtt_client = leader_lease.gate(ha_mqtt_client, replay=True)
+            wb_mqtt_client = leader_lease.gate(wb_mqtt_client, replay=False)
+            extra_wb_brokers = [(config, leader_lease.gate(client, replay=False)) for config, client in extra_wb_brokers]
         self._ha_mqtt_client = ha_mqtt_client
         self._wb_mqtt_client = wb_mqtt_client
-        self._ha_mqtt_router = MQTTRouter(self._ha_mqtt_client, 'homeassistant')
+        metrics = Metrics()
+        # Home Assistant broker gets configs, states and availability of all devices, so only its publishes are limited
+        self._ha_mqtt_router = MQTTRouter(
+            self._ha_mqtt_client,
+            'homeassistant',
+            ha_inflight,
+            ha_config.get('inflight_window', 0),
+            ha_config.get('publish_queue_size', 0),
+            ha_config.get('publish_drop_classes', [TOPIC_CLASS_STATE]),
+            metrics,
+        )
         self._wb_mqtt_router = MQTTRouter(self._wb_mqtt_client, 'wirenboard')
-        device_registry = WirenBoardDeviceRegistry()
+        qos_policy = None
+        if qos_rules or ha_config.get('qos_downgrade_threshold'):
+            qos_policy = QosPolicy(
+                ha_config.get('state_qos', 1),
+                qos_rules,
+                ha_config.get('qos_downgrade_threshold', 0),
+                ha_config.get('qos_restore_threshold', 0),
+                lambda: self._ha_mqtt_router.queue_depth,
+                metrics,
+            )
+        device_registry = WirenBoardDeviceRegistry(history_size)
+        self._registry = device_registry
         self._ha = HomeAssistant(
             self._ha_mqtt_router,
             device_registry,
@@ -65,6 +132,12 @@ class App:
             ha_config.get('config_retain', True),
             ha_config.get('state_qos', 1),
             ha_config.get('state_retain', True),
+            ha_config.get('availability_mode', AVAILABILITY_MODE_CONTROL),
+            ha_config.get('availability_debounce', 0),
+            ha_config.get('config_debounce', 0),
+            metrics=metrics,
+            optimistic_switch_timeout=ha_config.get('optimistic_switch_timeout', 0),
+            qos_policy=qos_policy,
         )
         self._wb = Wirenboard(
             self._wb_mqtt_router,
@@ -73,27 +146,100 @@ class App:
             wb_config.get('subscribe_qos', 1),
             wb_config.get('publish_qos', 1),
             wb_config.get('publish_retain', False),
+            wb_config.get('device_id_prefix', ''),
+            wb_config.get('single_subscription', False),
+            wb_config.get('command_coalesce_window', 0),
+            self._ha.metrics,
         )
-        self._wb.hass = self._ha
-        self._ha_mqtt_client.on_connect = self._ha.on_connect
+        # Wiren Board controllers publish to Home Assistant through aggregation stage, when it is configured
+        self._aggregation = AggregatingHomeAssistant(self._ha, aggregated_controls) if aggregated_controls else None
+        hass: IHomeAssistant = self._aggregation or self._ha
+        self._wb.hass = hass
+        self._ha_mqtt_client.on_connect = self._on_ha_connect
         self._wb_mqtt_client.on_connect = self._wb.on_connect
-        self._ha.on_control_set_state = self._wb.on_control_set_state
+
+        # All controllers share one registry and one Home Assistant connection,
+        # device ids of extra controllers are separated by their prefixes.
+        self._extra_wbs = []
+        for config, client in extra_wb_brokers:
+            assert 'broker_host' in config
+            assert 'broker_port' in config
+            assert config.get('device_id_prefix')
+            wb = Wirenboard(
+                MQTTRouter(client, f"wirenboard:{config['device_id_prefix']}"),
+                device_registry,
+                hass,
+                config.get('subscribe_qos', 1),
+                config.get('publish_qos', 1),
+                config.get('publish_retain', False),
+                config['device_id_prefix'],
+                config.get('single_subscription', False),
+                config.get('command_coalesce_window', 0),
+                self._ha.metrics,
+            )
+            client.on_connect = wb.on_connect
+            self._extra_wbs.append((config, client, wb))
+        # Longest prefix first, so command goes to the most specific controller
+        self._wbs_by_prefix = sorted([self._wb] + [wb for _, _, wb in self._extra_wbs], key=lambda wb: len(wb.device_id_prefix), reverse=True)
+        self._wb_by_device_id = {}
+        self._ha.on_control_set_state = self._on_control_set_state
         self._is_stopping = False
 
+    @property
+    def registry(self) -> WirenBoardDeviceRegistry:
+        return self._registry
+
+    @property
+    def metrics(self) -> Metrics:
+        return self._ha.metrics
+
+    def reload_customizer(self, ha_customizer: HomeAssistantDiscoveryCustomizer):
+        """Applies new customization to known devices, connections and registry are kept."""
+        self._ha.set_customizer(ha_customizer)
+
+    def _on_ha_connect(self, *args, **kwargs):
+        self._ha_mqtt_router.recount_inflight()
+        if self._lease is not None:
+            self._lease.on_connect(self._ha_mqtt_router)
+        self._ha.on_connect(*args, **kwargs)
+
+    def _on_control_set_state(self, device_id: str, control_id: str, control_state: str):
+        wb = self._wb_by_device_id.get(device_id)
+        if wb is None:
+            for wb in self._wbs_by_prefix:
+                if device_id.startswith(wb.device_id_prefix):
+                    # Commands come from any topic of Home Assistant broker, only known devices are cached
+                    if device_id in self._registry.devices():
+                        self._wb_by_device_id[device_id] = wb
+                    break
+            else:
+                logger.warning(f"No Wiren Board controller for device {device_id}")
+                return
+        wb.on_control_set_state(device_id, control_id, control_state)
+
     async def run(self):
+        if self._lease is not None:
+            self._lease_task = asyncio.create_task(self._lease.run())
         async with asyncio.TaskGroup() as tg:
-            tg.create_task(self._connect_mqtt(
+            tg.create_task(connect_mqtt(
                 name="wirenboard",
                 client=self._wb_mqtt_client,
                 host=self._wb_config['broker_host'],
                 port=self._wb_config['broker_port'],
             ))
-            tg.create_task(self._connect_mqtt(
+            tg.create_task(connect_mqtt(
                 name="homeassistant",
                 client=self._ha_mqtt_client,
                 host=self._ha_config['broker_host'],
                 port=self._ha_config['broker_port'],
             ))
+            for config, client, _ in self._extra_wbs:
+                tg.create_task(connect_mqtt(
+                    name=f"wirenboard:{config['device_id_prefix']}",
+                    client=client,
+                    host=config['broker_host'],
+                    port=config['broker_port'],
+                ))
         await self._stoper.wait()
         while True:
             pending = asyncio.all_tasks()
@@ -105,28 +251,21 @@ class App:
             except asyncio.CancelledError:
                 pass
 
-    async def _connect_mqtt(self, name: str, client: Union[LocalMQTTClient, MQTTClient], host: str, port: int):
-        # infinite loop of reconnections
-        trynum = 0
-        while True:
-            try:
-                await client.connect(host, port)
-                logger.info(f"[{name}] connected to MQTT")
-                break
-            except ConnectionRefusedError as e:
-                # backoff
-                trynum = min(trynum + 6, 30)
-                logger.error(f"[{name}] error connecting to MQTT: {e}; next try in {trynum} seconds")
-                await asyncio.sleep(trynum)
-            except Exception as e:
-                logger.error(f"[{name}] MQTT: error connecting: {e}")
-                raise
-
     async def stop(self):
         if self._is_stopping:
             return
         self._is_stopping = True
         logger.info("Stopping app")
+        if self._lease is not None:
+            self._lease.stop()
+        if self._lease_task is not None:
+            self._lease_task.cancel()
+        for wb in self._wbs_by_prefix:
+            wb.stop()
+        if self._aggregation is not None:
+            self._aggregation.stop()
         await self._wb_mqtt_client.disconnect()
+        for _, client, _ in self._extra_wbs:
+            await client.disconnect()
         await self._ha_mqtt_client.disconnect()
         self._stoper.set()
\ No newline at end of file
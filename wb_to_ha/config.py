@@ -1,6 +1,11 @@
 from enum import Enum
+import json
 import logging
-from voluptuous import Schema, Optional, Required, Coerce, Range
+from voluptuous import All, Any, In, Invalid, MultipleInvalid, Schema, Optional, Required, Coerce, Range
+
+from wb_to_ha.mappers import WirenControlType
+
+logger = logging.getLogger(__name__)
 
 class ConfigLogLevel(Enum):
     FATAL = "FATAL"
@@ -21,34 +26,144 @@ LOGLEVEL_MAPPER = {
 
 __invalid_qos_msg = "Invalid QoS: must be 0, 1 or 2"
 
+def _validate_extra_brokers(brokers: list[dict]) -> list[dict]:
+    prefixes = [b.get("device_id_prefix", "") for b in brokers]
+    if "" in prefixes:
+        raise Invalid("device_id_prefix is required for extra Wiren Board brokers")
+    if len(set(prefixes)) != len(prefixes):
+        raise Invalid("device_id_prefix of extra Wiren Board brokers must be unique")
+    return brokers
+
+def _validate_failover(config: dict) -> dict:
+    if config["heartbeat_interval"] >= config["lease_ttl"]:
+        raise Invalid("failover.heartbeat_interval must be less than failover.lease_ttl")
+    return config
+
+def _validate_workers(config: dict) -> dict:
+    # Worker processes own the registry and publish through main process, which only moves messages
+    if config["general.workers"] > 0:
+        if config["failover"]["enabled"]:
+            raise Invalid("failover is not supported with worker processes")
+        if config["general.diagnostics_port"]:
+            raise Invalid("general.diagnostics_port is not supported with worker processes")
+        if config["homeassistant"].get("inflight_window"):
+            raise Invalid("homeassistant.inflight_window is not supported with worker processes")
+    return config
+
+def _validate_qos_downgrade(config: dict) -> dict:
+    # Downgrade depends on depth of publish queue, which exists only with inflight window in main process
+    if config["homeassistant"].get("qos_downgrade_threshold"):
+        if not config["homeassistant"].get("inflight_window"):
+            raise Invalid("homeassistant.qos_downgrade_threshold requires homeassistant.inflight_window")
+        if config["general.workers"] > 0:
+            raise Invalid("homeassistant.qos_downgrade_threshold is not supported with worker processes")
+    return config
+
+def load_config(config_file: str, program_args: dict) -> dict | None:
+    """Reads and validates config file, None if it is not valid, errors are logged."""
+    try:
+        with open(config_file) as f:
+            config_file_content = f.read()
+    except OSError as e:
+        logger.error(f'Could not open config file "{config_file}: {e}"')
+        return None
+
+    config = None
+    if config_file.endswith(".json"):
+        try:
+            config = json.loads(config_file_content)
+        except json.JSONDecodeError as e:
+            logger.error(f'Could not parse config file "{config_file}": {e}')
+            return None
+    elif config_file.endswith(".yaml") or config_file.endswith(".yml"):
+        # yaml is needed only for YAML configs
+        import yaml
+        try:
+            config = yaml.load(config_file_content, Loader=yaml.FullLoader)
+        except yaml.YAMLError as e:
+            logger.error(f'Could not parse config file "{config_file}": {e}')
+            return None
+    else:
+        logger.error(f'Unsupported config file extension: "{config_file}"')
+        return None
+    if not config:
+        logger.error(f'Empty config "{config_file}"')
+        return None
+
+    try:
+        return config_schema_builder(program_args)(config)
+    except MultipleInvalid as e:
+        logger.error(f"Config validation error: {e}")
+        return None
+
 # config_schema_builder should be last function in this file because it used in docs_builder.py
 def config_schema_builder(program_args: dict) -> Schema:
-    return Schema(
+    # Wiren Board MQTT broker configuration
+    wirenboard_broker = {
+        # Wiren Board MQTT broker host
+        Required("broker_host"): str,
+        # Wiren Board MQTT broker port
+        Optional("broker_port", default=1883): int,
+        # Wiren Board MQTT broker username. Pass empty if mqtt without authentication.
+        Optional("username"): str,
+        # Wiren Board MQTT broker password. Pass empty if mqtt without authentication.
+        Optional("password"): str,
+        # MQTT client ID, required by MQTT protocol.
+        # By default used same client ID for both MQTT clients.
+        Required("mqtt_client_id", default="wb-to-ha-discovery"): str,
+        # Wiren Board MQTT subscribe QoS. For more details check MQTT spec.
+        Optional("subscribe_qos", default=1): Range(min=0, max=2, msg=__invalid_qos_msg),
+        # Wiren Board MQTT publish QoS. For more details check MQTT spec.
+        Optional("publish_qos", default=1): Range(min=0, max=2, msg=__invalid_qos_msg),
+        # Wiren Board MQTT publish retain flag. For more details check MQTT spec.
+        Optional("publish_retain", default=False): bool,
+        # Prefix added to ids of all devices of this broker in Home Assistant.
+        # For example, with prefix `second_` device `wb-mr3_16` is registered as `second_wb-mr3_16`.
+        Optional("device_id_prefix", default=""): str,
+        # Subscribe to whole `/devices/#` tree with one subscription and parse topics locally,
+        # instead of three wildcard subscriptions. Broker matches each message against one filter only.
+        Optional("single_subscription", default=False): bool,
+        # Commands to range controls (sliders) within this window in seconds are coalesced,
+        # only the latest value is sent to Wiren Board. 0 - every command is sent.
+        Optional("command_coalesce_window", default=0): All(Coerce(float), Range(min=0)),
+    }
+    return Schema(All(
         {
             # Logger level for this addon
             Optional("general.loglevel", default=ConfigLogLevel.INFO): Coerce(ConfigLogLevel),
+            # Number of worker processes for Wiren Board devices. Devices are partitioned between workers by id,
+            # main process only receives and publishes MQTT messages. 0 - process everything in main process.
+            # Useful for installations with tens of thousands of controls on multicore hosts.
+            # Not supported with failover, diagnostics and `homeassistant.inflight_window`.
+            Optional("general.workers", default=0): Range(min=0),
+            # Number of last state messages kept per control for diagnostics, with their time and numeric value.
+            # Diagnostics shows history and message rate of every control. 0 - history is not kept.
+            Optional("general.history_size", default=0): Range(min=0),
+            # Port of diagnostics HTTP JSON API (/api/diagnostics/...), 0 - disabled.
+            # YAML addon serves diagnostics on its web interface port, when history is enabled.
+            Optional("general.diagnostics_port", default=0): Range(min=0, max=65535),
+            # Serializer of discovery payloads. `json` - stdlib, `orjson` - faster, when installed,
+            # but its compact output differs from already published configs, so all configs are changed once.
+            Optional("general.json_backend", default="json"): In(["json", "orjson"]),
+            # Event loop. `uvloop` - faster handling of MQTT messages, when installed, otherwise `asyncio` is used.
+            Optional("general.event_loop", default="asyncio"): In(["asyncio", "uvloop"]),
+            # Number of last published topics kept per topic class by YAML addon, which has no Home Assistant broker.
+            # Only configs are needed to build YAML, other classes are kept only for `/api/stats`.
+            # null - keep every topic, 0 - do not keep topics of the class. Not used by discovery addon.
+            Optional("general.yaml_retention", default={}): {
+                Optional("config", default=None): Any(None, Range(min=0)),
+                Optional("availability", default=0): Any(None, Range(min=0)),
+                Optional("state", default=0): Any(None, Range(min=0)),
+            },
             # Logger level for both MQTT clients: Home Assistant and Wiren Board
             Optional("mqtt.loglevel", default=ConfigLogLevel.ERROR): Coerce(ConfigLogLevel),
             # Wiren Board part configuration
-            Required("wirenboard"): {
-                # Wiren Board MQTT broker host
-                Required("broker_host"): str,
-                # Wiren Board MQTT broker port
-                Optional("broker_port", default=1883): int,
-                # Wiren Board MQTT broker username. Pass empty if mqtt without authentication.
-                Optional("username"): str,
-                # Wiren Board MQTT broker password. Pass empty if mqtt without authentication.
-                Optional("password"): str,
-                # MQTT client ID, required by MQTT protocol.
-                # By default used same client ID for both MQTT clients.
-                Required("mqtt_client_id", default="wb-to-ha-discovery"): str,
-                # Wiren Board MQTT subscribe QoS. For more details check MQTT spec.
-                Optional("subscribe_qos", default=1): Range(min=0, max=2, msg=__invalid_qos_msg),
-                # Wiren Board MQTT publish QoS. For more details check MQTT spec.
-                Optional("publish_qos", default=1): Range(min=0, max=2, msg=__invalid_qos_msg),
-                # Wiren Board MQTT publish retain flag. For more details check MQTT spec.
-                Optional("publish_retain", default=False): bool,
-            },
+            Required("wirenboard"): wirenboard_broker,
+            # Additional Wiren Board controllers bridged to the same Home Assistant in one process.
+            # Each broker has the same parameters as `wirenboard`, `device_id_prefix` is required and must be unique,
+            # because devices of different controllers usually have the same ids.
+            # Prefix must not be a beginning of device ids of other brokers.
+            Optional("wirenboard.extra_brokers", default=[]): All([wirenboard_broker], _validate_extra_brokers),
             # Home Assistant part configuration
             Required("homeassistant", default={}): {
                 # Home Assistant MQTT broker host.
@@ -75,6 +190,11 @@ def config_schema_builder(program_args: dict) -> Schema:
                 Optional("config_first_publish_delay", default=1): Range(min=0),
                 # Delay in seconds before publish device config (and all its controls) to Home Assistant.
                 Optional("config_publish_delay", default=0): Range(min=0),
+                # Interval in seconds during which config changes of a device are collected after first publish,
+                # e.g. when Wiren Board republishes all meta after restart of wb-mqtt-serial.
+                # Then every changed config is published once, unchanged configs are not published again.
+                # Replaces `config_publish_delay` when enabled.
+                Optional("config_debounce", default=0): All(Coerce(float), Range(min=0)),
                 # Home Assistant MQTT subscribe QoS. For more details check MQTT spec.
                 Optional("subscribe_qos", default=1): Range(min=0, max=2, msg=__invalid_qos_msg),
                 # QoS for pushing availability messages to Home Assistant.
@@ -85,6 +205,14 @@ def config_schema_builder(program_args: dict) -> Schema:
                 # For more details about retain flag check MQTT spec.
                 # For more details about availability messages check Home Assistant documentation.
                 Optional("availability_retain", default=True): bool,
+                # `control` - availability topic per control, entity is unavailable when its control has error.
+                # `device` - one availability topic per Home Assistant device (combined or splitted devices included),
+                # all entities of device are unavailable when all its controls have errors.
+                # Reduces number of availability messages and retained topics when module drops off the bus.
+                Optional("availability_mode", default="control"): In(["control", "device"]),
+                # Delay in seconds before device availability change is published in `device` availability mode.
+                # Errors which are cleared during this delay are not published.
+                Optional("availability_debounce", default=0): All(Coerce(float), Range(min=0)),
                 # QoS for pushing config messages to Home Assistant.
                 # For more details about QoS check MQTT spec.
                 # For more details about config messages check Home Assistant documentation.
@@ -101,6 +229,23 @@ def config_schema_builder(program_args: dict) -> Schema:
                 # For more details about retain flag check MQTT spec.
                 # For more details about state messages check Home Assistant documentation.
                 Optional("state_retain", default=True): bool,
+                # Timeout in seconds for optimistic state of switches. Commanded state is published to Home Assistant
+                # immediately, if Wiren Board does not report the same state within timeout, reported state is published back.
+                # 0 - state is published only when Wiren Board reports it.
+                Optional("optimistic_switch_timeout", default=0): All(Coerce(float), Range(min=0)),
+                # Maximum number of not acknowledged QoS 1/2 messages published to Home Assistant broker.
+                # Other messages wait in queue, where only the latest message of every topic is kept.
+                # 0 - messages are passed to MQTT client without limit. Not supported with worker processes.
+                Optional("inflight_window", default=0): Range(min=0),
+                # Maximum number of topics in queue when `inflight_window` is enabled, 0 - not limited.
+                Optional("publish_queue_size", default=0): Range(min=0),
+                # Classes of messages which are dropped when queue is full, messages of other classes are queued anyway.
+                Optional("publish_drop_classes", default=["state"]): [In(["config", "availability", "state"])],
+                # Depth of publish queue (see `inflight_window`) when states are published with QoS 0 to reduce load.
+                # 0 - QoS of states is never downgraded. Requires `inflight_window`, not supported with worker processes.
+                Optional("qos_downgrade_threshold", default=0): Range(min=0),
+                # Depth of publish queue when states are published with configured QoS again.
+                Optional("qos_restore_threshold", default=0): Range(min=0),
             },
             # Home Assistant ignored devices configuration.
             #
@@ -157,5 +302,51 @@ def config_schema_builder(program_args: dict) -> Schema:
             # - `alarms` -> `wirenboard`
             # - `metrics` -> `wirenboard`
             Optional("homeassistant.enable_default_combined_devices", default=True): bool,
-        }
-)
+            # Controls which states are aggregated over time window, e.g. power of energy meters published several times per second.
+            # Home Assistant receives last state once per window instead of every state.
+            #
+            # Entity ID is formatted the same way as in `homeassistant.ignored_device_control_ids`.
+            # Only numeric controls are aggregated, other states are published as is.
+            Optional("homeassistant.aggregated_controls", default=[]): [
+                {
+                    # Entity ID of control, e.g. `wb_map12h_1_ch_1_total_p`.
+                    Required("entity_id"): str,
+                    # Window in seconds.
+                    Required("window"): All(Coerce(float), Range(min=0, min_included=False)),
+                    # Publish min, max and mean over window as extra sensors `<entity_id>_min`, `<entity_id>_max`, `<entity_id>_mean`.
+                    Optional("extra_sensors", default=False): bool,
+                }
+            ],
+            # QoS of state messages by Wiren Board control type and device id, the first matched rule wins.
+            # `homeassistant.state_qos` is used for controls which do not match any rule.
+            Optional("homeassistant.qos_rules", default=[]): [
+                {
+                    # Glob of Wiren Board device id, e.g. `wb-map*`.
+                    Optional("device", default="*"): str,
+                    # Wiren Board control type, e.g. `power`. Any type when omitted.
+                    Optional("control_type"): In([t.value for t in WirenControlType]),
+                    Required("qos"): Range(min=0, max=2, msg=__invalid_qos_msg),
+                }
+            ],
+            # Active/standby mode. Run several instances with the same configuration and different `instance_id`.
+            # Leader publishes to Home Assistant, standby instances keep all devices in memory
+            # and one of them becomes leader when lease of leader is not renewed during `lease_ttl`.
+            Optional("failover", default={}): All({
+                # Enable active/standby mode
+                Optional("enabled", default=False): bool,
+                # Unique id of instance. When two instances are leaders, instance with lower id stays leader.
+                # Random by default.
+                Optional("instance_id"): str,
+                # Retained topic on Home Assistant MQTT broker with lease of current leader
+                Optional("lease_topic", default="wb_to_ha/leader"): str,
+                # Time in seconds after last lease renewal when leader is considered dead, standby takes over
+                # exactly at expiration. Lease bypasses publish queue, so it is not delayed by load of leader.
+                Optional("lease_ttl", default=1): All(Coerce(float), Range(min=0, min_included=False)),
+                # Interval in seconds of lease renewal, must be less than `lease_ttl`.
+                # Default tolerates three lost heartbeats in a row.
+                Optional("heartbeat_interval", default=0.25): All(Coerce(float), Range(min=0, min_included=False)),
+            }, _validate_failover),
+        },
+        _validate_workers,
+        _validate_qos_downgrade,
+    ))
@@ -0,0 +1,75 @@
+import time
+from aiohttp import web
+
+from wb_to_ha.metrics import Metrics
+from wb_to_ha.wirenboard_registry import WirenBoardDeviceRegistry
+
+class DiagnosticsService:
+    """JSON endpoints to find noisy controls and tune throttling: message rates, history of states and counters."""
+    _registry: WirenBoardDeviceRegistry
+    _metrics: Metrics
+
+    def __init__(self, registry: WirenBoardDeviceRegistry, metrics: Metrics):
+        self._registry = registry
+        self._metrics = metrics
+
+    def routes(self) -> list[web.RouteDef]:
+        return [
+            web.get('/api/diagnostics/controls', self.controls),
+            web.get('/api/diagnostics/controls/{device_id}/{control_id}', self.control_history),
+            web.get('/api/diagnostics/metrics', self.metrics),
+        ]
+
+    async def start(self, host: str, port: int) -> web.AppRunner:
+        """Serves diagnostics on its own port, for the addon without web interface."""
+        app = web.Application()
+        app.add_routes(self.routes())
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+    async def controls(self, request: web.Request):
+        """
+        Controls with history sorted by message rate, noisiest first.
+        `limit` - maximum number of controls in response.
+        """
+        try:
+            limit = int(request.query.get('limit', 0))
+        except ValueError:
+            raise web.HTTPBadRequest(text='limit must be integer')
+        now = time.time()
+        result = []
+        for device in self._registry.devices().values():
+            for control in device.controls.values():
+                if control.history is None:
+                    continue
+                result.append({
+                    'device_id': device.device_id,
+                    'control_id': control.id,
+                    'state': control.state,
+                    'messages': control.history.count,
+                    'rate_per_minute': round(control.history.rate(now), 3),
+                })
+        result.sort(key=lambda c: c['rate_per_minute'], reverse=True)
+        if limit > 0:
+            result = result[:limit]
+        return web.json_response(result)
+
+    async def control_history(self, request: web.Request):
+        """Kept state messages of control from the oldest to the newest."""
+        device = self._registry.devices().get(request.match_info['device_id'])
+        control = device.controls.get(request.match_info['control_id']) if device else None
+        if control is None or control.history is None:
+            raise web.HTTPNotFound()
+        return web.json_response({
+            'device_id': control.device_id,
+            'control_id': control.id,
+            'state': control.state,
+            'value': control.value,
+            'messages': control.history.count,
+            'history': [{'timestamp': ts, 'value': value} for ts, value in control.history.items()],
+        })
+
+    async def metrics(self, request: web.Request):
+        return web.json_response(self._metrics.snapshot())
@@ -0,0 +1,57 @@
+"""
+Discovery payloads rendered from compiled templates.
+
+For one combination of Home Assistant component, Wiren Board control type and units, discovery payload has
+the same structure, only names, ids and topics differ. Template is compiled once: payload is built with sentinels
+in place of these fields and serialized with current JSON backend, then split at sentinels. Rendering joins
+the fragments with serialized values, so output is byte-identical to serializing the whole payload.
+"""
+import re
+
+from wb_to_ha import json_backend
+
+def sentinel(name: str) -> str:
+    # \x00 does not appear in names and topics, serializers escape it, so it is found in serialized payload as is
+    return f'\x00{name}\x00'
+
+class DiscoveryTemplate:
+    __slots__ = ('_fragments', '_fields', '_raw')
+
+    # serialized payload between fields, one more than fields
+    _fragments: list[str]
+    # name of field after fragment with the same index
+    _fields: list[str]
+    # field is already serialized JSON value, e.g. device object, otherwise field is string or part of string
+    _raw: list[bool]
+
+    def __init__(self, payload: dict, fields: list[str], raw_fields: list[str] = []):
+        """
+        `payload` - payload with `sentinel(name)` in place of fields. String fields can be parts of strings,
+        e.g. `sentinel('control_topic') + '/on'`, raw fields replace whole values.
+        """
+        markers = {json_backend.dumps_str(sentinel(name))[1:-1]: (name, False) for name in fields}
+        markers.update({json_backend.dumps_str(sentinel(name)): (name, True) for name in raw_fields})
+        # raw markers are longer, they include quotes
+        pattern = re.compile('|'.join(re.escape(m) for m in sorted(markers, key=len, reverse=True)))
+        data = json_backend.dumps(payload)
+        self._fragments = []
+        self._fields = []
+        self._raw = []
+        pos = 0
+        for match in pattern.finditer(data):
+            name, raw = markers[match.group(0)]
+            self._fragments.append(data[pos:match.start()])
+            self._fields.append(name)
+            self._raw.append(raw)
+            pos = match.end()
+        self._fragments.append(data[pos:])
+
+    def render(self, values: dict[str, str]) -> str:
+        dumps_str = json_backend.dumps_str
+        fragments = self._fragments
+        parts = [fragments[0]]
+        for i, name in enumerate(self._fields):
+            value = values[name]
+            parts.append(value if self._raw[i] else dumps_str(value)[1:-1])
+            parts.append(fragments[i + 1])
+        return ''.join(parts)
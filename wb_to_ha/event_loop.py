@@ -0,0 +1,38 @@
+"""
+Event loop of the bridge.
+
+Every MQTT message is read, dispatched and published in callbacks and tasks of the event loop, so on low-power
+controllers the loop itself is a noticeable part of CPU time. uvloop runs them faster than stdlib asyncio loop,
+it is used when selected with `set_loop(LOOP_UVLOOP)` and installed, stdlib loop is used otherwise.
+uvloop is imported only when selected, it is not needed to start with stdlib loop.
+"""
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+LOOP_ASYNCIO = 'asyncio'
+LOOP_UVLOOP = 'uvloop'
+
+_loop_name = LOOP_ASYNCIO
+
+def set_loop(name: str):
+    """Selects loop created by `new_event_loop`, falls back to stdlib loop when uvloop is not installed."""
+    global _loop_name
+    if name == LOOP_UVLOOP:
+        try:
+            import uvloop  # type: ignore[import-not-found]
+        except ImportError:
+            logger.warning("uvloop is not installed, asyncio event loop is used")
+            name = LOOP_ASYNCIO
+    _loop_name = name
+
+def loop_name() -> str:
+    return _loop_name
+
+def new_event_loop() -> asyncio.AbstractEventLoop:
+    """New loop of selected implementation, usable as `loop_factory` of `asyncio.Runner`."""
+    if _loop_name == LOOP_UVLOOP:
+        import uvloop  # type: ignore[import-not-found]
+        return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
@@ -1,24 +1,127 @@
 import asyncio
-from typing import Coroutine
+from typing import Any
 import uuid
 from aiohttp import web
 
-from wb_to_ha import manual_config
+from wb_to_ha import json_backend
 from wb_to_ha.manual_config import ManualConfigService
 from wb_to_ha.mqtt.conn.inmem_mqtt import InmemMQTTClient
 
 class HTTPService(web.View):
     cfg_service: ManualConfigService
     mqtt_client: InmemMQTTClient
+    _instance_id: str
+    # one event per connected events stream, set when document changes
+    _change_events: set[asyncio.Event]
+    _events_settle_delay: float
+    _events_heartbeat_interval: float
+    # document with at least this number of not rendered entity blocks is rendered in executor
+    _render_executor_threshold: int
 
-    def __init__(self, cfg_service: ManualConfigService, mqtt_client: InmemMQTTClient):
+    def __init__(self,
+                 cfg_service: ManualConfigService,
+                 mqtt_client: InmemMQTTClient,
+                 events_settle_delay: float = 0.5,
+                 events_heartbeat_interval: float = 15,
+                 render_executor_threshold: int = 500,
+        ):
         self.cfg_service = cfg_service
         self.mqtt_client = mqtt_client
+        self._instance_id = uuid.uuid4().hex[:8]
+        self._change_events = set()
+        self._events_settle_delay = events_settle_delay
+        self._events_heartbeat_interval = events_heartbeat_interval
+        self._render_executor_threshold = render_executor_threshold
+        self.cfg_service.add_change_listener(self._on_document_change)
+
+    def _on_document_change(self):
+        for event in self._change_events:
+            event.set()
 
     async def index(self, request: web.Request):
         raise web.HTTPFound('/index.html')
 
     async def wb_to_ha_yaml(self, request: web.Request):
-        d = self.cfg_service.convert_mqtt_topics_messages_to_manual_config(self.mqtt_client.last_messages)
-        resp = manual_config.dict_to_yaml(d)
-        return web.Response(text=resp)
+        """
+        Full document or its part filtered by query parameters:
+        `device` - Home Assistant device id, can be repeated;
+        `component` - Home Assistant component type (sensor, switch...), can be repeated;
+        `unique_id_prefix` - prefix of entity unique_id.
+        Device id can also be passed in path: /api/devices/{device_id}/wb_to_ha.yaml
+        """
+        # Instance id makes ETag unique across restarts, because version counter starts from zero.
+        # no-cache forces browser to revalidate cached document with If-None-Match on every request.
+        headers = {'ETag': f'"{self._instance_id}-{self.cfg_service.version}"', 'Cache-Control': 'no-cache'}
+        if request.headers.get('If-None-Match') == headers['ETag']:
+            return web.Response(status=304, headers=headers)
+        device_ids = request.query.getall('device', [])
+        if 'device_id' in request.match_info:
+            device_ids.append(request.match_info['device_id'])
+        device_types = request.query.getall('component', [])
+        text = await self.cfg_service.render_yaml(
+            self._render_executor_threshold,
+            device_ids=device_ids or None,
+            device_types=device_types or None,
+            unique_id_prefix=request.query.get('unique_id_prefix'),
+        )
+        return web.Response(text=text, headers=headers)
+
+    async def devices(self, request: web.Request):
+        """Home Assistant device ids known in document with number of their entities."""
+        return web.json_response(self.cfg_service.devices())
+
+    async def stats(self, request: web.Request):
+        """Memory footprint of in-memory MQTT client and size of document."""
+        return web.json_response({
+            'inmem_mqtt': self.mqtt_client.footprint(),
+            'document': {'version': self.cfg_service.version, 'devices': len(self.cfg_service.devices())},
+        })
+
+    async def wb_to_ha_events(self, request: web.Request):
+        """
+        Server-sent events stream of the document.
+        First `snapshot` event contains all entity blocks, next `patch` events contain only changed entity blocks.
+        Changes are collected during settle delay, so burst of discovery messages is sent as one patch.
+        """
+        resp = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+        await resp.prepare(request)
+        changed = asyncio.Event()
+        self._change_events.add(changed)
+        try:
+            version = self._parse_last_event_id(request.headers.get('Last-Event-ID', ''))
+            changes = self.cfg_service.changes_since(version) if version is not None else None
+            version = self.cfg_service.version
+            if changes is None:
+                await self._send_event(resp, 'snapshot', version, self.cfg_service.snapshot())
+            elif changes:
+                await self._send_event(resp, 'patch', version, changes)
+            while True:
+                try:
+                    await asyncio.wait_for(changed.wait(), self._events_heartbeat_interval)
+                except asyncio.TimeoutError:
+                    await resp.write(b': ping\n\n')
+                    continue
+                await asyncio.sleep(self._events_settle_delay)
+                changed.clear()
+                changes = self.cfg_service.changes_since(version)
+                version = self.cfg_service.version
+                if changes is None:
+                    await self._send_event(resp, 'snapshot', version, self.cfg_service.snapshot())
+                elif changes:
+                    await self._send_event(resp, 'patch', version, changes)
+        except ConnectionResetError:
+            pass
+        finally:
+            self._change_events.discard(changed)
+        return resp
+
+    def _parse_last_event_id(self, last_event_id: str) -> int | None:
+        # Browser sends id of last received event on reconnect, continue from it if it is from this instance.
+        instance_id, _, version = last_event_id.partition('-')
+        if instance_id != self._instance_id or not version.isdigit():
+            return None
+        return int(version)
+
+    async def _send_event(self, resp: web.StreamResponse, event: str, version: int, entities: list[dict[str, Any]]):
+        data = json_backend.dumps({'version': version, 'entities': entities})
+        await resp.write(f'id: {self._instance_id}-{version}\nevent: {event}\ndata: {data}\n\n'.encode('utf-8'))
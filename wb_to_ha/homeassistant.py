@@ -1,12 +1,14 @@
 import asyncio
-import json
 import logging
-import re
 import time
 from typing import Callable, Coroutine
 
 import wb_to_ha.mappers as mappers
+from wb_to_ha import json_backend
+from wb_to_ha.discovery_template import DiscoveryTemplate, sentinel
+from wb_to_ha.metrics import Metrics
 from wb_to_ha.mqtt.mqtt_router import MQTTRouter
+from wb_to_ha.qos import QosPolicy
 from wb_to_ha.wirenboard_registry import WirenControl, WirenDevice, WirenBoardDeviceRegistry
 
 logger = logging.getLogger(__name__)
@@ -34,6 +36,11 @@ _default_combined_devices: list[CombinedDevice] = [
     CombinedDevice('metrics', 'wirenboard', 'Wiren Board'),
 ]
 
+# Availability topic per control, error of control makes only its entity unavailable
+AVAILABILITY_MODE_CONTROL = 'control'
+# One availability topic per Home Assistant device, device is unavailable when all its controls have errors
+AVAILABILITY_MODE_DEVICE = 'device'
+
 class HomeAssistantDiscoveryCustomizer:
     _ignored_device_ids: set[str]
     _ignored_device_control_ids: set[str]
@@ -46,13 +53,20 @@ class HomeAssistantDiscoveryCustomizer:
                  splitted_device_ids: list[str] = [],
                  combined_devices: list[dict] = [],
                  enable_default_combined_devices: bool = True,
+                 device_id_prefixes: list[str] = [''],
         ):
         self._ignored_device_ids = set(ignored_device_ids)
         self._ignored_device_control_ids = set(ignored_device_control_ids)
         self._splitted_device_ids = set(splitted_device_ids)
         self._combined_devices = {e['device_id']: CombinedDevice(**e) for e in combined_devices}
         if enable_default_combined_devices:
-            self._combined_devices.update({e.device_id: e for e in _default_combined_devices})
+            # Every Wiren Board controller gets its own combined device, prefixes are device_id_prefix of brokers.
+            for prefix in device_id_prefixes:
+                new_name = f"Wiren Board {prefix.strip('_-')}" if prefix else None
+                self._combined_devices.update({
+                    prefix + e.device_id: CombinedDevice(prefix + e.device_id, prefix + e.new_device_id, new_name or e.new_name)
+                    for e in _default_combined_devices
+                })
 
     def is_ignored_device(self, device_id: str) -> bool:
         return device_id in self._ignored_device_ids
@@ -67,30 +81,70 @@ class HomeAssistantDiscoveryCustomizer:
     def get_combined_device_id(self, device_id: str) -> CombinedDevice | None:
         return self._combined_devices.get(device_id)
 
+    def get_ha_device(self, device_id: str, control_id: str) -> tuple[str, CombinedDevice | None]:
+        """Id of Home Assistant device of control and combined device, if control is in one."""
+        device_unique_id = prepare_ha_identifier(device_id)
+        if self.is_splitted_device(device_unique_id):
+            device_unique_id = format_entity_id(device_id, control_id)
+        combined_device = self.get_combined_device_id(device_unique_id)
+        if combined_device:
+            return combined_device.new_device_id, combined_device
+        return device_unique_id, None
+
+    def splitted_device_ids(self) -> set[str]:
+        return self._splitted_device_ids
+
+    def combined_device_ids(self) -> dict[str, str]:
+        """Device id -> id of combined device it belongs to."""
+        return {device_id: e.new_device_id for device_id, e in self._combined_devices.items()}
+
 class HomeAssistant:
     # components
     _router: MQTTRouter
     _registry: WirenBoardDeviceRegistry
     _ha_customizer: HomeAssistantDiscoveryCustomizer
     _async_tasks: dict[str, asyncio.Task]
+    _metrics: Metrics
 
     # internal states
     _ratelimiter: dict[str, float]
     _ratelimit_intervals: dict[str, int]
-    _first_published_configs: dict[str, bool]
+    # (device id, control id) of controls whose config was published at least once
+    _first_published_configs: dict[tuple[str, str], bool]
+    # Home Assistant device id -> entity id -> entity is available, for device availability mode
+    _availability_members: dict[str, dict[str, bool]]
+    # Home Assistant device id -> last published availability payload
+    _published_availability: dict[str, str]
+    # device id -> control id -> control, configs waiting for end of debounce interval
+    _pending_configs: dict[str, dict[str, WirenControl]]
+    # config topic -> last published payload, when config debounce is enabled
+    _published_configs: dict[str, str]
+    # config topic of control -> config topic of derived sensor -> last published payload
+    _published_derived_configs: dict[str, dict[str, str]]
+    # config topic of control -> (serialized config of control, suffix -> config topic and payload of derived sensor)
+    _derived_configs: dict[str, tuple[str, dict[str, tuple[str, str]]]]
+    # state topic -> (commanded state, timer of rollback), switch states echoed to Home Assistant before Wiren Board confirms them
+    _optimistic_states: dict[str, tuple[str, asyncio.TimerHandle]]
+    # (component, control type, units) -> compiled control config, None if component is not supported
+    _config_templates: dict[tuple[mappers.HassControlType, mappers.WirenControlType | None, str | None], DiscoveryTemplate | None]
+    # fields of device payload -> serialized device payload, shared by all controls of device
+    _device_payloads: dict[tuple, str]
 
     # configs
     _config_publish_delay: int
     _config_first_publish_delay: int
+    _config_debounce: float
     _subscribe_qos: int
     _availability_qos: int
     _availability_retain: bool
+    _availability_mode: str
+    _availability_debounce: float
     _config_qos: int
     _config_retain: bool
     _state_qos: int
     _state_retain: bool
-
-    _control_command_topic_re = re.compile(r"/devices/([^/]*)/controls/([^/]*)/on$")
+    _optimistic_switch_timeout: float
+    _qos_policy: QosPolicy | None
 
     on_control_set_state: Callable[[str, str, str], None]
 
@@ -107,6 +161,12 @@ class HomeAssistant:
                  config_retain: bool = True,
                  state_qos: int = 1,
                  state_retain: bool = True,
+                 availability_mode: str = AVAILABILITY_MODE_CONTROL,
+                 availability_debounce: float = 0,
+                 config_debounce: float = 0,
+                 metrics: Metrics | None = None,
+                 optimistic_switch_timeout: float = 0,
+                 qos_policy: QosPolicy | None = None,
         ):
         self._router = router
         self._registry = registry
@@ -120,10 +180,29 @@ class HomeAssistant:
         self._config_retain = config_retain
         self._state_qos = state_qos
         self._state_retain = state_retain
+        self._availability_mode = availability_mode
+        self._availability_debounce = availability_debounce
+        self._config_debounce = config_debounce
+        self._metrics = metrics if metrics is not None else Metrics()
+        self._optimistic_switch_timeout = optimistic_switch_timeout
+        self._qos_policy = qos_policy
         self._async_tasks = {}
         self._ratelimiter = {}
         self._ratelimit_intervals = {}
         self._first_published_configs = {}
+        self._availability_members = {}
+        self._published_availability = {}
+        self._pending_configs = {}
+        self._published_configs = {}
+        self._published_derived_configs = {}
+        self._derived_configs = {}
+        self._optimistic_states = {}
+        self._config_templates = {}
+        self._device_payloads = {}
+
+    @property
+    def metrics(self) -> Metrics:
+        return self._metrics
 
     def _run_task(self, task_id: str, task: Coroutine):
         loop = asyncio.get_event_loop()
@@ -138,12 +217,21 @@ class HomeAssistant:
         self._publish_all_devices()
 
     def _publish_all_devices(self):
+        # Availability and configs of every device are published again
+        self._published_availability = {}
+        self._published_configs = {}
+        self._published_derived_configs = {}
         async def do_publish_all_devices():
             for device in self._registry.devices().values():
                 self.publish_device_config(device)
         self._run_task("publish_all_devices", do_publish_all_devices())
 
     def publish_device_config(self, device: WirenDevice):
+        if self._config_debounce:
+            # every control goes to debounce stage of the device, so device config is published once per interval
+            self._publish_device_config(device)
+            return
+
         async def do_publish_device_config():
             await asyncio.sleep(self._config_publish_delay)
             self._publish_device_config(device)
@@ -159,13 +247,16 @@ class HomeAssistant:
             return
         if self._ha_customizer.is_ignored_control(format_entity_id(device.device_id, control.id)):
             return
+        if self._config_debounce and (device.device_id, control.id) in self._first_published_configs:
+            self._debounce_control_config(device, control)
+            return
         async def do_publish_control_config():
-            if control.id not in self._first_published_configs:
+            if (device.device_id, control.id) not in self._first_published_configs:
                 try:
                     # Wait for 1 second to ensure that all data is gathered from all wb topics
                     await asyncio.sleep(self._config_first_publish_delay)
                     # Next time do not wait
-                    self._first_published_configs[control.id] = True
+                    self._first_published_configs[(device.device_id, control.id)] = True
                 except asyncio.CancelledError:
                     return
             self._publish_control_config(device, control)
@@ -173,31 +264,222 @@ class HomeAssistant:
             self._publish_control_state_sync(device, control)
         self._run_task(f"{device.device_id}_{control.id}_config", do_publish_control_config())
 
+    def _debounce_control_config(self, device: WirenDevice, control: WirenControl):
+        """Collects config changes of device during debounce interval, then publishes every changed config once."""
+        self._metrics.inc('config_requests')
+        pending = self._pending_configs.setdefault(device.device_id, {})
+        if control.id in pending:
+            self._metrics.inc('config_coalesced')
+            return
+        pending[control.id] = control
+        if len(pending) > 1:
+            return
+
+        async def publish_pending_configs():
+            await asyncio.sleep(self._config_debounce)
+            for control in self._pending_configs.pop(device.device_id, {}).values():
+                config = self._render_control_config(device, control)
+                if config is None:
+                    continue
+                topic, data = config
+                if self._published_configs.get(topic) == data:
+                    self._metrics.inc('config_unchanged')
+                    continue
+                self._published_configs[topic] = data
+                logger.info(f"publish config of {control} to '{topic}'")
+                self._router.publish(topic, data, qos=self._config_qos, retain=self._config_retain)
+                self._metrics.inc('config_published')
+                self._publish_availability_sync(device, control)
+                self._publish_control_state_sync(device, control)
+        self._run_task(f"{device.device_id}_config_debounce", publish_pending_configs())
+
+    def set_customizer(self, customizer: HomeAssistantDiscoveryCustomizer):
+        """
+        Replaces customization without reconnection. Already published configs are rendered with both customizations
+        from the registry: only added and changed configs are published, configs of controls which are ignored now
+        or moved to another Home Assistant device are removed with empty payload.
+        """
+        # Controls waiting for the first publish get new customization when their config is published
+        controls = [
+            (device, control)
+            for device in self._registry.devices().values()
+            for control in device.controls.values()
+            if (device.device_id, control.id) in self._first_published_configs
+        ]
+        old_configs = [self._render_control_config(device, control) for device, control in controls]
+        self._ha_customizer = customizer
+        new_configs = [self._render_control_config(device, control) for device, control in controls]
+        self._metrics.inc('customizer_reloads')
+
+        new_topics = {config[0] for config in new_configs if config is not None}
+        # Removed first, entity moved to another device keeps its unique_id and Home Assistant accepts only one of them
+        removed = 0
+        for old_config in old_configs:
+            if old_config is None or old_config[0] in new_topics:
+                continue
+            self._remove_config(old_config[0])
+            removed += 1
+        if self._availability_mode == AVAILABILITY_MODE_DEVICE:
+            self._rebuild_device_availability([c for c, config in zip(controls, new_configs) if config is not None])
+        published = 0
+        for (device, control), old_config, new_config in zip(controls, old_configs, new_configs):
+            if new_config is None or new_config == old_config:
+                continue
+            topic, data = new_config
+            if self._config_debounce:
+                self._published_configs[topic] = data
+            logger.info(f"publish config of {control} to '{topic}'")
+            self._router.publish(topic, data, qos=self._config_qos, retain=self._config_retain)
+            self._publish_availability_sync(device, control)
+            self._publish_control_state_sync(device, control)
+            published += 1
+        self._metrics.inc('customizer_configs_published', published)
+        self._metrics.inc('customizer_configs_removed', removed)
+        logger.info(f"customization is replaced, {published} configs published, {removed} configs removed")
+
+    def _remove_config(self, topic: str):
+        logger.info(f"remove config '{topic}'")
+        self._published_configs.pop(topic, None)
+        self._router.publish(topic, '', qos=self._config_qos, retain=self._config_retain)
+        # Derived sensors are published again with the next state of control
+        self._derived_configs.pop(topic, None)
+        for derived_topic in self._published_derived_configs.pop(topic, {}):
+            self._router.publish(derived_topic, '', qos=self._config_qos, retain=self._config_retain)
+
+    def _rebuild_device_availability(self, controls: list[tuple[WirenDevice, WirenControl]]):
+        """Groups entities by Home Assistant devices of current customization, availability of changed devices is published."""
+        members: dict[str, dict[str, bool]] = {}
+        for device, control in controls:
+            ha_device_id, _ = self._get_ha_device(device, control)
+            members.setdefault(ha_device_id, {})[format_entity_id(device.device_id, control.id)] = not control.error
+        removed = self._availability_members.keys() - members.keys()
+        self._availability_members = members
+        for ha_device_id in members:
+            self._publish_device_availability_sync(ha_device_id)
+        for ha_device_id in removed:
+            if self._published_availability.pop(ha_device_id, None) is not None:
+                self._router.publish(self._get_device_availability_topic(ha_device_id), '', qos=self._availability_qos, retain=self._availability_retain)
+
+    def _get_ha_device(self, device: WirenDevice, control: WirenControl) -> tuple[str, str]:
+        """Identifier and name of device, under which control is registered in Home Assistant."""
+        device_unique_id, combined_device = self._ha_customizer.get_ha_device(device.device_id, control.id)
+        if combined_device:
+            return device_unique_id, combined_device.new_name
+        if self._ha_customizer.is_splitted_device(prepare_ha_identifier(device.device_id)):
+            return device_unique_id, f"{device.name} {control.id}".replace("_", " ").title()
+        return device_unique_id, device.name
+
     def _publish_control_config(self, device: WirenDevice, control: WirenControl):
-        # Итоговый идентификатор девайса, под которым девайс или контрол будет зарегистрирован в Home Assistant
-        # Ниже эти параметры будут переопределены в соответствии с конфигом кастомизации
-        device_unique_id = prepare_ha_identifier(device.device_id)
-        device_name = device.name
+        config = self._render_control_config(device, control)
+        if config is None:
+            return
+        topic, data = config
+        logger.info(f"publish config of {control} to '{topic}'")
+
+        async def publish_config():
+            if self._config_debounce:
+                self._published_configs[topic] = data
+            self._router.publish(topic, data, qos=self._config_qos, retain=self._config_retain)
 
+        self._run_task(f"publish_{topic}", publish_config())
+
+    def _build_control_config(self, device: WirenDevice, control: WirenControl) -> tuple[str, dict] | None:
+        """Discovery topic and payload of control, None if control is not published to Home Assistant."""
+        entity = self._get_control_entity(device, control)
+        if entity is None:
+            return None
+        entity_unique_id, entity_name, device_unique_id, device_name = entity
+
+        payload = self._get_config_payload(
+            self._get_device_payload(device, device_unique_id, device_name),
+            entity_name,
+            entity_unique_id,
+            self._get_availability_topic(device, control),
+        )
+
+        component = self._enrich_with_component(payload, device, control)
+        if not component:
+            return None
+        return self._get_config_topic(component, device_unique_id, control), payload
+
+    def _render_control_config(self, device: WirenDevice, control: WirenControl) -> tuple[str, str] | None:
+        """The same as `_build_control_config`, but payload is rendered from template to serialized JSON."""
+        if json_backend.backend() == json_backend.BACKEND_ORJSON:
+            # orjson serializes the whole payload faster than fragments are joined
+            config = self._build_control_config(device, control)
+            return (config[0], json_backend.dumps(config[1])) if config is not None else None
+
+        entity = self._get_control_entity(device, control)
+        if entity is None:
+            return None
+        entity_unique_id, entity_name, device_unique_id, device_name = entity
+
+        component = mappers.wiren_to_hass_type(control)
+        if component is None:
+            return None
+        key = (component, control.type, control.units)
+        template = self._config_templates.get(key)
+        if template is None:
+            if key in self._config_templates:
+                return None
+            template = self._config_templates[key] = self._compile_config_template(component, device, control)
+            if template is None:
+                return None
+
+        data = template.render({
+            'device': self._get_device_payload_json(device, device_unique_id, device_name),
+            'name': entity_name,
+            'unique_id': entity_unique_id,
+            'availability_topic': self._get_availability_topic(device, control),
+            'control_topic': self._get_control_topic(device, control),
+        })
+        return self._get_config_topic(component, device_unique_id, control), data
+
+    def _get_control_entity(self, device: WirenDevice, control: WirenControl) -> tuple[str, str, str, str] | None:
+        """
+        Unique id and name of entity, identifier and name of Home Assistant device of control,
+        None if device or control is ignored.
+        """
         # Entity в Home Assistant, control в WirenBoard
         entity_unique_id = format_entity_id(device.device_id, control.id)
-        entity_name = f"{device.device_id} {control.id}".replace("_", " ").title()
-        object_id = prepare_ha_identifier(control.id)
-
-        if self._ha_customizer.is_ignored_device(device_unique_id):
-            return
+        if self._ha_customizer.is_ignored_device(prepare_ha_identifier(device.device_id)):
+            return None
         if self._ha_customizer.is_ignored_control(entity_unique_id):
-            return
+            return None
+        entity_name = f"{device.device_id} {control.id}".replace("_", " ").title()
+        # Итоговый идентификатор девайса, под которым девайс или контрол будет зарегистрирован в Home Assistant
+        device_unique_id, device_name = self._get_ha_device(device, control)
+        return entity_unique_id, entity_name, device_unique_id, device_name
 
-        if self._ha_customizer.is_splitted_device(device_unique_id):
-            device_unique_id = entity_unique_id
-            device_name = f"{device_name} {control.id}".replace("_", " ").title()
+    def _get_config_topic(self, component: mappers.HassControlType, device_unique_id: str, control: WirenControl) -> str:
+        # https://www.home-assistant.io/integrations/mqtt/#discovery-messages
+        return 'homeassistant' + '/' + component.value + '/' + device_unique_id + '/' + prepare_ha_identifier(control.id) + '/config'
+
+    def render_configs(self) -> dict[str, str]:
+        """Discovery topic -> serialized config of every control in registry, nothing is published."""
+        configs = {}
+        for device in self._registry.devices().values():
+            for control in device.controls.values():
+                config = self._render_control_config(device, control)
+                if config is not None:
+                    configs[config[0]] = config[1]
+        return configs
+
+    def _compile_config_template(self, component: mappers.HassControlType, device: WirenDevice, control: WirenControl) -> DiscoveryTemplate | None:
+        payload = self._get_config_payload(sentinel('device'), sentinel('name'), sentinel('unique_id'), sentinel('availability_topic'))
+        if not self._add_component_fields(payload, component, control, sentinel('control_topic')):
+            logger.warning(f"No algorithm for hass type '{control.type.name if control.type else None}', hass: '{component}', {device}")
+            return None
+        return DiscoveryTemplate(payload, ['name', 'unique_id', 'availability_topic', 'control_topic'], ['device'])
 
-        combined_device = self._ha_customizer.get_combined_device_id(device_unique_id)
-        if combined_device:
-            device_unique_id = combined_device.new_device_id
-            device_name = combined_device.new_name
+    def _get_device_payload_json(self, device: WirenDevice, device_unique_id: str, device_name: str) -> str:
+        key = (device_unique_id, device_name, device.manufactorer, device.model, device.hw_version, device.serial_number, device.sw_version)
+        data = self._device_payloads.get(key)
+        if data is None:
+            data = self._device_payloads[key] = json_backend.dumps(self._get_device_payload(device, device_unique_id, device_name))
+        return data
 
+    def _get_device_payload(self, device: WirenDevice, device_unique_id: str, device_name: str) -> dict:
         d_payload = {
             'name': device_name,
             'identifiers': device_unique_id
@@ -212,44 +494,40 @@ class HomeAssistant:
             d_payload['serial_number'] = device.serial_number
         if device.sw_version:
             d_payload['sw_version'] = device.sw_version
+        return d_payload
 
-        payload = {
-            'device': d_payload,
+    def _get_config_payload(self, device_payload: dict | str, entity_name: str, entity_unique_id: str, availability_topic: str) -> dict:
+        return {
+            'device': device_payload,
             'name': entity_name,
-            'unique_id': entity_unique_id
+            'unique_id': entity_unique_id,
+            'availability_topic': availability_topic,
+            'payload_available': "1",
+            'payload_not_available': "0",
         }
 
-        payload['availability_topic'] = self._get_availability_topic(device, control);
-        payload['payload_available'] = "1"
-        payload['payload_not_available'] = "0"
-
-        component = self._enrich_with_component(payload, device, control)
-        if not component:
-            return
-
-        node_id = device_unique_id
-
-        # https://www.home-assistant.io/integrations/mqtt/#discovery-messages
-        topic = 'homeassistant' + '/' + component.value + '/' + node_id + '/' + object_id + '/config'
-        logger.info(f"publish config of {control} to '{topic}'")
-
-        async def publish_config():
-            self._router.publish(topic, json.dumps(payload), qos=self._config_qos, retain=self._config_retain)
-
-        self._run_task(f"publish_{topic}", publish_config())
-
     def _get_control_topic(self, device: WirenDevice, control: WirenControl):
         return f"/devices/{device.device_id}/controls/{control.id}"
 
     def _get_availability_topic(self, device: WirenDevice, control: WirenControl):
+        if self._availability_mode == AVAILABILITY_MODE_DEVICE:
+            return self._get_device_availability_topic(self._get_ha_device(device, control)[0])
         return f"{self._get_control_topic(device, control)}/availability"
 
+    def _get_device_availability_topic(self, ha_device_id: str):
+        return f"wb_to_ha/{ha_device_id}/availability"
+
     def _enrich_with_component(self, payload: dict, device: WirenDevice, control: WirenControl) -> mappers.HassControlType | None:
         hass_entity_type = mappers.wiren_to_hass_type(control)
         if hass_entity_type is None:
             return None
+        if not self._add_component_fields(payload, hass_entity_type, control, self._get_control_topic(device, control)):
+            logger.warning(f"No algorithm for hass type '{control.type.name if control.type else None}', hass: '{hass_entity_type}', {device}")
+            return None
+        return hass_entity_type
 
-        control_topic = self._get_control_topic(device, control)
+    def _add_component_fields(self, payload: dict, hass_entity_type: mappers.HassControlType, control: WirenControl, control_topic: str) -> bool:
+        """Adds fields of Home Assistant component, False if component is not supported."""
         # if inverse:
         #     _payload_on = '0'
         #     _payload_off = '1'
@@ -288,10 +566,9 @@ class HomeAssistant:
                 'command_topic': f"{control_topic}/on",
             })
         else:
-            logger.warning(f"No algorithm for hass type '{control.type.name}', hass: '{hass_entity_type}', {device}")
-            return None
+            return False
 
-        return hass_entity_type
+        return True
 
     def publish_availability(self, device: WirenDevice, control: WirenControl):
         self._publish_availability_sync(device, control)
@@ -301,12 +578,43 @@ class HomeAssistant:
             return
         if self._ha_customizer.is_ignored_control(format_entity_id(device.device_id, control.id)):
             return
+        if self._availability_mode == AVAILABILITY_MODE_DEVICE:
+            self._update_device_availability(device, control)
+            return
         topic = self._get_availability_topic(device, control)
         payload = '1' if not control.error else '0'
         logger.info(f"[{device.debug_id}/{control.debug_id}] availability: {'online' if control.state else 'offline'}")
         self._router.publish(topic, payload, qos=self._availability_qos, retain=self._availability_retain)
 
+    def _update_device_availability(self, device: WirenDevice, control: WirenControl):
+        if mappers.wiren_to_hass_type(control) is None:
+            # control without entity in Home Assistant does not affect availability of device
+            return
+        ha_device_id, _ = self._get_ha_device(device, control)
+        self._availability_members.setdefault(ha_device_id, {})[format_entity_id(device.device_id, control.id)] = not control.error
+        if ha_device_id not in self._published_availability or not self._availability_debounce:
+            # First availability goes together with config without delay
+            self._publish_device_availability_sync(ha_device_id)
+            return
+        # Errors which are cleared during debounce interval (flapping bus) are not published at all
+        async def publish_device_availability():
+            await asyncio.sleep(self._availability_debounce)
+            self._publish_device_availability_sync(ha_device_id)
+        self._run_task(f"availability_{ha_device_id}", publish_device_availability())
+
+    def _publish_device_availability_sync(self, ha_device_id: str):
+        payload = '1' if any(self._availability_members[ha_device_id].values()) else '0'
+        if self._published_availability.get(ha_device_id) == payload:
+            return
+        self._published_availability[ha_device_id] = payload
+        logger.info(f"[{ha_device_id}] availability: {'online' if payload == '1' else 'offline'}")
+        self._router.publish(self._get_device_availability_topic(ha_device_id), payload, qos=self._availability_qos, retain=self._availability_retain)
+
     def publish_control_state(self, device: WirenDevice, control: WirenControl):
+        if self._optimistic_states and not self._confirm_optimistic_state(device, control):
+            # Echoed state must be replaced even within ratelimit interval
+            self._publish_control_state_sync(device, control)
+            return
         if self._ratelimiter.get(control.id, 0) + self._ratelimit_intervals.get(control.id, 0) > time.time():
             return
         self._run_task(f"publish_state_{control.id}", self._publish_control_state(device, control))
@@ -323,9 +631,65 @@ class HomeAssistant:
         if control.state is None:
             logger.debug(f"[{control}] state is None, skip publishing")
             return
-        self._router.publish(target_topic, control.state, qos=self._state_qos, retain=self._state_retain)
+        qos = self._qos_policy.state_qos(device, control) if self._qos_policy is not None else self._state_qos
+        self._router.publish(target_topic, control.state, qos=qos, retain=self._state_retain)
         self._ratelimiter[control.id] = time.time()
 
+    def publish_control_state_now(self, device: WirenDevice, control: WirenControl):
+        """Publishes state bypassing ratelimit, for callers which limit rate of states themselves."""
+        self._publish_control_state_sync(device, control)
+
+    def publish_derived_states(self, device: WirenDevice, control: WirenControl, states: dict[str, str]):
+        """
+        Publishes sensors derived from sensor control, e.g. aggregates over time window.
+        Key of `states` is suffix of entity id and state topic of derived sensor, config is published when changed.
+        """
+        config = self._render_control_config(device, control)
+        if config is None:
+            return
+        topic, data = config
+        # homeassistant/{component}/{node_id}/{object_id}/config
+        if topic.split('/')[1] != mappers.HassControlType.sensor.value:
+            logger.warning(f"derived states are supported for sensors only, {control}")
+            return
+        # Derived configs are built again only when config of control is changed
+        cached = self._derived_configs.get(topic)
+        if cached is None or cached[0] != data or not states.keys() <= cached[1].keys():
+            cached = self._derived_configs[topic] = (data, self._build_derived_configs(device, control, list(states)))
+        derived_configs = cached[1]
+        control_topic = self._get_control_topic(device, control)
+        published = self._published_derived_configs.setdefault(topic, {})
+        for suffix, state in states.items():
+            derived_topic, derived_data = derived_configs[suffix]
+            if published.get(derived_topic) != derived_data:
+                published[derived_topic] = derived_data
+                self._router.publish(derived_topic, derived_data, qos=self._config_qos, retain=self._config_retain)
+            self._router.publish(f"{control_topic}/{suffix}", state, qos=self._state_qos, retain=self._state_retain)
+
+    def render_derived_configs(self, device: WirenDevice, control: WirenControl, suffixes: list[str]) -> dict[str, str]:
+        """Discovery topic -> serialized config of every sensor derived from control, nothing is published."""
+        config = self._render_control_config(device, control)
+        if config is None or config[0].split('/')[1] != mappers.HassControlType.sensor.value:
+            return {}
+        return dict(self._build_derived_configs(device, control, suffixes).values())
+
+    def _build_derived_configs(self, device: WirenDevice, control: WirenControl, suffixes: list[str]) -> dict[str, tuple[str, str]]:
+        config = self._build_control_config(device, control)
+        if config is None:
+            return {}
+        topic, payload = config
+        # homeassistant/{component}/{node_id}/{object_id}/config
+        _, component, node_id, object_id, _ = topic.split('/')
+        control_topic = self._get_control_topic(device, control)
+        derived_configs = {}
+        for suffix in suffixes:
+            derived_payload = dict(payload)
+            derived_payload['name'] = f"{payload['name']} {suffix.title()}"
+            derived_payload['unique_id'] = f"{payload['unique_id']}_{suffix}"
+            derived_payload['state_topic'] = f"{control_topic}/{suffix}"
+            derived_configs[suffix] = (f"homeassistant/{component}/{node_id}/{object_id}_{suffix}/config", json_backend.dumps(derived_payload))
+        return derived_configs
+
     def _ha_status_topic_handler(self, topic: str, payload: bytes):
         if payload == b'online':
             logger.info('Home assistant changed status to online. Pushing all devices')
@@ -334,15 +698,78 @@ class HomeAssistant:
             logger.info('Home assistant changed status to offline')
 
     def _control_set_state_topic_handler(self, topic: str, payload: bytes):
-        match = self._control_command_topic_re.match(topic)
-        if not match:
-            logger.warning(f'not matched topic={topic} re={self._control_command_topic_re}')
+        # /devices/{device}/controls/{control}/on, split is cheaper than regex on the command path
+        parts = topic.split('/')
+        if len(parts) != 6 or parts[3] != 'controls' or parts[5] != 'on':
+            logger.warning(f'not matched command topic={topic}')
             return
-        device_id, control_id, control_state = match.group(1), match.group(2), payload.decode('utf-8')
+        device_id, control_id, control_state = parts[2], parts[4], payload.decode('utf-8')
         self.on_control_set_state(device_id, control_id, control_state)
+        if self._optimistic_switch_timeout > 0:
+            self._echo_optimistic_state(device_id, control_id, control_state)
+
+    def _echo_optimistic_state(self, device_id: str, control_id: str, control_state: str):
+        """
+        Publishes commanded state of switch to Home Assistant without waiting for Wiren Board.
+        If Wiren Board does not report the same state within timeout, the last reported state is published back.
+        """
+        device = self._registry.devices().get(device_id)
+        control = device.controls.get(control_id) if device is not None else None
+        if control is None or control.type != mappers.WirenControlType.switch:
+            return
+        if control.state is None:
+            # Echoed state could not be rolled back
+            return
+        if self._ha_customizer.is_ignored_device(prepare_ha_identifier(device.device_id)):
+            return
+        if self._ha_customizer.is_ignored_control(format_entity_id(device.device_id, control.id)):
+            return
+        topic = self._get_control_topic(device, control)
+        pending = self._optimistic_states.get(topic)
+        if pending is not None:
+            pending[1].cancel()
+        timer = asyncio.get_running_loop().call_later(self._optimistic_switch_timeout, self._rollback_optimistic_state, device, control)
+        self._optimistic_states[topic] = (control_state, timer)
+        self._router.publish(topic, control_state, qos=self._state_qos, retain=self._state_retain)
+        self._metrics.inc('optimistic_states')
+
+    def _confirm_optimistic_state(self, device: WirenDevice, control: WirenControl) -> bool:
+        """False if reported state differs from echoed one."""
+        pending = self._optimistic_states.pop(self._get_control_topic(device, control), None)
+        if pending is None:
+            return True
+        control_state, timer = pending
+        timer.cancel()
+        if control.state == control_state:
+            self._metrics.inc('optimistic_confirmed')
+            return True
+        self._metrics.inc('optimistic_rolled_back')
+        return False
+
+    def _rollback_optimistic_state(self, device: WirenDevice, control: WirenControl):
+        topic = self._get_control_topic(device, control)
+        control_state, _ = self._optimistic_states.pop(topic)
+        if control.state == control_state:
+            # Command did not change state, e.g. switch was already on
+            self._metrics.inc('optimistic_confirmed')
+            return
+        logger.info(f"[{control}] state {control_state} is not confirmed by Wiren Board, rolling back to {control.state}")
+        self._metrics.inc('optimistic_rolled_back')
+        self._publish_control_state_sync(device, control)
 
 def prepare_ha_identifier(name: str) -> str:
     return name.lower().replace(" ", "_").replace("-", "_")
 
 def format_entity_id(device_id: str, control_id: str) -> str:
     return prepare_ha_identifier(f"{device_id}_{control_id}")
+
+def build_customizer(cfg: dict) -> HomeAssistantDiscoveryCustomizer:
+    """Customizer of validated config, see config.load_config."""
+    return HomeAssistantDiscoveryCustomizer(
+        splitted_device_ids=cfg["homeassistant.splitted_device_ids"],
+        combined_devices=cfg["homeassistant.combined_devices"],
+        ignored_device_ids=cfg["homeassistant.ignored_device_ids"],
+        ignored_device_control_ids=cfg["homeassistant.ignored_device_control_ids"],
+        enable_default_combined_devices=cfg["homeassistant.enable_default_combined_devices"],
+        device_id_prefixes=[cfg["wirenboard"]["device_id_prefix"]] + [e["device_id_prefix"] for e in cfg["wirenboard.extra_brokers"]],
+    )
@@ -0,0 +1,45 @@
+"""
+JSON backend of discovery payloads and recorded MQTT messages.
+
+`loads` uses orjson when it is installed, parsed values of standard JSON are the same as with stdlib json.
+`dumps` uses stdlib json by default: its output (`", "` and `": "` separators, escaped non-ASCII characters)
+is what Home Assistant already has in retained configs and what golden files contain. orjson output is compact
+and not byte-identical, so it is used only when selected explicitly with `set_backend(BACKEND_ORJSON)`.
+"""
+import json
+import json.encoder
+import logging
+from typing import Any, Callable
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore[assignment]
+
+logger = logging.getLogger(__name__)
+
+BACKEND_JSON = 'json'
+BACKEND_ORJSON = 'orjson'
+
+def _orjson_dumps(obj: Any) -> str:
+    return orjson.dumps(obj).decode('utf-8')
+
+# json.dumps with default arguments goes to the same encoder, without checking arguments on every call
+_json_dumps: Callable[[Any], str] = json.JSONEncoder().encode
+
+dumps: Callable[[Any], str] = _json_dumps
+# Serialized string with quotes, the same as `dumps` produces for string inside of any object
+dumps_str: Callable[[str], str] = json.encoder.encode_basestring_ascii
+loads: Callable[[str | bytes], Any] = orjson.loads if orjson is not None else json.loads
+
+def set_backend(backend: str):
+    """Selects serializer of `dumps`, falls back to stdlib json when orjson is not installed."""
+    global dumps, dumps_str
+    if backend == BACKEND_ORJSON and orjson is None:
+        logger.warning("orjson is not installed, stdlib json is used")
+        backend = BACKEND_JSON
+    dumps = _orjson_dumps if backend == BACKEND_ORJSON else _json_dumps
+    dumps_str = _orjson_dumps if backend == BACKEND_ORJSON else json.encoder.encode_basestring_ascii
+
+def backend() -> str:
+    return BACKEND_ORJSON if dumps is _orjson_dumps else BACKEND_JSON
@@ -0,0 +1,213 @@
+"""
+Active/standby mode of several instances connected to the same brokers.
+
+Leader publishes retained lease with its instance id and TTL to Home Assistant broker every heartbeat interval.
+Standby instances process all Wiren Board messages as usual, so their registries are warm, but their
+publishes are dropped by `GatedMQTTClient`. When lease of leader is not renewed during TTL, standby becomes leader.
+If two instances are leaders at the same time, instance with lower id stays leader.
+
+Standby keeps retained messages dropped after previous lease heartbeat, because leader could have died before
+publishing them. They are published on promotion, other messages were already published by leader,
+so failover does not republish all configs.
+"""
+import asyncio
+import json
+import logging
+import time
+from typing import Callable
+
+from wb_to_ha.mqtt.mqtt_router import IMQTTClient, MQTTRouter
+
+logger = logging.getLogger(__name__)
+
+class GatedMQTTClient:
+    """MQTT client wrapper which publishes only when instance is leader."""
+    _client: IMQTTClient
+    _lease: 'LeaderLease'
+    _replay: bool
+    # topic -> payload, qos, retain, monotonic time of drop
+    _dropped: dict[str, tuple[str, int, bool, float]]
+    _prev_heartbeat: float
+
+    def __init__(self, client: IMQTTClient, lease: 'LeaderLease', replay: bool):
+        self._client = client
+        self._lease = lease
+        self._replay = replay
+        self._dropped = {}
+        self._prev_heartbeat = float('-inf')
+
+    @property
+    def on_message(self) -> Callable:
+        return self._client.on_message
+
+    @on_message.setter
+    def on_message(self, value: Callable):
+        self._client.on_message = value
+
+    @property
+    def on_connect(self) -> Callable:
+        return self._client.on_connect
+
+    @on_connect.setter
+    def on_connect(self, value: Callable):
+        self._client.on_connect = value
+
+    @property
+    def on_disconnect(self) -> Callable:
+        return self._client.on_disconnect
+
+    @on_disconnect.setter
+    def on_disconnect(self, value: Callable):
+        self._client.on_disconnect = value
+
+    def subscribe(self, topic: str, qos: int = 0):
+        self._client.subscribe(topic, qos=qos)
+
+    def publish(self, topic: str, payload: str, qos: int = 0, retain: bool = False):
+        if self._lease.is_leader:
+            self._client.publish(topic, payload, qos=qos, retain=retain)
+        elif self._replay and retain:
+            # keep dict ordered by drop time
+            self._dropped.pop(topic, None)
+            self._dropped[topic] = (payload, qos, retain, time.monotonic())
+
+    async def connect(self, *args, **kwargs):
+        await self._client.connect(*args, **kwargs)
+
+    async def disconnect(self):
+        await self._client.disconnect()
+
+    def on_leader_heartbeat(self, now: float):
+        # Messages dropped before previous heartbeat are published by leader: it handles the same messages
+        # and its publishes reach broker before its next heartbeat.
+        while self._dropped:
+            topic, (_, _, _, dropped_at) = next(iter(self._dropped.items()))
+            if dropped_at >= self._prev_heartbeat:
+                break
+            del self._dropped[topic]
+        self._prev_heartbeat = now
+
+    def replay(self) -> int:
+        dropped, self._dropped = self._dropped, {}
+        for topic, (payload, qos, retain, _) in dropped.items():
+            self._client.publish(topic, payload, qos=qos, retain=retain)
+        return len(dropped)
+
+class LeaderLease:
+    _instance_id: str
+    _topic: str
+    _ttl: float
+    _heartbeat_interval: float
+    _qos: int
+    _is_leader: bool
+    _gates: list[GatedMQTTClient]
+    _router: MQTTRouter | None
+    # monotonic time and TTL of last lease of other leader
+    _last_seen: float
+    _leader_ttl: float
+    _stopping: asyncio.Event
+    # set to check lease before end of sleep, on stop and when leader released lease
+    _wakeup: asyncio.Event
+
+    def __init__(self,
+                 instance_id: str,
+                 topic: str = 'wb_to_ha/leader',
+                 ttl: float = 1,
+                 heartbeat_interval: float = 0.25,
+                 qos: int = 1,
+                 ):
+        assert heartbeat_interval < ttl
+        self._instance_id = instance_id
+        self._topic = topic
+        self._ttl = ttl
+        self._heartbeat_interval = heartbeat_interval
+        self._qos = qos
+        self._is_leader = False
+        self._gates = []
+        self._router = None
+        self._last_seen = time.monotonic()
+        self._leader_ttl = ttl
+        self._stopping = asyncio.Event()
+        self._wakeup = asyncio.Event()
+
+    @property
+    def is_leader(self) -> bool:
+        return self._is_leader
+
+    @property
+    def instance_id(self) -> str:
+        return self._instance_id
+
+    def gate(self, client: IMQTTClient, replay: bool) -> GatedMQTTClient:
+        """Wraps client of this instance. Retained messages of clients with replay are published on promotion."""
+        gate = GatedMQTTClient(client, self, replay)
+        self._gates.append(gate)
+        return gate
+
+    def on_connect(self, router: MQTTRouter):
+        """Should be called on connection to Home Assistant broker, router publishes through gated client."""
+        self._router = router
+        router.subscribe(self._topic, self._lease_topic_handler, qos=self._qos)
+
+    def _lease_topic_handler(self, topic: str, payload: bytes):
+        if not payload:
+            return
+        try:
+            lease = json.loads(payload)
+            instance_id, ttl = str(lease['instance']), float(lease['ttl'])
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"invalid lease payload={payload!r}: {e}")
+            return
+        if instance_id == self._instance_id:
+            return
+        if self._is_leader:
+            if ttl == 0 or instance_id > self._instance_id:
+                # other instance steps down when receives our lease
+                return
+            logger.warning(f"[{self._instance_id}] instance {instance_id} is leader too, stepping down")
+            self._is_leader = False
+        now = time.monotonic()
+        self._last_seen = now
+        self._leader_ttl = ttl
+        for gate in self._gates:
+            gate.on_leader_heartbeat(now)
+        if ttl == 0:
+            self._wakeup.set()
+
+    def _publish_lease(self, ttl: float):
+        if self._router is not None:
+            # Lease waiting behind states in publish queue would expire while leader is alive
+            self._router.publish_now(self._topic, json.dumps({'instance': self._instance_id, 'ttl': ttl}), qos=self._qos, retain=True)
+
+    def _promote(self):
+        self._is_leader = True
+        self._publish_lease(self._ttl)
+        replayed = sum(gate.replay() for gate in self._gates)
+        logger.warning(f"[{self._instance_id}] became leader, republished {replayed} messages")
+
+    async def run(self):
+        self._last_seen = time.monotonic()
+        while not self._stopping.is_set():
+            timeout = self._heartbeat_interval
+            if self._is_leader:
+                self._publish_lease(self._ttl)
+            elif self._router is not None:
+                expires_in = self._last_seen + self._leader_ttl - time.monotonic()
+                if expires_in <= 0:
+                    self._promote()
+                else:
+                    # Standby wakes up when the last seen lease expires, lease renewed meanwhile is checked again
+                    timeout = expires_in
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def stop(self):
+        if self._is_leader:
+            # Lease with zero TTL lets standby take over without waiting for expiration
+            self._publish_lease(0)
+            self._is_leader = False
+        self._stopping.set()
+        self._wakeup.set()
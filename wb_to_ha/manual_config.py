@@ -1,70 +1,242 @@
-import json
+import asyncio
+import bisect
+from collections import deque
 import logging
 import re
-from typing import Any
-import yaml
+from typing import Any, Callable
 
-logger = logging.getLogger(__name__)
-
-# A lot of strange hacks to make yaml output expected.
-# https://stackoverflow.com/questions/47542343/how-to-print-a-value-with-double-quotes-and-spaces-in-yaml
+from wb_to_ha import json_backend, yaml_emitter
 
-# Hack for double quotes for values in yaml.
-_yaml_cached_dict_keys: set[str] = set()
+logger = logging.getLogger(__name__)
 
-def mk_double_quote(dumper, data):
-    if data in _yaml_cached_dict_keys:
-        return dumper.represent_scalar('tag:yaml.org,2002:str', data, style='')
-    else:
-        return dumper.represent_scalar('tag:yaml.org,2002:str', data, style='"')
+class ManualConfigEntity:
+    topic: str
+    payload: str
+    device_type: str
+    # Home Assistant device id (node_id of discovery topic)
+    device_id: str
+    unique_id: str
+    msg: dict[str, Any]
+    _yaml: str | None
 
-yaml.add_representer(str, mk_double_quote)
+    def __init__(self, topic: str, payload: str, device_type: str, device_id: str, msg: dict[str, Any]):
+        self.topic = topic
+        self.payload = payload
+        self.device_type = device_type
+        self.device_id = device_id
+        self.unique_id = msg['unique_id']
+        self.msg = msg
+        self._yaml = None
 
-def update_yaml_cached_dict_keys(msg: dict[str, Any]):
-    _yaml_cached_dict_keys.update(msg.keys())
-    for v in msg.values():
-        if isinstance(v, dict):
-            update_yaml_cached_dict_keys(v)
-        elif isinstance(v, list):
-            for item in v:
-                if isinstance(item, dict):
-                    update_yaml_cached_dict_keys(item)
+    @property
+    def yaml(self) -> str:
+        """Entity block exactly as it is placed in the full document, under `mqtt:` and `<device_type>:` lines."""
+        if self._yaml is None:
+            rendered = dict_to_yaml({"mqtt": {self.device_type: [self.msg]}})
+            self._yaml = rendered.split('\n', 2)[2]
+        return self._yaml
 
-# Hack to increase indent for lists.
-class IndentDumper(yaml.Dumper):
-    def increase_indent(self, flow=False, indentless=False):
-        return super(IndentDumper, self).increase_indent(flow, False)
+    @property
+    def is_rendered(self) -> bool:
+        return self._yaml is not None
 
 class ManualConfigService:
+    """
+    Keeps Home Assistant manual MQTT config document in sync with published discovery config topics.
+
+    Document is updated incrementally with `on_mqtt_message`. Each entity block is rendered once and cached,
+    full document is joined from blocks and cached until next change.
+    """
     _config_topic_re = re.compile(r'^homeassistant/([^/]+)/([^/]+)/([^/]+)/config$')
     _availability_topic_re = re.compile(r'^(.+)/controls/([^/]+)/availability$')
 
+    # device_type -> entities sorted by unique_id
+    _device_types: dict[str, list[ManualConfigEntity]]
+    _topics: dict[str, ManualConfigEntity]
+    # device_id -> entities of device
+    _devices: dict[str, dict[str, ManualConfigEntity]]
+    _version: int
+    # (version, topic, device_type) of last changes, used to send only changed entities to clients
+    _changelog: deque[tuple[int, str, str]]
+    _change_listeners: list[Callable[[], None]]
+    _rendered_yaml: str | None
+    _rendered_version: int
+
+    def __init__(self, changelog_size: int = 10000):
+        self._device_types = {}
+        self._topics = {}
+        self._devices = {}
+        self._version = 0
+        self._changelog = deque(maxlen=changelog_size)
+        self._change_listeners = []
+        self._rendered_yaml = None
+        self._rendered_version = -1
+
+    @property
+    def version(self) -> int:
+        """Incremented on every change of the document."""
+        return self._version
+
+    def add_change_listener(self, listener: Callable[[], None]):
+        self._change_listeners.append(listener)
+
+    def on_mqtt_message(self, topic: str, payload: str) -> bool:
+        """Applies published message to the document. Returns True if document was changed."""
+        match = self._config_topic_re.match(topic)
+        if not match:
+            return False
+        prev = self._topics.get(topic)
+        if prev is not None and prev.payload == payload:
+            return False
+        device_type = match.group(1)
+        entity = None
+        if payload:
+            try:
+                msg = self._preprocess_for_manual_config(device_type, json_backend.loads(payload))
+                entity = ManualConfigEntity(topic, payload, device_type, match.group(2), msg)
+            except (ValueError, KeyError) as e:
+                logger.warning(f'invalid config message topic={topic}: {e}')
+                return False
+        elif prev is None:
+            return False
+        if prev is not None:
+            self._remove_entity(prev)
+            del self._topics[topic]
+        if entity is not None:
+            # keep sorted by unique_id to make output deterministic
+            bisect.insort(self._device_types.setdefault(device_type, []), entity, key=_unique_id_key)
+            self._devices.setdefault(entity.device_id, {})[topic] = entity
+            self._topics[topic] = entity
+        self._version += 1
+        self._changelog.append((self._version, topic, device_type))
+        for listener in self._change_listeners:
+            listener()
+        return True
+
+    def _remove_entity(self, entity: ManualConfigEntity):
+        entities = self._device_types[entity.device_type]
+        i = bisect.bisect_left(entities, entity.unique_id, key=_unique_id_key)
+        while entities[i] is not entity:
+            i += 1
+        del entities[i]
+        if not entities:
+            del self._device_types[entity.device_type]
+        device_entities = self._devices[entity.device_id]
+        del device_entities[entity.topic]
+        if not device_entities:
+            del self._devices[entity.device_id]
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "mqtt": {device_type: [e.msg for e in entities] for device_type, entities in self._device_types.items()},
+        }
+
+    def to_yaml(self) -> str:
+        if self._rendered_yaml is None or self._rendered_version != self._version:
+            self._rendered_yaml = _render(self._device_types)
+            self._rendered_version = self._version
+        return self._rendered_yaml
+
+    async def render_yaml(self,
+                          executor_threshold: int,
+                          device_ids: list[str] | None = None,
+                          device_types: list[str] | None = None,
+                          unique_id_prefix: str | None = None,
+        ) -> str:
+        """
+        Full or filtered document like `to_yaml` and `filtered_yaml`. When at least `executor_threshold` entity blocks
+        are not rendered yet, document is rendered in default executor, so event loop is not blocked.
+        Entities are selected on event loop, changes made during rendering get into the next version.
+        """
+        is_full = device_ids is None and device_types is None and not unique_id_prefix
+        if is_full and self._rendered_yaml is not None and self._rendered_version == self._version:
+            return self._rendered_yaml
+        version = self._version
+        # lists of filter are copies, so they are not changed by messages received during rendering
+        entities = self.filter(device_ids, device_types, unique_id_prefix)
+        not_rendered = sum(1 for type_entities in entities.values() for e in type_entities if not e.is_rendered)
+        if not_rendered < executor_threshold:
+            text = _render(entities)
+        else:
+            text = await asyncio.get_running_loop().run_in_executor(None, _render, entities)
+        if is_full and version == self._version:
+            self._rendered_yaml = text
+            self._rendered_version = version
+        return text
+
+    def devices(self) -> dict[str, int]:
+        """Device ids with number of entities."""
+        return {device_id: len(entities) for device_id, entities in sorted(self._devices.items())}
+
+    def filter(self,
+               device_ids: list[str] | None = None,
+               device_types: list[str] | None = None,
+               unique_id_prefix: str | None = None,
+        ) -> dict[str, list[ManualConfigEntity]]:
+        """
+        Entities matching all given filters grouped by device_type and sorted by unique_id.
+        Uses device index when device ids are given and bisect over sorted lists otherwise, so whole document is not scanned.
+        """
+        if device_ids is not None:
+            result: dict[str, list[ManualConfigEntity]] = {}
+            for device_id in device_ids:
+                for entity in self._devices.get(device_id, {}).values():
+                    if device_types is not None and entity.device_type not in device_types:
+                        continue
+                    if unique_id_prefix and not entity.unique_id.startswith(unique_id_prefix):
+                        continue
+                    result.setdefault(entity.device_type, []).append(entity)
+            for entities in result.values():
+                entities.sort(key=_unique_id_key)
+            return result
+        result = {}
+        for device_type in (device_types if device_types is not None else self._device_types.keys()):
+            sorted_entities = self._device_types.get(device_type, [])
+            start, end = 0, len(sorted_entities)
+            if unique_id_prefix:
+                start = bisect.bisect_left(sorted_entities, unique_id_prefix, key=_unique_id_key)
+                # every string with the prefix is less than prefix + max code point
+                end = bisect.bisect_left(sorted_entities, unique_id_prefix + '\U0010FFFF', key=_unique_id_key)
+            if start < end:
+                result[device_type] = sorted_entities[start:end]
+        return result
+
+    def filtered_yaml(self,
+                      device_ids: list[str] | None = None,
+                      device_types: list[str] | None = None,
+                      unique_id_prefix: str | None = None,
+        ) -> str:
+        return _render(self.filter(device_ids, device_types, unique_id_prefix))
+
+    def snapshot(self) -> list[dict[str, Any]]:
+        """All entity blocks in document order."""
+        return [_entity_change(e.topic, e.device_type, e) for device_type in sorted(self._device_types) for e in self._device_types[device_type]]
+
+    def changes_since(self, version: int) -> list[dict[str, Any]] | None:
+        """
+        Entity blocks changed after given version; removed entities have `yaml` set to None.
+        Returns None when version is too old and client should take full snapshot.
+        """
+        if version == self._version:
+            return []
+        if version > self._version or not self._changelog or self._changelog[0][0] > version + 1:
+            return None
+        changed: dict[str, str] = {}
+        for v, topic, device_type in reversed(self._changelog):
+            if v <= version:
+                break
+            changed.setdefault(topic, device_type)
+        return [_entity_change(topic, device_type, self._topics.get(topic)) for topic, device_type in reversed(changed.items())]
+
     def convert_mqtt_topics_messages_to_manual_config(
         self,
         topics_messages: dict[str, str],
     ) -> dict[str, Any]:
-        device_types = {}
+        """Builds document from scratch, current state of the service is not used."""
+        doc = ManualConfigService(changelog_size=0)
         for topic, message in topics_messages.items():
-            match = self._config_topic_re.match(topic)
-            if not match:
-                continue
-            device_type = match.group(1)
-            if device_type not in device_types:
-                device_types[device_type] = []
-            msg = json.loads(message)
-            msg = self._preprocess_for_manual_config(device_type, msg)
-
-            update_yaml_cached_dict_keys(msg)
-            # sort by unique_id to make output deterministic
-            prev_entities = device_types[device_type]
-            prev_entities.append(msg)
-            prev_entities.sort(key=lambda x: x['unique_id'])
-            device_types[device_type] = prev_entities
-        result = {
-            "mqtt": device_types,
-        }
-        update_yaml_cached_dict_keys(result)
-        return result
+            doc.on_mqtt_message(topic, message)
+        return doc.to_dict()
 
     def _preprocess_for_manual_config(self, device_type: str, msg: dict[str, Any]) -> dict[str, Any]:
         if device_type in ['button', 'switch']:
@@ -75,6 +247,26 @@ class ManualConfigService:
         del msg['payload_not_available']
         return msg
 
+def _render(device_types: dict[str, list[ManualConfigEntity]]) -> str:
+    if not device_types:
+        return dict_to_yaml({"mqtt": {}})
+    parts = ["mqtt:\n"]
+    # yaml.dump sorts mapping keys
+    for device_type in sorted(device_types):
+        parts.append(f"  {device_type}:\n")
+        parts.extend(e.yaml for e in device_types[device_type])
+    return ''.join(parts)
+
+def _unique_id_key(entity: ManualConfigEntity) -> str:
+    return entity.unique_id
+
+def _entity_change(topic: str, device_type: str, entity: ManualConfigEntity | None) -> dict[str, Any]:
+    return {
+        'topic': topic,
+        'component': device_type,
+        'unique_id': entity.unique_id if entity is not None else None,
+        'yaml': entity.yaml if entity is not None else None,
+    }
+
 def dict_to_yaml(d: dict[str, Any]) -> str:
-    update_yaml_cached_dict_keys(d)
-    return yaml.dump(d, allow_unicode=True, Dumper=IndentDumper)
\ No newline at end of file
+    return yaml_emitter.dump(d)
@@ -57,6 +57,15 @@ WIREN_UNITS_DICT = {
     WirenControlType.current: 'A',
 }
 
+# Types with numeric state, their state is parsed to WirenControl.value on ingestion.
+# Switch and alarm states are 0 or 1.
+WIREN_NUMERIC_TYPES = {
+    WirenControlType.switch,
+    WirenControlType.alarm,
+    WirenControlType.range,
+    WirenControlType.value,
+} | set(WIREN_UNITS_DICT)
+
 @unique
 class HassControlType(Enum):
     binary_sensor = "binary_sensor"
@@ -0,0 +1,61 @@
+class Summary:
+    """Count, sum and maximum of observed values, e.g. latencies in seconds."""
+    __slots__ = ('count', 'sum', 'max')
+
+    count: int
+    sum: float
+    max: float
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def to_dict(self) -> dict[str, float]:
+        return {'count': self.count, 'mean': self.sum / self.count if self.count else 0.0, 'max': self.max}
+
+class Metrics:
+    """Named counters, gauges and summaries of the bridge, e.g. how many publishes were avoided by debouncing."""
+    _counters: dict[str, int]
+    # current values, e.g. depth of queue
+    _gauges: dict[str, int]
+    _summaries: dict[str, Summary]
+
+    def __init__(self):
+        self._counters = {}
+        self._gauges = {}
+        self._summaries = {}
+
+    def inc(self, name: str, value: int = 1):
+        self._counters[name] = self._counters.get(name, 0) + value
+
+    def get(self, name: str) -> int:
+        return self._counters.get(name, 0)
+
+    def set(self, name: str, value: int):
+        self._gauges[name] = value
+
+    def gauge(self, name: str) -> int:
+        return self._gauges.get(name, 0)
+
+    def observe(self, name: str, value: float):
+        summary = self._summaries.get(name)
+        if summary is None:
+            summary = self._summaries[name] = Summary()
+        summary.observe(value)
+
+    def summary(self, name: str) -> Summary:
+        return self._summaries.get(name) or Summary()
+
+    def snapshot(self) -> dict[str, int | dict[str, float]]:
+        result: dict[str, int | dict[str, float]] = {}
+        result.update(self._counters)
+        result.update(self._gauges)
+        result.update({name: summary.to_dict() for name, summary in self._summaries.items()})
+        return dict(sorted(result.items()))
@@ -5,17 +5,39 @@ from typing import Callable
 import re
 import logging
 
+from wb_to_ha.mqtt.topics import TOPIC_CLASS_AVAILABILITY, TOPIC_CLASS_CONFIG, TOPIC_CLASS_STATE, topic_class
+
 logger = logging.getLogger(__name__)
 
 class InmemMQTTClient:
+    """
+    MQTT client which keeps last published message of every topic in memory.
+
+    Retention is configured per topic class (config, availability, state):
+    None - keep every topic, 0 - do not keep topics of the class, N - keep N most recently published topics.
+    Publish listeners and on_message are called for every message regardless of retention.
+    """
     on_message: Callable | None
     on_disconnect: Callable | None
     on_connect: Callable | None
 
-    _last_messages: dict[str, str]
+    _retention: dict[str, int | None]
+    # topic class -> topic -> payload
+    _messages: dict[str, dict[str, str]]
+    # topic class -> sum of UTF-8 sizes of topics and payloads
+    _sizes: dict[str, int]
+    _publish_listeners: list[Callable[[str, str], None]]
 
-    def __init__(self):
-        self._last_messages = {}
+    def __init__(self, retention: dict[str, int | None] = {}):
+        self._retention = {
+            TOPIC_CLASS_CONFIG: None,
+            TOPIC_CLASS_AVAILABILITY: None,
+            TOPIC_CLASS_STATE: None,
+        }
+        self._retention.update(retention)
+        self._messages = {c: {} for c in self._retention}
+        self._sizes = {c: 0 for c in self._retention}
+        self._publish_listeners = []
         self.on_disconnect = None
         self.on_connect = None
         self.on_message = None
@@ -25,10 +47,32 @@ class InmemMQTTClient:
         pass
 
     def publish(self, topic: str, payload: str, qos: int = 0, retain: bool = False):
-        self._last_messages[topic] = payload
+        self._store(topic, payload)
+        for listener in self._publish_listeners:
+            listener(topic, payload)
         if self.on_message is not None:
             self.on_message(self, topic, payload, qos, retain)
 
+    def _store(self, topic: str, payload: str):
+        cls = topic_class(topic)
+        limit = self._retention[cls]
+        if limit == 0:
+            return
+        messages = self._messages[cls]
+        # capped classes are ordered by last publish, so the oldest topic is evicted first
+        prev = messages.get(topic) if limit is None else messages.pop(topic, None)
+        if prev is not None:
+            self._sizes[cls] -= _size(topic, prev)
+        messages[topic] = payload
+        self._sizes[cls] += _size(topic, payload)
+        if limit is not None and len(messages) > limit:
+            oldest = next(iter(messages))
+            self._sizes[cls] -= _size(oldest, messages.pop(oldest))
+
+    def add_publish_listener(self, listener: Callable[[str, str], None]):
+        """Listener is called with topic and payload of every published message."""
+        self._publish_listeners.append(listener)
+
     async def connect(self, *args, **kwargs):
         if self.on_connect is not None:
             self.on_connect(self)
@@ -39,4 +83,14 @@ class InmemMQTTClient:
 
     @property
     def last_messages(self) -> dict[str, str]:
-        return self._last_messages
+        result: dict[str, str] = {}
+        for messages in self._messages.values():
+            result.update(messages)
+        return result
+
+    def footprint(self) -> dict[str, dict[str, int]]:
+        """Number of kept topics and bytes of their topics and payloads in UTF-8 per topic class."""
+        return {cls: {'topics': len(messages), 'bytes': self._sizes[cls]} for cls, messages in self._messages.items()}
+
+def _size(topic: str, payload: str) -> int:
+    return len(topic.encode('utf-8')) + len(payload.encode('utf-8'))
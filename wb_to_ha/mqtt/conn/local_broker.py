@@ -0,0 +1,123 @@
+import asyncio
+import re
+import threading
+from typing import Callable
+import logging
+
+logger = logging.getLogger(__name__)
+
+class LocalBroker:
+    """
+    In-process stand-in of MQTT broker for tests: wildcard subscriptions and retained messages.
+    Clients can run in different threads with their own event loops, messages are delivered
+    asynchronously in event loop of subscriber.
+    """
+    _lock: threading.Lock
+    _retained: dict[str, bytes]
+    _clients: list['LocalBrokerClient']
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._retained = {}
+        self._clients = []
+
+    def client(self, client_id: str) -> 'LocalBrokerClient':
+        return LocalBrokerClient(self, client_id)
+
+    @property
+    def retained(self) -> dict[str, str]:
+        with self._lock:
+            return {topic: payload.decode('utf-8') for topic, payload in self._retained.items()}
+
+    def publish(self, topic: str, payload: str | bytes, qos: int = 0, retain: bool = False):
+        data = payload.encode('utf-8') if isinstance(payload, str) else payload
+        with self._lock:
+            if retain:
+                if data:
+                    self._retained[topic] = data
+                else:
+                    self._retained.pop(topic, None)
+            subscribers = [c for c in self._clients if c.is_subscribed(topic)]
+        for client in subscribers:
+            client.deliver(topic, data)
+
+    def _connect(self, client: 'LocalBrokerClient'):
+        with self._lock:
+            if client not in self._clients:
+                self._clients.append(client)
+
+    def _disconnect(self, client: 'LocalBrokerClient'):
+        with self._lock:
+            if client in self._clients:
+                self._clients.remove(client)
+
+    def _subscribe(self, client: 'LocalBrokerClient', pattern: re.Pattern):
+        with self._lock:
+            retained = [(topic, payload) for topic, payload in self._retained.items() if pattern.match(topic)]
+        for topic, payload in retained:
+            client.deliver(topic, payload)
+
+class LocalBrokerClient:
+    on_message: Callable
+    on_disconnect: Callable | None
+    on_connect: Callable | None
+
+    client_id: str
+    # topics and payloads of all messages accepted by broker from this client
+    published: list[tuple[str, str]]
+    _broker: LocalBroker
+    _subscriptions: list[re.Pattern]
+    _loop: asyncio.AbstractEventLoop | None
+    _connected: bool
+
+    def __init__(self, broker: LocalBroker, client_id: str):
+        self.client_id = client_id
+        self.published = []
+        self._broker = broker
+        self._subscriptions = []
+        self._loop = None
+        self._connected = False
+        self.on_connect = None
+        self.on_disconnect = None
+
+    def subscribe(self, topic: str, qos: int = 0):
+        topic_pattern = topic.replace('+', '[^/]+').replace('#', '.+')
+        topic_regex = re.compile(f'^{topic_pattern}$')
+        self._subscriptions.append(topic_regex)
+        self._broker._subscribe(self, topic_regex)
+
+    def is_subscribed(self, topic: str) -> bool:
+        return any(s.match(topic) for s in self._subscriptions)
+
+    def publish(self, topic: str, payload: str, qos: int = 0, retain: bool = False):
+        if not self._connected:
+            return
+        self.published.append((topic, payload))
+        self._broker.publish(topic, payload, qos=qos, retain=retain)
+
+    def deliver(self, topic: str, payload: bytes):
+        if self._loop is not None and self._connected:
+            self._loop.call_soon_threadsafe(self._on_message, topic, payload)
+
+    def _on_message(self, topic: str, payload: bytes):
+        if self._connected:
+            self.on_message(self, topic, payload, 0, {})
+
+    async def connect(self, *args, **kwargs):
+        self._loop = asyncio.get_running_loop()
+        self._connected = True
+        self._subscriptions = []
+        self._broker._connect(self)
+        if self.on_connect is not None:
+            self.on_connect(self)
+
+    async def disconnect(self):
+        self._connected = False
+        self._broker._disconnect(self)
+        if self.on_disconnect is not None:
+            await self.on_disconnect(None, None)
+
+    def crash(self):
+        """Connection is lost without disconnect, like when host of client dies."""
+        self._connected = False
+        self._broker._disconnect(self)
@@ -1,10 +1,11 @@
 import asyncio
-import json
 import os
 from typing import Callable
 import re
 import logging
 
+from wb_to_ha import json_backend
+
 logger = logging.getLogger(__name__)
 
 class LocalMQTTClient:
@@ -37,7 +38,7 @@ class LocalMQTTClient:
         }
 
         with open(self._output_file, 'at') as f:
-            f.write(json.dumps(msg) + '\n')
+            f.write(json_backend.dumps(msg) + '\n')
 
     async def connect(self, *args, **kwargs):
         if self.on_connect is not None:
@@ -45,7 +46,7 @@ class LocalMQTTClient:
 
         with open(self._input_file) as f:
             for line in f:
-                msg = json.loads(line)
+                msg = json_backend.loads(line)
                 for topic_regex in self._subscriptions:
                     if topic_regex.match(msg['topic']):
                         self.on_message(None, msg['topic'], msg['payload'].encode('utf-8'), 0, {})
@@ -0,0 +1,29 @@
+from typing import Callable
+
+from gmqtt.storage import HeapPersistentStorage
+
+class InflightStorage(HeapPersistentStorage):
+    """
+    gmqtt storage of not acknowledged QoS 1/2 messages which reports acknowledgements,
+    so MQTTRouter can limit number of messages in flight.
+
+    Passed to gmqtt client with `persistent_storage` argument and to MQTTRouter with `inflight` argument.
+    """
+    on_release: Callable[[], None] | None
+
+    def __init__(self, timeout: float = 5):
+        # timeout must be the same as `retry_deliver_timeout` of client, 5 seconds by default
+        super().__init__(timeout)
+        self.on_release = None
+
+    @property
+    def count(self) -> int:
+        """Number of stored messages, not acknowledged by broker yet."""
+        return len(self._queue)
+
+    async def remove_message_by_mid(self, mid):
+        # called when PUBACK/PUBCOMP is received
+        found = any(message[1] == mid for message in self._queue)
+        await super().remove_message_by_mid(mid)
+        if found and self.on_release is not None:
+            self.on_release()
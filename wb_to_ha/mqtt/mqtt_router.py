@@ -4,13 +4,18 @@ import re
 
 from gmqtt import Client
 
+from wb_to_ha.metrics import Metrics
+from wb_to_ha.mqtt.topics import TOPIC_CLASS_STATE, topic_class
+
 logger = logging.getLogger(__name__)
 
 class Subscription:
+    topic: str
     re_matcher: re.Pattern
     callback: Callable
 
     def __init__(self, pattern: str, callback: Callable):
+        self.topic = pattern
         self.callback = callback
         pattern = pattern.replace('+', '[^/]+').replace('#', '.+')
         self.re_matcher = re.compile(pattern)
@@ -31,27 +36,136 @@ class IMQTTClient(Protocol):
     def publish(self, topic: str, payload: str, qos: int = 0, retain: bool = False):
         ...
 
+class IInflightNotifier(Protocol):
+    """Reports acknowledgement of QoS 1/2 message, e.g. InflightStorage of gmqtt client."""
+    on_release: Callable[[], None] | None
+
+    @property
+    def count(self) -> int:
+        ...
+
 class MQTTRouter:
     _client_name: str = ''
     _mqtt: IMQTTClient
     _subscriptions: list[Subscription]
     on_404: Callable = default_404
 
-    def __init__(self, cl: IMQTTClient, client_name: str):
+    # Backpressure of QoS 1/2 publishes, 0 - messages are passed to client without limit
+    _inflight: IInflightNotifier | None
+    _inflight_window: int
+    _inflight_count: int
+    # topic -> (payload, qos, retain), publishes waiting for free inflight slot, the latest payload of topic wins
+    _queue: dict[str, tuple[str, int, bool]]
+    # Maximum number of queued topics, 0 - not limited
+    _queue_size: int
+    # Topic classes (config, availability, state) which are dropped when queue is full, others are queued anyway
+    _drop_classes: set[str]
+    _metrics: Metrics | None
+
+    def __init__(self,
+                 cl: IMQTTClient,
+                 client_name: str,
+                 inflight: IInflightNotifier | None = None,
+                 inflight_window: int = 0,
+                 queue_size: int = 0,
+                 drop_classes: list[str] = [TOPIC_CLASS_STATE],
+                 metrics: Metrics | None = None):
         self._client_name = client_name
         cl.on_message = self._on_message
         self._mqtt = cl
         self._subscriptions = []
+        self._inflight = inflight
+        self._inflight_window = inflight_window if inflight is not None else 0
+        self._inflight_count = 0
+        self._queue = {}
+        self._queue_size = queue_size
+        self._drop_classes = set(drop_classes)
+        self._metrics = metrics
+        if inflight is not None and inflight_window > 0:
+            inflight.on_release = self._on_inflight_release
 
     def subscribe(self, topic: str, callback: Callable[[str, bytes], None], qos: int = 0):
-        self._subscriptions.append(Subscription(topic, callback))
+        # on_connect handlers subscribe again after every reconnection, broker needs it, router does not
+        if not any(sub.topic == topic and sub.callback == callback for sub in self._subscriptions):
+            self._subscriptions.append(Subscription(topic, callback))
         self._mqtt.subscribe(topic, qos=qos)
         logger.info(f"[{self._client_name}] subscribed to topic={topic} with qos={qos}")
 
     def publish(self, topic: str, payload: str, qos: int = 0, retain: bool = False):
+        if self._inflight_window and qos > 0:
+            # queued messages go first, so messages of one topic are not reordered
+            if self._queue or self._inflight_count >= self._inflight_window:
+                self._enqueue(topic, payload, qos, retain)
+                return
+            self._inflight_count += 1
+        elif self._queue and topic in self._queue:
+            # QoS 0 message is newer than queued one, e.g. when QoS of states is downgraded under load
+            del self._queue[topic]
+            self._inc_metric('publish_coalesced')
+            self._update_depth_metrics()
         self._mqtt.publish(topic, payload, qos=qos, retain=retain)
         logger.debug(f"[{self._client_name}] published to topic={topic} payload={payload} with qos={qos}")
 
+    def publish_now(self, topic: str, payload: str, qos: int = 0, retain: bool = False):
+        """
+        Publishes bypassing queue and inflight window, for messages which must not wait behind others,
+        e.g. leader lease. Message is counted in flight, so window is exceeded until it is acknowledged.
+        """
+        if self._inflight_window and qos > 0:
+            self._inflight_count += 1
+            self._update_depth_metrics()
+        self._mqtt.publish(topic, payload, qos=qos, retain=retain)
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    def _enqueue(self, topic: str, payload: str, qos: int, retain: bool):
+        if topic in self._queue:
+            # keeps position in queue, only the latest payload is published
+            self._queue[topic] = (payload, qos, retain)
+            self._inc_metric('publish_coalesced')
+            return
+        if self._queue_size and len(self._queue) >= self._queue_size and topic_class(topic) in self._drop_classes:
+            logger.debug(f"[{self._client_name}] publish queue is full, dropped topic={topic}")
+            self._inc_metric('publish_dropped')
+            return
+        self._queue[topic] = (payload, qos, retain)
+        self._inc_metric('publish_queued')
+        self._update_depth_metrics()
+
+    def recount_inflight(self):
+        """
+        Takes number of messages in flight from the storage, called on connect.
+        Count of the router drifts when acknowledgement is lost or publish fails on broken connection,
+        storage keeps messages until they are acknowledged.
+        """
+        if not self._inflight_window or self._inflight is None:
+            return
+        self._inflight_count = self._inflight.count
+        self._publish_queued()
+
+    def _on_inflight_release(self):
+        self._inflight_count = max(self._inflight_count - 1, 0)
+        self._publish_queued()
+
+    def _publish_queued(self):
+        while self._queue and self._inflight_count < self._inflight_window:
+            topic = next(iter(self._queue))
+            payload, qos, retain = self._queue.pop(topic)
+            self._inflight_count += 1
+            self._mqtt.publish(topic, payload, qos=qos, retain=retain)
+        self._update_depth_metrics()
+
+    def _inc_metric(self, name: str):
+        if self._metrics is not None:
+            self._metrics.inc(f"{self._client_name}_{name}")
+
+    def _update_depth_metrics(self):
+        if self._metrics is not None:
+            self._metrics.set(f"{self._client_name}_publish_queue_depth", len(self._queue))
+            self._metrics.set(f"{self._client_name}_inflight", self._inflight_count)
+
     def _on_message(self, client: Client, topic: str, payload: bytes, qos: int, properties):
         if logger.isEnabledFor(logging.DEBUG):
             pl = payload.decode('utf-8')
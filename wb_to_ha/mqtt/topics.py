@@ -0,0 +1,14 @@
+"""
+Classes of topics published to Home Assistant broker: discovery configs, availability and states.
+"""
+
+TOPIC_CLASS_CONFIG = 'config'
+TOPIC_CLASS_AVAILABILITY = 'availability'
+TOPIC_CLASS_STATE = 'state'
+
+def topic_class(topic: str) -> str:
+    if topic.endswith('/config') and topic.startswith('homeassistant/'):
+        return TOPIC_CLASS_CONFIG
+    if topic.endswith('/availability'):
+        return TOPIC_CLASS_AVAILABILITY
+    return TOPIC_CLASS_STATE
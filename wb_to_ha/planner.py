@@ -0,0 +1,136 @@
+"""
+Dry run of customization change: which discovery configs are added, removed and changed.
+
+Registry is filled from recorded Wiren Board traffic, in JSONL format of `LocalMQTTClient`, e.g. retained messages
+of /devices tree. Configs are rendered from the same registry with current and new customization by
+the usual payload builder, then compared by topic. Entities which are removed under one topic and added under
+another one with the same unique_id are reported as moved, e.g. when device is splitted or combined.
+Extra sensors of aggregated controls are included. Traffic is recorded from one controller, so devices of
+extra Wiren Board brokers are not compared.
+"""
+from typing import Callable
+
+from wb_to_ha import json_backend
+from wb_to_ha.aggregation import EXTRA_SENSOR_SUFFIXES
+from wb_to_ha.homeassistant import AVAILABILITY_MODE_CONTROL, HomeAssistant, HomeAssistantDiscoveryCustomizer, format_entity_id
+from wb_to_ha.mqtt.mqtt_router import MQTTRouter
+from wb_to_ha.wirenboard import Wirenboard
+from wb_to_ha.wirenboard_registry import WirenBoardDeviceRegistry, WirenControl, WirenDevice
+
+class _NoConnection:
+    """IMQTTClient of dry run, nothing is subscribed and published."""
+    on_message: Callable
+    on_disconnect: Callable
+    on_connect: Callable
+
+    def subscribe(self, topic: str, qos: int = 0):
+        pass
+
+    def publish(self, topic: str, payload: str, qos: int = 0, retain: bool = False):
+        pass
+
+class _RegistryOnly:
+    """IHomeAssistant which publishes nothing, Wiren Board messages only fill registry."""
+    def publish_device_config(self, device: WirenDevice) -> None:
+        pass
+
+    def publish_control_config(self, device: WirenDevice, control: WirenControl) -> None:
+        pass
+
+    def publish_control_state(self, device: WirenDevice, control: WirenControl) -> None:
+        pass
+
+    def publish_availability(self, device: WirenDevice, control: WirenControl) -> None:
+        pass
+
+class ConfigDiff:
+    # topic -> payload
+    added: dict[str, str]
+    # topic -> payload
+    removed: dict[str, str]
+    # topic -> changed fields of payload
+    changed: dict[str, list[str]]
+    # old topic -> new topic, entity with the same unique_id
+    moved: dict[str, str]
+    unchanged: int
+
+    def __init__(self, old: dict[str, str], new: dict[str, str]):
+        self.added = {}
+        self.changed = {}
+        self.moved = {}
+        self.unchanged = 0
+        for topic, data in new.items():
+            old_data = old.get(topic)
+            if old_data is None:
+                self.added[topic] = data
+            elif old_data == data:
+                self.unchanged += 1
+            else:
+                self.changed[topic] = _changed_fields(json_backend.loads(old_data), json_backend.loads(data))
+        self.removed = {topic: data for topic, data in old.items() if topic not in new}
+        # Only added and removed payloads are parsed to find moved entities
+        added_by_unique_id = {json_backend.loads(data).get('unique_id'): topic for topic, data in self.added.items()}
+        for topic, data in self.removed.items():
+            new_topic = added_by_unique_id.get(json_backend.loads(data).get('unique_id'))
+            if new_topic is not None:
+                self.moved[topic] = new_topic
+        for topic, new_topic in self.moved.items():
+            del self.removed[topic]
+            del self.added[new_topic]
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.removed or self.changed or self.moved)
+
+    def format(self) -> list[str]:
+        """One line per topic, sorted by topic within every kind of change, and summary line."""
+        lines = [f'+ {topic}' for topic in sorted(self.added)]
+        lines += [f'- {topic}' for topic in sorted(self.removed)]
+        lines += [f'> {topic} -> {self.moved[topic]}' for topic in sorted(self.moved)]
+        lines += [f'~ {topic}: {", ".join(self.changed[topic])}' for topic in sorted(self.changed)]
+        lines.append(
+            f'{len(self.added)} added, {len(self.removed)} removed, {len(self.moved)} moved, '
+            f'{len(self.changed)} changed, {self.unchanged} unchanged'
+        )
+        return lines
+
+def _changed_fields(old: dict, new: dict) -> list[str]:
+    return sorted(key for key in old.keys() | new.keys() if old.get(key) != new.get(key))
+
+def load_registry(path: str, device_id_prefix: str = '') -> WirenBoardDeviceRegistry:
+    """Registry after all messages of recorded Wiren Board traffic, in one pass over the file."""
+    registry = WirenBoardDeviceRegistry()
+    wb = Wirenboard(MQTTRouter(_NoConnection(), 'wirenboard'), registry, _RegistryOnly(), device_id_prefix=device_id_prefix)
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            msg = json_backend.loads(line)
+            # commands and other topics are skipped
+            wb.ingest(msg['topic'], msg['payload'].encode('utf-8'))
+    return registry
+
+def render_configs(registry: WirenBoardDeviceRegistry, customizer: HomeAssistantDiscoveryCustomizer,
+                   availability_mode: str = AVAILABILITY_MODE_CONTROL,
+                   aggregated_controls: list[dict] = []) -> dict[str, str]:
+    ha = HomeAssistant(MQTTRouter(_NoConnection(), 'homeassistant'), registry, customizer, availability_mode=availability_mode)
+    configs = ha.render_configs()
+    # Extra sensors are published with the first window of control
+    extra_sensors = {c['entity_id'] for c in aggregated_controls if c.get('extra_sensors')}
+    if extra_sensors:
+        for device in registry.devices().values():
+            for control in device.controls.values():
+                if format_entity_id(device.device_id, control.id) in extra_sensors:
+                    configs.update(ha.render_derived_configs(device, control, EXTRA_SENSOR_SUFFIXES))
+    return configs
+
+def plan(registry: WirenBoardDeviceRegistry,
+         old_customizer: HomeAssistantDiscoveryCustomizer,
+         new_customizer: HomeAssistantDiscoveryCustomizer,
+         old_availability_mode: str = AVAILABILITY_MODE_CONTROL,
+         new_availability_mode: str = AVAILABILITY_MODE_CONTROL,
+         old_aggregated_controls: list[dict] = [],
+         new_aggregated_controls: list[dict] = []) -> ConfigDiff:
+    return ConfigDiff(
+        render_configs(registry, old_customizer, old_availability_mode, old_aggregated_controls),
+        render_configs(registry, new_customizer, new_availability_mode, new_aggregated_controls),
+    )
@@ -0,0 +1,90 @@
+"""
+QoS of state messages published to Home Assistant.
+
+QoS is assigned by rules matching Wiren Board control type and device id glob, the first matched rule wins,
+`state_qos` is used when no rule matches. Under load, when publish queue of Home Assistant broker grows above
+downgrade threshold, states are published with QoS 0 until queue drops to restore threshold.
+"""
+import fnmatch
+import logging
+from typing import Callable
+
+from wb_to_ha.metrics import Metrics
+from wb_to_ha.wirenboard_registry import WirenControl, WirenDevice
+
+logger = logging.getLogger(__name__)
+
+class QosRule:
+    device: str
+    control_type: str | None
+    qos: int
+
+    def __init__(self, qos: int, device: str = '*', control_type: str | None = None):
+        self.device = device
+        self.control_type = control_type
+        self.qos = qos
+
+    def matches(self, device: WirenDevice, control: WirenControl) -> bool:
+        if self.control_type is not None and (control.type is None or control.type.value != self.control_type):
+            return False
+        return fnmatch.fnmatchcase(device.device_id, self.device)
+
+class QosPolicy:
+    _state_qos: int
+    _rules: list[QosRule]
+    # (device id, control id, control type) -> QoS by rules
+    _cache: dict[tuple[str, str, str | None], int]
+    # Queue depth to publish states with QoS 0, 0 - never downgraded
+    _downgrade_threshold: int
+    # Queue depth to publish states with QoS by rules again, lower than downgrade threshold to avoid flapping
+    _restore_threshold: int
+    # Current depth of publish queue
+    _load: Callable[[], int] | None
+    _metrics: Metrics
+    _downgraded: bool
+
+    def __init__(self,
+                 state_qos: int,
+                 rules: list[dict],
+                 downgrade_threshold: int = 0,
+                 restore_threshold: int = 0,
+                 load: Callable[[], int] | None = None,
+                 metrics: Metrics | None = None):
+        self._state_qos = state_qos
+        self._rules = [QosRule(**rule) for rule in rules]
+        self._cache = {}
+        self._downgrade_threshold = downgrade_threshold
+        self._restore_threshold = min(restore_threshold, downgrade_threshold)
+        self._load = load
+        self._metrics = metrics if metrics is not None else Metrics()
+        self._downgraded = False
+
+    @property
+    def downgraded(self) -> bool:
+        return self._downgraded
+
+    def state_qos(self, device: WirenDevice, control: WirenControl) -> int:
+        key = (device.device_id, control.id, control.type.value if control.type is not None else None)
+        qos = self._cache.get(key)
+        if qos is None:
+            qos = next((rule.qos for rule in self._rules if rule.matches(device, control)), self._state_qos)
+            self._cache[key] = qos
+        if qos == 0 or not self._downgrade_threshold or self._load is None:
+            return qos
+        self._update_load(self._load())
+        if self._downgraded:
+            self._metrics.inc('qos_downgraded_states')
+            return 0
+        return qos
+
+    def _update_load(self, depth: int):
+        if self._downgraded and depth <= self._restore_threshold:
+            self._downgraded = False
+            logger.info(f"publish queue depth is {depth}, states are published with configured QoS")
+            self._metrics.inc('qos_restores')
+            self._metrics.set('qos_downgraded', 0)
+        elif not self._downgraded and depth >= self._downgrade_threshold:
+            self._downgraded = True
+            logger.warning(f"publish queue depth is {depth}, states are published with QoS 0")
+            self._metrics.inc('qos_downgrades')
+            self._metrics.set('qos_downgraded', 1)
@@ -0,0 +1,361 @@
+"""
+Sharded mode: Wiren Board traffic is partitioned across worker processes by Home Assistant device of control,
+the same one `HomeAssistant` publishes control under. So all controls of one Home Assistant device, including
+members of combined devices and controls of splitted devices, are processed by one worker, and its device
+config and availability are built from complete state. Device meta topics and states of controls with
+device info (serial number, system info) go to every worker, because every worker may own controls of device.
+
+Main process owns MQTT connections and only moves messages: it sends every received message
+to the worker which owns the device, and publishes and subscribes on behalf of workers.
+Every worker runs the usual `App` with `WorkerMQTTClient` proxies instead of MQTT clients,
+so it parses topics, keeps its slice of the registry and builds discovery payloads.
+
+Main process and worker are connected with a socket pair, messages are pickled in batches
+collected during one event loop iteration.
+"""
+import asyncio
+import logging
+import multiprocessing
+import pickle
+import socket
+import struct
+import zlib
+from typing import Any, Callable
+
+from wb_to_ha import event_loop, json_backend
+from wb_to_ha.app import App, IMQTTClient, connect_mqtt
+from wb_to_ha.homeassistant import HomeAssistantDiscoveryCustomizer
+from wb_to_ha.wirenboard import is_device_info_control
+
+logger = logging.getLogger(__name__)
+
+_HA_CLIENT = 'homeassistant'
+_WB_CLIENT = 'wirenboard'
+_frame_header = struct.Struct('!I')
+
+def shard_for_device(device_id: str, workers: int) -> int:
+    # crc32 instead of hash(), because str hash is randomized per process
+    return zlib.crc32(device_id.encode('utf-8')) % workers
+
+class Channel:
+    """Batched two-way channel of pickled messages over a stream socket."""
+    _reader: asyncio.StreamReader
+    _writer: asyncio.StreamWriter
+    _batch: list[tuple]
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._reader = reader
+        self._writer = writer
+        self._batch = []
+
+    @classmethod
+    async def from_socket(cls, sock: socket.socket) -> 'Channel':
+        reader, writer = await asyncio.open_connection(sock=sock)
+        return cls(reader, writer)
+
+    def send(self, msg: tuple):
+        if not self._batch:
+            asyncio.get_running_loop().call_soon(self.flush)
+        self._batch.append(msg)
+
+    def flush(self):
+        if not self._batch or self._writer.is_closing():
+            return
+        data = pickle.dumps(self._batch, protocol=pickle.HIGHEST_PROTOCOL)
+        self._batch = []
+        self._writer.write(_frame_header.pack(len(data)) + data)
+
+    async def receive(self) -> list[tuple]:
+        """Next batch of messages, empty list when other side closed the channel."""
+        try:
+            header = await self._reader.readexactly(_frame_header.size)
+            return pickle.loads(await self._reader.readexactly(_frame_header.unpack(header)[0]))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return []
+
+    async def close(self):
+        self.flush()
+        try:
+            await self._writer.drain()
+            self._writer.close()
+            await self._writer.wait_closed()
+        except ConnectionError:
+            # other side is already gone, e.g. worker process died
+            pass
+
+class WorkerMQTTClient:
+    """MQTT client of worker process, subscribes and publishes through main process."""
+    on_message: Callable
+    on_disconnect: Callable
+    on_connect: Callable
+
+    _name: str
+    _channel: Channel
+
+    def __init__(self, name: str, channel: Channel):
+        self._name = name
+        self._channel = channel
+
+    def subscribe(self, topic: str, qos: int = 0):
+        self._channel.send(('subscribe', self._name, topic, qos))
+
+    def publish(self, topic: str, payload: str, qos: int = 0, retain: bool = False):
+        self._channel.send(('publish', self._name, topic, payload, qos, retain))
+
+    async def connect(self, *args, **kwargs):
+        # Subscriptions are reported to main process before it connects to brokers,
+        # main process makes them synchronously on every connection.
+        self.on_connect(self)
+        self._channel.send(('connected', self._name))
+
+    async def disconnect(self):
+        pass
+
+def _extra_wb_client_name(prefix: str) -> str:
+    return f'{_WB_CLIENT}:{prefix}'
+
+def _worker_main(sock: socket.socket, loglevel: int, app_args: dict[str, Any]):
+    logging.basicConfig(level=loglevel, format="%(asctime)s %(levelname)s [%(processName)s %(name)s] %(message)s", datefmt="%H:%M:%S")
+    event_loop.set_loop(app_args['event_loop'])
+    with asyncio.Runner(loop_factory=event_loop.new_event_loop) as runner:
+        runner.run(_run_worker(sock, app_args))
+
+async def _run_worker(sock: socket.socket, app_args: dict[str, Any]):
+    json_backend.set_backend(app_args['json_backend'])
+    channel = await Channel.from_socket(sock)
+    clients = {
+        _HA_CLIENT: WorkerMQTTClient(_HA_CLIENT, channel),
+        _WB_CLIENT: WorkerMQTTClient(_WB_CLIENT, channel),
+    }
+    extra_wb_brokers: list[tuple[dict, IMQTTClient]] = []
+    for config in app_args['extra_wb_brokers']:
+        name = _extra_wb_client_name(config['device_id_prefix'])
+        clients[name] = WorkerMQTTClient(name, channel)
+        extra_wb_brokers.append((config, clients[name]))
+    app = App(
+        app_args['ha_config'],
+        app_args['wb_config'],
+        clients[_HA_CLIENT],
+        clients[_WB_CLIENT],
+        app_args['ha_customizer'],
+        extra_wb_brokers,
+        aggregated_controls=app_args['aggregated_controls'],
+        qos_rules=app_args['qos_rules'],
+    )
+
+    async def receive():
+        while True:
+            batch = await channel.receive()
+            if not batch:
+                await app.stop()
+                return
+            for msg in batch:
+                if msg[0] == 'message':
+                    _, name, topic, payload = msg
+                    clients[name].on_message(None, topic, payload, 0, {})
+                elif msg[0] == 'connect':
+                    clients[msg[1]].on_connect(clients[msg[1]])
+                elif msg[0] == 'customizer':
+                    app.reload_customizer(msg[1])
+                elif msg[0] == 'stop':
+                    await app.stop()
+                    return
+
+    receiver = asyncio.create_task(receive())
+    await app.run()
+    await receiver
+    await channel.close()
+
+class ShardedApp:
+    """
+    Same as `App`, but Wiren Board devices are processed by `workers` worker processes.
+    Messages of one device always go to the same worker, so every worker owns a slice of devices.
+    """
+    _workers: int
+    _app_args: dict[str, Any]
+    _ha_customizer: HomeAssistantDiscoveryCustomizer
+    # client name -> MQTT client
+    _clients: dict[str, IMQTTClient]
+    # client name -> device id prefix, for Wiren Board clients only
+    _prefixes: dict[str, str]
+    _configs: dict[str, dict]
+    # client name -> topic -> qos, subscriptions requested by workers
+    _subscriptions: dict[str, dict[str, int]]
+    _connected: set[str]
+    _channels: list[Channel]
+    _processes: list[multiprocessing.process.BaseProcess]
+    _receivers: list[asyncio.Task]
+    _workers_ready: asyncio.Event
+    _ready_count: int
+    _stoper: asyncio.Event
+    _is_stopping: bool
+    # reason of stop when app can not work further, e.g. worker process died
+    _failure: str | None
+
+    def __init__(self,
+                 workers: int,
+                 ha_config: dict,
+                 wb_config: dict,
+                 ha_mqtt_client: IMQTTClient,
+                 wb_mqtt_client: IMQTTClient,
+                 ha_customizer: HomeAssistantDiscoveryCustomizer,
+                 extra_wb_brokers: list[tuple[dict, IMQTTClient]] = [],
+                 aggregated_controls: list[dict] = [],
+                 qos_rules: list[dict] = [],
+                 ):
+        assert workers > 0
+        self._workers = workers
+        self._ha_customizer = ha_customizer
+        self._app_args = {
+            'ha_config': ha_config,
+            'wb_config': wb_config,
+            'ha_customizer': ha_customizer,
+            'extra_wb_brokers': [config for config, _ in extra_wb_brokers],
+            'aggregated_controls': aggregated_controls,
+            'qos_rules': qos_rules,
+            # workers are spawned, so backend selected in main process is passed explicitly
+            'json_backend': json_backend.backend(),
+            'event_loop': event_loop.loop_name(),
+        }
+        self._clients = {_HA_CLIENT: ha_mqtt_client, _WB_CLIENT: wb_mqtt_client}
+        self._prefixes = {_WB_CLIENT: wb_config.get('device_id_prefix', '')}
+        self._configs = {_HA_CLIENT: ha_config, _WB_CLIENT: wb_config}
+        for config, client in extra_wb_brokers:
+            name = _extra_wb_client_name(config['device_id_prefix'])
+            self._clients[name] = client
+            self._prefixes[name] = config['device_id_prefix']
+            self._configs[name] = config
+        self._subscriptions = {name: {} for name in self._clients}
+        self._connected = set()
+        for name, client in self._clients.items():
+            client.on_message = self._message_handler(name)
+            client.on_connect = self._connect_handler(name)
+        self._channels = []
+        self._processes = []
+        self._receivers = []
+        self._workers_ready = asyncio.Event()
+        self._ready_count = 0
+        self._stoper = asyncio.Event()
+        self._is_stopping = False
+        self._failure = None
+
+    def _shard_for_control(self, device_id: str, control_id: str) -> int:
+        ha_device_id, _ = self._ha_customizer.get_ha_device(device_id, control_id)
+        return shard_for_device(ha_device_id, self._workers)
+
+    def reload_customizer(self, ha_customizer: HomeAssistantDiscoveryCustomizer):
+        """
+        Every worker applies new customization to its slice of devices. Controls are routed to workers by
+        Home Assistant device, so changed combined and splitted devices are applied on restart only.
+        """
+        if (ha_customizer.combined_device_ids() != self._ha_customizer.combined_device_ids()
+                or ha_customizer.splitted_device_ids() != self._ha_customizer.splitted_device_ids()):
+            logger.error("Combined or splitted devices are changed, restart is needed to apply them with worker processes, customization is not reloaded")
+            return
+        self._ha_customizer = ha_customizer
+        self._app_args['ha_customizer'] = ha_customizer
+        for channel in self._channels:
+            channel.send(('customizer', ha_customizer))
+
+    def _message_handler(self, name: str) -> Callable:
+        prefix = self._prefixes.get(name, '')
+        def on_message(client, topic: str, payload: bytes, qos: int, properties):
+            # /devices/{device_id}/controls/{control_id}... goes to the owner of control,
+            # other topics (device meta, device info, hass/status) to every worker
+            parts = topic.split('/', 5)
+            if (len(parts) > 4 and parts[1] == 'devices' and parts[3] == 'controls'
+                    and not (len(parts) == 5 and is_device_info_control(parts[2], parts[4]))):
+                self._channels[self._shard_for_control(prefix + parts[2], parts[4])].send(('message', name, topic, payload))
+            else:
+                for channel in self._channels:
+                    channel.send(('message', name, topic, payload))
+        return on_message
+
+    def _connect_handler(self, name: str) -> Callable:
+        def on_connect(*args, **kwargs):
+            # Subscribe synchronously, so broker sends retained messages only after all subscriptions are made
+            for topic, qos in self._subscriptions[name].items():
+                self._clients[name].subscribe(topic, qos=qos)
+            self._connected.add(name)
+            # workers run on_connect handlers, e.g. HomeAssistant publishes all known devices
+            for channel in self._channels:
+                channel.send(('connect', name))
+        return on_connect
+
+    async def _receive(self, channel: Channel, worker: int):
+        while True:
+            batch = await channel.receive()
+            if not batch:
+                if not self._is_stopping:
+                    # Devices of worker would be silently lost, app is stopped and fails, so supervisor restarts it
+                    self._failure = f"worker {worker} exited with code {self._processes[worker].exitcode}"
+                    logger.error(f"{self._failure}, stopping app")
+                    asyncio.create_task(self.stop())
+                return
+            for msg in batch:
+                if msg[0] == 'publish':
+                    _, name, topic, payload, qos, retain = msg
+                    self._clients[name].publish(topic, payload, qos=qos, retain=retain)
+                elif msg[0] == 'subscribe':
+                    _, name, topic, qos = msg
+                    if topic not in self._subscriptions[name]:
+                        self._subscriptions[name][topic] = qos
+                        if name in self._connected:
+                            self._clients[name].subscribe(topic, qos=qos)
+                elif msg[0] == 'connected':
+                    self._ready_count += 1
+                    if self._ready_count == self._workers * len(self._clients):
+                        self._workers_ready.set()
+
+    async def _start_workers(self):
+        ctx = multiprocessing.get_context('spawn')
+        for i in range(self._workers):
+            parent_sock, child_sock = socket.socketpair()
+            process = ctx.Process(
+                target=_worker_main,
+                args=(child_sock, logging.getLogger().getEffectiveLevel(), self._app_args),
+                name=f'wb-to-ha-worker-{i}',
+                daemon=True,
+            )
+            process.start()
+            child_sock.close()
+            channel = await Channel.from_socket(parent_sock)
+            self._channels.append(channel)
+            self._processes.append(process)
+            self._receivers.append(asyncio.create_task(self._receive(channel, i)))
+        # workers report when they are ready to handle messages, so no message is lost on connection
+        await self._workers_ready.wait()
+        logger.info(f"{self._workers} workers started")
+
+    async def run(self):
+        await self._start_workers()
+        async with asyncio.TaskGroup() as tg:
+            for name, client in self._clients.items():
+                tg.create_task(connect_mqtt(
+                    name=name,
+                    client=client,
+                    host=self._configs[name]['broker_host'],
+                    port=self._configs[name]['broker_port'],
+                ))
+        await self._stoper.wait()
+        if self._failure is not None:
+            raise RuntimeError(self._failure)
+
+    async def stop(self):
+        if self._is_stopping:
+            return
+        self._is_stopping = True
+        logger.info("Stopping app")
+        # Workers handle all sent messages before stop, their publishes are done before disconnect
+        for channel in self._channels:
+            channel.send(('stop',))
+        await asyncio.gather(*self._receivers)
+        for channel in self._channels:
+            await channel.close()
+        for process in self._processes:
+            await asyncio.to_thread(process.join)
+        for name, client in self._clients.items():
+            if name != _HA_CLIENT:
+                await client.disconnect()
+        await self._clients[_HA_CLIENT].disconnect()
+        self._stoper.set()
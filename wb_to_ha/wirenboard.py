@@ -1,10 +1,13 @@
+import asyncio
 import logging
 import re
+import time
 from typing import Protocol
 
 from wb_to_ha.wirenboard_registry import WirenBoardDeviceRegistry, WirenDevice, WirenControl
 from wb_to_ha.mqtt.mqtt_router import MQTTRouter
 from wb_to_ha.mappers import WirenControlType, WIREN_UNITS_DICT
+from wb_to_ha.metrics import Metrics
 
 logger = logging.getLogger(__name__)
 
@@ -34,6 +37,19 @@ class Wirenboard:
     _subscribe_qos: int
     _publish_qos: int
     _publish_retain: bool
+    # Prefix of device ids in registry, to keep devices of several controllers in one registry
+    _device_id_prefix: str
+    # Subscribe to /devices/# and demultiplex topics by their segments instead of three wildcard subscriptions
+    _single_subscription: bool
+    # Commands to range controls within this window are coalesced, only the latest value is sent
+    _command_coalesce_window: float
+    _metrics: Metrics | None
+    # (device id, control id) -> command topic
+    _command_topics: dict[tuple[str, str], str]
+    # command topic -> (state, time command was received), latest command to send at the end of window
+    _pending_commands: dict[str, tuple[str, float]]
+    # command topic -> timer closing its coalescing window
+    _command_windows: dict[str, asyncio.TimerHandle]
 
     def __init__(self,
                  router: MQTTRouter,
@@ -41,12 +57,23 @@ class Wirenboard:
                  hass: IHomeAssistant | None = None,
                  subscribe_qos: int = 1,
                  publish_qos: int = 1,
-                 publish_retain: bool = False):
+                 publish_retain: bool = False,
+                 device_id_prefix: str = '',
+                 single_subscription: bool = False,
+                 command_coalesce_window: float = 0,
+                 metrics: Metrics | None = None):
         self._router = router
         self._device_registry = registry
         self._subscribe_qos = subscribe_qos
         self._publish_qos = publish_qos
         self._publish_retain = publish_retain
+        self._device_id_prefix = device_id_prefix
+        self._single_subscription = single_subscription
+        self._command_coalesce_window = command_coalesce_window
+        self._metrics = metrics
+        self._command_topics = {}
+        self._pending_commands = {}
+        self._command_windows = {}
         self._unknown_types = []
         if hass is not None:
             self.hass = hass
@@ -68,17 +95,41 @@ class Wirenboard:
 
     def on_connect(self, *args, **kwargs):
         logger.warning(f"connected to MQTT")
+        if self._single_subscription:
+            self._router.subscribe('/devices/#', self._devices_handler, qos=self._subscribe_qos)
+            return
         self._router.subscribe('/devices/+/meta/+', self._device_meta_handler, qos=self._subscribe_qos)
         self._router.subscribe('/devices/+/controls/+/meta/+', self._control_meta_handler, qos=self._subscribe_qos)
         self._router.subscribe('/devices/+/controls/+', self._control_state_handler, qos=self._subscribe_qos)
 
+    def ingest(self, topic: str, payload: bytes):
+        """Applies message of /devices tree received without subscription, e.g. from recorded traffic."""
+        self._devices_handler(topic, payload)
+
+    def _devices_handler(self, topic: str, payload: bytes):
+        # /devices/{device}/meta/{meta}
+        # /devices/{device}/controls/{control}
+        # /devices/{device}/controls/{control}/meta/{meta}
+        # Other topics, like commands /devices/{device}/controls/{control}/on, are skipped.
+        parts = topic.split('/')
+        n = len(parts)
+        if n == 5:
+            if parts[3] == 'controls':
+                self._on_control_state(parts[2], parts[4], payload.decode('utf-8'))
+            elif parts[3] == 'meta':
+                self._on_device_meta(parts[2], parts[4], payload.decode('utf-8'))
+        elif n == 7 and parts[5] == 'meta' and parts[3] == 'controls':
+            self._on_control_meta(parts[2], parts[4], parts[6], payload.decode('utf-8'))
+
     def _device_meta_handler(self, topic: str, payload: bytes):
         match = self._device_meta_topic_re.match(topic)
         if match is None:
             logger.warning(f'not matched topic={topic} re={self._device_meta_topic_re}')
             return
-        device_id, meta_name, meta_value = match.group(1), match.group(2), payload.decode('utf-8')
-        device = self._device_registry.get_device(device_id)
+        self._on_device_meta(match.group(1), match.group(2), payload.decode('utf-8'))
+
+    def _on_device_meta(self, device_id: str, meta_name: str, meta_value: str):
+        device = self._device_registry.get_device(self._device_id_prefix + device_id)
         if meta_name == 'name':
             device.name = meta_value
         logger.debug(f'DEVICE META: {device_id} / {meta_name} ==> {meta_value}')
@@ -88,7 +139,9 @@ class Wirenboard:
         if match is None:
             logger.warning(f'not matched topic={topic} re={self._control_meta_topic_re}')
             return
-        device_id, control_id, meta_name, meta_value = match.group(1), match.group(2), match.group(3), payload.decode('utf-8')
+        self._on_control_meta(match.group(1), match.group(2), match.group(3), payload.decode('utf-8'))
+
+    def _on_control_meta(self, device_id: str, control_id: str, meta_name: str, meta_value: str):
         logger.debug(f'CONTROL META: {device_id} / {control_id} / {meta_name} ==> {meta_value}')
 
         # Обработка специальных контролов.
@@ -98,7 +151,7 @@ class Wirenboard:
         if device_id == 'system' and self.is_known_system_control(control_id):
             return
 
-        device = self._device_registry.get_device(device_id)
+        device = self._device_registry.get_device(self._device_id_prefix + device_id)
         control = device.get_control(control_id)
 
         if meta_name == 'error':
@@ -138,8 +191,9 @@ class Wirenboard:
         if match is None:
             logger.warning(f'not matched topic={topic} re={self._control_state_topic_re}')
             return
-        device_id, control_id, control_state = match.group(1), match.group(2), payload.decode('utf-8')
+        self._on_control_state(match.group(1), match.group(2), payload.decode('utf-8'))
 
+    def _on_control_state(self, device_id: str, control_id: str, control_state: str):
         # Обработка специальных контролов.
         # В mqtt в wb системная информация зарегана под устройством system.
         # Вытаскиваем из system максимум информации, при этом не регаем его как отдельный контрол.
@@ -149,13 +203,13 @@ class Wirenboard:
                 return
         normilized_control_id = control_id.lower().replace(" ", "_")
         if normilized_control_id == 'serial':
-            device = self._device_registry.get_device(device_id)
+            device = self._device_registry.get_device(self._device_id_prefix + device_id)
             device.serial_number = control_state
             self.hass.publish_device_config(device)
             return
-        device = self._device_registry.get_device(device_id)
+        device = self._device_registry.get_device(self._device_id_prefix + device_id)
         control = device.get_control(control_id)
-        control.state = control_state
+        control.apply_state(control_state)
         self.hass.publish_control_state(device, control)
 
     def is_known_system_control(self, control_id: str) -> bool:
@@ -165,7 +219,7 @@ class Wirenboard:
         if not self.is_known_system_control(control_id):
             return False
 
-        device = self._device_registry.get_device(device_id)
+        device = self._device_registry.get_device(self._device_id_prefix + device_id)
         normalized_control_id = control_id.lower().replace(" ", "_")
         if normalized_control_id == 'hw_revision':
             device.hw_version = value
@@ -179,7 +233,70 @@ class Wirenboard:
         self.hass.publish_device_config(device)
         return True
 
+    @property
+    def device_id_prefix(self) -> str:
+        return self._device_id_prefix
+
+    def stop(self):
+        """Closes coalescing windows, commands pending till the end of window are dropped."""
+        for timer in self._command_windows.values():
+            timer.cancel()
+        self._command_windows.clear()
+        self._pending_commands.clear()
+
     def on_control_set_state(self, device_id: str, control_id: str, control_state: str):
-        self._router.publish(f"/devices/{device_id}/controls/{control_id}/on", control_state, qos=self._publish_qos, retain=self._publish_retain)
+        """
+        Forwards command to Wiren Board. Device id is id in registry, with prefix of this controller.
+        Commands to range controls (sliders) are coalesced: the first one is sent immediately, then during
+        the window only the latest one is kept and sent at the end of window.
+        """
+        received_at = time.monotonic()
+        key = (device_id, control_id)
+        topic = self._command_topics.get(key)
+        if topic is None:
+            topic = f"/devices/{device_id[len(self._device_id_prefix):]}/controls/{control_id}/on"
+            # Commands come from any topic of Home Assistant broker, only known controls are cached
+            device = self._device_registry.devices().get(device_id)
+            if device is not None and control_id in device.controls:
+                self._command_topics[key] = topic
+        if self._command_coalesce_window > 0 and self._is_coalesced_control(device_id, control_id):
+            if topic in self._command_windows:
+                if topic in self._pending_commands and self._metrics is not None:
+                    self._metrics.inc('commands_coalesced')
+                self._pending_commands[topic] = (control_state, received_at)
+                return
+            self._open_command_window(topic)
+        self._send_command(topic, control_state, received_at)
+
+    def _is_coalesced_control(self, device_id: str, control_id: str) -> bool:
+        device = self._device_registry.devices().get(device_id)
+        control = device.controls.get(control_id) if device is not None else None
+        return control is not None and control.type == WirenControlType.range
+
+    def _open_command_window(self, topic: str):
+        self._command_windows[topic] = asyncio.get_running_loop().call_later(
+            self._command_coalesce_window, self._close_command_window, topic,
+        )
+
+    def _close_command_window(self, topic: str):
+        self._command_windows.pop(topic, None)
+        pending = self._pending_commands.pop(topic, None)
+        if pending is not None:
+            # Window is started again, so commands stay rate limited while slider is moving
+            self._open_command_window(topic)
+            self._send_command(topic, *pending)
+
+    def _send_command(self, topic: str, control_state: str, received_at: float):
+        self._router.publish(topic, control_state, qos=self._publish_qos, retain=self._publish_retain)
+        if self._metrics is not None:
+            self._metrics.inc('commands_sent')
+            # Time the command was held by coalescing window, from its arrival to handing it to the router.
+            # Queueing and delivery to the Wiren Board broker are not included
+            self._metrics.observe('command_coalesce_delay', time.monotonic() - received_at)
 
 _known_system_controls = ['hw_revision', 'short_sn', 'release_name']
+
+def is_device_info_control(device_id: str, control_id: str) -> bool:
+    """State of control fills info of device: serial number of device, hardware and release of controller."""
+    normalized_control_id = control_id.lower().replace(" ", "_")
+    return normalized_control_id == 'serial' or (device_id == 'system' and normalized_control_id in _known_system_controls)
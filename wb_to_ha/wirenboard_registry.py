@@ -1,27 +1,84 @@
+from array import array
 import logging
+import math
+import time
 
-from wb_to_ha.mappers import WirenControlType
+from wb_to_ha.mappers import WIREN_NUMERIC_TYPES, WirenControlType
 
 logger = logging.getLogger(__name__)
 
+class ControlHistory:
+    """
+    Last `size` state messages of control: timestamps and parsed values in fixed size arrays,
+    so memory per control does not depend on message rate. Non-numeric states are stored as NaN.
+    """
+    __slots__ = ('_timestamps', '_values', '_next', 'count')
+
+    _timestamps: array
+    _values: array
+    # index of the oldest entry, it is overwritten by the next message
+    _next: int
+    # number of messages since start
+    count: int
+
+    def __init__(self, size: int):
+        assert size > 0
+        self._timestamps = array('d', [0.0]) * size
+        self._values = array('d', [math.nan]) * size
+        self._next = 0
+        self.count = 0
+
+    def __len__(self) -> int:
+        return min(self.count, len(self._timestamps))
+
+    def append(self, timestamp: float, value: float | None):
+        self._timestamps[self._next] = timestamp
+        self._values[self._next] = math.nan if value is None else value
+        self._next = (self._next + 1) % len(self._timestamps)
+        self.count += 1
+
+    def items(self) -> list[tuple[float, float | None]]:
+        """Messages from the oldest to the newest, None for non-numeric states."""
+        start = self._next if self.count >= len(self._timestamps) else 0
+        indexes = [(start + i) % len(self._timestamps) for i in range(len(self))]
+        return [(self._timestamps[i], None if math.isnan(self._values[i]) else self._values[i]) for i in indexes]
+
+    def rate(self, now: float) -> float:
+        """Messages per minute over the time span of kept messages."""
+        if len(self) == 0:
+            return 0.0
+        oldest = self._timestamps[self._next if self.count >= len(self._timestamps) else 0]
+        return len(self) * 60 / max(now - oldest, 1.0)
+
 class WirenControl:
+    # Registry keeps a control per every WB control, slots make them compact
+    __slots__ = ('id', 'type', 'read_only', 'error', 'units', 'max', 'state', 'value', 'history', 'device_id')
+
     id: str
-    type: WirenControlType | None = None
+    type: WirenControlType | None
     read_only: bool | None
     error: bool | None
     units: str | None
     max: float | None
+    # Raw state as received from WB
     state: str | None
+    # State parsed once on ingestion, None for non-numeric types and unparsable states
+    value: float | None
+    # Last state messages, when history is enabled in registry
+    history: ControlHistory | None
     device_id: str
 
-    def __init__(self, device_id: str, control_id: str):
+    def __init__(self, device_id: str, control_id: str, history_size: int = 0):
         self.id = control_id
         self.device_id = device_id
+        self.type = None
         self.read_only = None
         self.error = None
         self.units = None
         self.max = None
         self.state = None
+        self.value = None
+        self.history = ControlHistory(history_size) if history_size else None
 
     @property
     def debug_id(self):
@@ -32,8 +89,28 @@ class WirenControl:
             return False
         else:
             self.type = t
+            # state can come before type
+            self.value = self._parse_value(self.state)
             return True
 
+    def apply_state(self, state: str):
+        changed = self.state != state
+        if changed:
+            self.state = state
+            self.value = self._parse_value(state)
+        if self.history is not None:
+            # every message is kept, repeated states are what makes control noisy
+            self.history.append(time.time(), self.value)
+        return changed
+
+    def _parse_value(self, state: str | None) -> float | None:
+        if state is None or self.type not in WIREN_NUMERIC_TYPES:
+            return None
+        try:
+            return float(state)
+        except ValueError:
+            return None
+
     def apply_read_only(self, read_only: bool):
         if self.read_only == read_only:
             return False
@@ -74,11 +151,13 @@ class WirenDevice:
     sw_version: str | None = None
     serial_number: str | None = None
     _controls: dict[str, WirenControl]
+    _history_size: int
 
-    def __init__(self, device_id):
+    def __init__(self, device_id, history_size: int = 0):
         self.device_id = device_id
         self.manufactorer = 'Wiren Board'
         self._controls = {}
+        self._history_size = history_size
 
     @property
     def debug_id(self):
@@ -90,7 +169,7 @@ class WirenDevice:
 
     def get_control(self, control_id) -> WirenControl:
         if control_id not in self._controls.keys():
-            self._controls[control_id] = WirenControl(self.device_id, control_id)
+            self._controls[control_id] = WirenControl(self.device_id, control_id, self._history_size)
             logger.debug(f'{self}: new control: {control_id}')
         return self._controls[control_id]
 
@@ -107,16 +186,19 @@ class WirenDevice:
 
 class WirenBoardDeviceRegistry:
     _wb_devices: dict[str, WirenDevice]
+    # Number of last state messages kept per control, 0 - history is disabled
+    _history_size: int
 
-    def __init__(self):
+    def __init__(self, history_size: int = 0):
         self._wb_devices = {}
+        self._history_size = history_size
 
     def devices(self):
         return self._wb_devices
 
     def get_device(self, device_id: str) -> WirenDevice:
         if self._wb_devices.get(device_id) is None:
-            self._wb_devices[device_id] = WirenDevice(device_id)
+            self._wb_devices[device_id] = WirenDevice(device_id, self._history_size)
             logger.debug(f'New device: {device_id}')
 
         return self._wb_devices[device_id]
@@ -0,0 +1,176 @@
+"""
+YAML emitter for Home Assistant manual MQTT config.
+
+Output is the same as `yaml.dump(data, allow_unicode=True)` with list items indented under their keys,
+mapping keys written as plain scalars and string values written as double-quoted scalars.
+
+All state lives in `YamlEmitter` instance created per `dump` call, so rendering is reentrant
+and can be done in worker threads or processes.
+"""
+import functools
+import re
+from typing import Any
+
+# Same line width as yaml.Emitter.best_width.
+_BEST_WIDTH = 80
+
+_ESCAPE_REPLACEMENTS = {
+    '\0': '0',
+    '\x07': 'a',
+    '\x08': 'b',
+    '\x09': 't',
+    '\x0A': 'n',
+    '\x0B': 'v',
+    '\x0C': 'f',
+    '\x0D': 'r',
+    '\x1B': 'e',
+    '\"': '\"',
+    '\\': '\\',
+    '\x85': 'N',
+    '\xA0': '_',
+    '\u2028': 'L',
+    '\u2029': 'P',
+}
+
+# Characters which are written escaped in double-quoted scalar with allow_unicode=True.
+_escaped_char_re = re.compile('["\\\\\x85\u2028\u2029\uFEFF]|[^\x20-\x7E\xA0-\uD7FF\uE000-\uFFFD]')
+_plain_key_re = re.compile(r'^[A-Za-z_][A-Za-z0-9_-]*$')
+# Keys which yaml resolver reads as bool or null, they can not be written plain.
+_reserved_plain_keys = {
+    'yes', 'Yes', 'YES', 'no', 'No', 'NO',
+    'true', 'True', 'TRUE', 'false', 'False', 'FALSE',
+    'on', 'On', 'ON', 'off', 'Off', 'OFF',
+    'null', 'Null', 'NULL',
+}
+
+@functools.lru_cache(maxsize=1024)
+def _format_key(key: str) -> str:
+    if _plain_key_re.match(key) and key not in _reserved_plain_keys:
+        return key
+    return "'" + key.replace("'", "''") + "'"
+
+def _format_plain(value: Any) -> str:
+    if value is None:
+        return 'null'
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+    if isinstance(value, float):
+        if value != value:
+            return '.nan'
+        if value == float('inf'):
+            return '.inf'
+        if value == -float('inf'):
+            return '-.inf'
+        text = repr(value).lower()
+        if '.' not in text and 'e' in text:
+            text = text.replace('e', '.0e', 1)
+        return text
+    return str(value)
+
+class YamlEmitter:
+    _parts: list[str]
+    _column: int
+
+    def __init__(self):
+        self._parts = []
+        self._column = 0
+
+    def emit(self, data: dict[str, Any]) -> str:
+        if data:
+            self._write_mapping(data, 0, first_inline=False)
+        else:
+            self._write('{}')
+        self._parts.append('\n')
+        return ''.join(self._parts)
+
+    def _write(self, data: str):
+        self._parts.append(data)
+        self._column += len(data)
+
+    def _write_indent(self, indent: int):
+        self._parts.append('\n' + ' ' * indent)
+        self._column = indent
+
+    def _write_mapping(self, data: dict[str, Any], indent: int, first_inline: bool):
+        for i, key in enumerate(sorted(data)):
+            if i > 0 or not first_inline:
+                if self._parts:
+                    self._write_indent(indent)
+                else:
+                    self._column = indent
+            self._write(_format_key(key) + ':')
+            self._write_value(data[key], indent)
+
+    def _write_sequence(self, data: list[Any], indent: int):
+        for item in data:
+            self._write_indent(indent)
+            self._write('- ')
+            if isinstance(item, dict) and item:
+                self._write_mapping(item, indent + 2, first_inline=True)
+            elif isinstance(item, list) and item:
+                raise ValueError('nested lists are not supported')
+            else:
+                self._write_scalar(item, indent + 2, leading_space=False)
+
+    def _write_value(self, value: Any, indent: int):
+        if isinstance(value, dict):
+            if value:
+                self._write_mapping(value, indent + 2, first_inline=False)
+            else:
+                self._write(' {}')
+        elif isinstance(value, list):
+            if value:
+                self._write_sequence(value, indent + 2)
+            else:
+                self._write(' []')
+        else:
+            self._write_scalar(value, indent + 2, leading_space=True)
+
+    def _write_scalar(self, value: Any, indent: int, leading_space: bool):
+        if leading_space:
+            self._write(' ')
+        if isinstance(value, str):
+            self._write_double_quoted(value, indent)
+        else:
+            self._write(_format_plain(value))
+
+    def _write_double_quoted(self, text: str, indent: int):
+        self._write('"')
+        # Fast path: nothing to escape and no space can be placed after line width.
+        if self._column + len(text) - 2 <= _BEST_WIDTH and not _escaped_char_re.search(text):
+            self._write(text + '"')
+            return
+        # Port of yaml.Emitter.write_double_quoted
+        start = end = 0
+        while end <= len(text):
+            ch = text[end] if end < len(text) else None
+            if ch is None or _escaped_char_re.match(ch):
+                if start < end:
+                    self._write(text[start:end])
+                    start = end
+                if ch is not None:
+                    if ch in _ESCAPE_REPLACEMENTS:
+                        data = '\\' + _ESCAPE_REPLACEMENTS[ch]
+                    elif ch <= '\xFF':
+                        data = '\\x%02X' % ord(ch)
+                    elif ch <= '\uFFFF':
+                        data = '\\u%04X' % ord(ch)
+                    else:
+                        data = '\\U%08X' % ord(ch)
+                    self._write(data)
+                    start = end + 1
+            if 0 < end < len(text) - 1 and (ch == ' ' or start >= end) and self._column + (end - start) > _BEST_WIDTH:
+                data = text[start:end] + '\\'
+                if start < end:
+                    start = end
+                self._write(data)
+                self._write_indent(indent)
+                if text[start] == ' ':
+                    self._write('\\')
+            end += 1
+        self._write('"')
+
+def dump(data: dict[str, Any]) -> str:
+    return YamlEmitter().emit(data)